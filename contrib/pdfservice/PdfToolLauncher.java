@@ -0,0 +1,59 @@
+/*
+ * Copyright (C) 2016 Artus
+ * All rights reserved.
+ *
+ * Author: Michel Guillot <michel.guillot@meggitt.com>
+ */
+
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.InputStreamReader;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.List;
+import java.util.jar.JarFile;
+
+/**
+ * JVM started ahead of a PDF tool run (see pdfservice_daemon.py)
+ *
+ * Usage: java -cp <dir> PdfToolLauncher <tool jar>
+ * The main class of the jar is loaded, then "ready" is written on stdout.
+ * The arguments of the run are then read on stdin, one per line, up to
+ * an empty line or the end of stdin, and the main method of the tool is
+ * called: the exit status and the output are those of the tool.
+ * The JVM is used for a single run.
+ */
+public final class PdfToolLauncher {
+
+    public static void main(String[] argv) throws Exception {
+        File jar = new File(argv[0]);
+        String mainClassName;
+        try (JarFile jarFile = new JarFile(jar)) {
+            mainClassName = jarFile.getManifest().getMainAttributes().getValue("Main-Class");
+        }
+        URLClassLoader loader = new URLClassLoader(new URL[] {jar.toURI().toURL()},
+                                                   PdfToolLauncher.class.getClassLoader());
+        Thread.currentThread().setContextClassLoader(loader);
+        Method main = Class.forName(mainClassName, true, loader).getMethod("main", String[].class);
+
+        System.out.println("ready");
+        System.out.flush();
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        List<String> args = new ArrayList<String>();
+        for (String line = in.readLine(); line != null && !line.isEmpty(); line = in.readLine()) {
+            args.add(line);
+        }
+        try {
+            main.invoke(null, (Object) args.toArray(new String[0]));
+        } catch (InvocationTargetException e) {
+            e.getCause().printStackTrace(System.out);
+            System.out.flush();
+            System.exit(1);
+        }
+    }
+}
@@ -83,7 +83,9 @@ from artusplugin.buildbot.model import Build
 from artusplugin.buildbot.web_ui import BuildBotModule
 from artusplugin.cache import Ticket_Cache
 from artusplugin.form import TicketFormTemplate, MSOFormTemplate
+from artusplugin.jobs import JobQueue
 from artusplugin.model import NamingRule
+from artusplugin.ooxml import TemplateCache
 from artusplugin.util import OrderedSet
 
 # Profiling
@@ -1251,7 +1253,7 @@ class AdminInterface(CComponent):
                 req.session['authz_change'] = 'False'
 
                 # Force update of UsersPermissions component
-                util.Users(self.env).__init__()
+                util.Users(self.env).invalidate()
 
                 # Get users associated with a profile
                 # through roles or directly
@@ -2516,34 +2518,21 @@ class DocumentsAdminPanel(TagsMgmt, VersionAdminPanel):
                 # Get PDF package
                 elif req.args.get('pdf_get') == 'Get Documents package':
                     if 'pdf_checkbox' in req.args:
-                        # Handle PDF packaging asynchronously
-                        pid = os.fork()
-                        if pid == 0:  # Child process
-                            # The following waiting time is for allowing the parent process
-                            # to end because it seems concurrency is poorly supported for
-                            # access to the Trac database and generates the following error:
-                            # "sqlite backend database disk image is malformed"
-                            sleep(10)
-                            pdf_package = cache.PDFPackage(
-                                self.env,
-                                req.authname,
-                                req.args.get('pdf_checkbox'),
-                                data['pdf_renaming'],
-                                data['max_size'],
-                                data['prf_chklst'],
-                                data['source_files'])
-                            pdf_package.build()
-                            pdf_package.notify(self.compmgr)
-                            os._exit(0)
-                        else:  # Parent process
-                            base_url = '/PDF-packaging/%s' % data['trac_env_name']
-                            add_notice(req, _('You will receive an email '
-                                              'when your packaging job is complete. '))
-                            add_notice(req, tag(_('You may also click on '),
-                                                tag.a(_('this link'), href="%s" % base_url),
-                                                _(' to access the package(s) directly. '),
-                                                tag.b(_('Please allow some time')),
-                                                _(' for zip generation.')))
+                        # Handle PDF packaging asynchronously (see xhrget 'pdf_jobs')
+                        JobQueue(self.env).enqueue('pdf_package', req.authname, {
+                            'pdf_list': req.args.get('pdf_checkbox'),
+                            'pdf_rename': data['pdf_renaming'],
+                            'max_size': data['max_size'],
+                            'prf_chklst': data['prf_chklst'],
+                            'source_files': data['source_files']})
+                        base_url = '/PDF-packaging/%s' % data['trac_env_name']
+                        add_notice(req, _('You will receive an email '
+                                          'when your packaging job is complete. '))
+                        add_notice(req, tag(_('You may also click on '),
+                                            tag.a(_('this link'), href="%s" % base_url),
+                                            _(' to access the package(s) directly. '),
+                                            tag.b(_('Please allow some time')),
+                                            _(' for zip generation.')))
                     else:
                         # Case where no element is selected
                         add_warning(req, _("Sorry, can not generate a PDF package. No PDF was selected."))
@@ -6028,6 +6017,8 @@ class TemplatesAdminPanel(CComponent):
                                 req.args.get('%s_selected_url' % selected))
                 try:
                     self.config.save()
+                    # The template artefacts are read again
+                    TemplateCache.invalidate()
                     add_notice(req, _('Your change has been saved.'))
                 except Exception:
                     e = sys.exc_info()[1]
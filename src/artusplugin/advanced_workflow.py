@@ -40,7 +40,7 @@ from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 from email import encoders
-from itertools import groupby, chain
+from itertools import groupby
 from collections import OrderedDict
 from artusplugin.ldap.ldap_utilities import Ldap_Utilities
 from io import StringIO
@@ -53,7 +53,7 @@ import urllib.request, urllib.error, urllib.parse
 from zipfile import ZipFile
 
 # Same package
-from artusplugin import form, _
+from artusplugin import form, pdfservice, _
 from artusplugin.admin.web_ui import VersionTagsAdminPanel
 from artusplugin.buildbot.web_ui import BuildBotModule
 from artusplugin.model import Tag, Document, BaselineItem, Branch
@@ -466,8 +466,8 @@ class TicketWF(object):
         # Get all roles for the given name
         # dictionary: eg key: SCM / value: Software Configuration Manager
         roles_by_initials = {}
-        for (subject, group) in self.component.all_permissions:
-            if subject == name and group in self.component.user_roles:
+        for group in Users(self.component.env).get_roles(name):
+            if group in self.component.user_roles:
                 value = group.replace('_', ' ').title()
                 if value == 'Project Manager':
                     key = 'PjM'
@@ -1200,14 +1200,9 @@ class DocWF(TicketWF):
 
                 certificate_validity_required = self.get_certificate_validity_required() == 'True'
 
-                # Check the validity dates of the certificate chain
-                sign_jar_path = self.env.config.get('artusplugin', 'sign_jar_path', '/srv/trac/common/TracPdfSign.jar')
-                unix_cmd_list = ['sudo /usr/bin/java '
-                                 '-jar %s '
-                                 '-validity' % sign_jar_path]
-
-                # Effective application of the list of commands
-                retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
+                # Check the validity dates of the certificate chain (kept until renewal)
+                sign_jar_path = self.env.config.get('artusplugin', 'sign_jar_path', pdfservice.SIGN_JAR)
+                retcode, lines = pdfservice.CertificateValidity(self.env, sign_jar_path).check()
 
                 if retcode != 0:
                     if certificate_validity_required:
@@ -1232,9 +1227,10 @@ class DocWF(TicketWF):
                                   self.req.authname,
                                   self.ticket) as doc:
 
-                    doc.checkout(self.ticket['pdffile'])
+                    docfiles = [self.ticket['pdffile']]
                     if self.ticket['sourcefile'] and self.ticket['sourcefile'] != 'N/A':
-                        doc.checkout(self.ticket['sourcefile'])
+                        docfiles.append(self.ticket['sourcefile'])
+                    doc.checkout_files(docfiles)
 
                     # Create sub-directory for signing
                     sign_dir = "%s/.sign" % doc.path
@@ -1263,47 +1259,37 @@ class DocWF(TicketWF):
                     else:
                         tmpl_properties_path = None
 
-                    # Sign PDF
-                    unix_cmd_list = []
+                    # Sign PDF - the signatures are applied in one batch
+                    jobs = []
                     with Ldap_Utilities() as ldap_util:
                         for signature in signatures:
                             signer_role = signature['role'] if signature['role'] != 'role not set' else ''
                             signer_email = util.Users.get_email(self.env, signature['user'], ldap_util)
-                            unix_cmd = ('sudo /usr/bin/java '
-                                        '-jar %s '
-                                        '-sign ' % sign_jar_path)
+                            args = ['-sign']
                             if tmpl_properties_path:
-                                unix_cmd += ('-p "%s" ' % tmpl_properties_path)
-                            unix_cmd += ('-A "%s" '
-                                         '-a "%s" '
-                                         '-R "%s" '
-                                         '-e "%s" '
-                                         '-r "%s" '
-                                         '-t "%s" '
-                                         '-s "%s" '
-                                         '-d "%s"' % (
-                                             signature['signed_action'],
-                                             signature['user'],
-                                             signer_role,
-                                             signer_email,
-                                             signature['rect_id'],
-                                             signature_timestamp,
-                                             src,
-                                             dest))
-                            unix_cmd_list += [unix_cmd]
-
+                                args += ['-p', tmpl_properties_path]
+                            args += ['-A', signature['signed_action'],
+                                     '-a', signature['user'],
+                                     '-R', signer_role,
+                                     '-e', signer_email,
+                                     '-r', signature['rect_id'],
+                                     '-t', signature_timestamp,
+                                     '-s', src,
+                                     '-d', dest]
                             # Copy signed PDF to the working copy (if not empty)
-                            unix_cmd_list += ['if [[ -s "%s" ]] ; then cp -f "%s" "%s"; fi'
-                                              % (dest, dest, src)]
+                            jobs.append(pdfservice.PdfJob(sign_jar_path, args, (dest, src)))
+
+                    retcode, lines = pdfservice.run_jobs(self.env, jobs)
 
-                    # Commit
-                    unix_cmd_list += [util.SVN_TEMPLATE_CMD % {
-                                      'subcommand': 'commit -m "%s" "%s"' % (
-                                          _('ticket:%(id)s (on behalf of %(user)s)',
-                                            id=str(self.ticket.id), user=self.req.authname), doc.path)}]
+                    if retcode == 0:
+                        # Commit
+                        unix_cmd_list = [util.SVN_TEMPLATE_CMD % {
+                                         'subcommand': 'commit -m "%s" "%s"' % (
+                                             _('ticket:%(id)s (on behalf of %(user)s)',
+                                               id=str(self.ticket.id), user=self.req.authname), doc.path)}]
 
-                    # Effective application of the list of commands
-                    retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
+                        # Effective application of the list of commands
+                        retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
 
                     if retcode == 0:
                         revision = ''
@@ -2848,8 +2834,8 @@ class DOCWF(DocWF):
         users = Users(ticket.env)
 
         def add_author(owner):
-            if (owner not in users.users_by_profile['admin'] or
-                owner in chain.from_iterable(list(users.users_by_role.values()))):
+            if (not users.has_profile(owner, 'admin') or
+                users.has_role(owner)):
                 # admin user filtered out if without role
                 authors.add(owner)
 
@@ -2906,8 +2892,8 @@ class DOCWF(DocWF):
             elif ('document' in changes[-1] and 'status' in changes[-2] and
                   changes[-2]['status'][1] == initial_status):
                 # tag removal  by admin
-                if (owner in users.users_by_profile['admin'] and
-                    owner in chain.from_iterable(list(users.users_by_role.values()))):
+                if (users.has_profile(owner, 'admin') and
+                    users.has_role(owner)):
                     authors.discard(owner)
             else:
                 # just keep track of owner and status
@@ -3334,15 +3320,20 @@ class TicketWorkflowOpTriage(Component):
         self.certificate_validity_required = self.env.config.get('artusplugin', 'certificate_validity_required', 'True')
         self.perm = PermissionSystem(self.env)  # pylint: disable=too-many-function-args
         self.ticket_module = TicketModule(self.env)  # pylint: disable=too-many-function-args
-        self.all_permissions = self.perm.get_all_permissions()
-        self.users = {t[0] for t in self.all_permissions
-                      if t[0] not in self.user_profiles and
-                      t[0] not in self.user_roles}
         self.dc_url = self.env.config.get('artusplugin', 'dc_url')
         program_data = util.get_program_data(self.env)
         self.trac_env_name = program_data['trac_env_name']
         self.program_name = program_data['program_name']
 
+    @property
+    def all_permissions(self):
+        return Users(self.env).all_permissions
+
+    @property
+    def users(self):
+        """ Users which are neither profiles nor roles """
+        return Users(self.env).index.users
+
     # ITicketActionController methods
 
     def get_ticket_actions(self, req, ticket):
@@ -38,7 +38,6 @@ import shutil
 import sys
 import syslog
 import warnings
-from itertools import chain
 
 # https://github.com/JoshData/python-email-validator
 from email_validator import validate_email, EmailNotValidError
@@ -977,8 +976,8 @@ class ArtusSystem(CComponent):
                  action != 'return_to_peer_review'): # DOC
                 owner = ticket['owner'] if 'owner' not in ticket._old else ticket._old['owner']
                 users_permissions = util.Users(self.env)
-                if (owner in users_permissions.users_by_profile['admin'] and
-                    owner not in chain.from_iterable(users_permissions.users_by_role.values())):
+                if (users_permissions.has_profile(owner, 'admin') and
+                    not users_permissions.has_role(owner)):
                     msg = tag.p("You may not sign as a Trac admin, ",
                                 "a role in the project is required.")
                     issues.append((None, msg))
@@ -1638,45 +1637,28 @@ class ArtusSystem(CComponent):
             template_cls = cache.Ticket_Cache.get_subclass(ticket['type'])
             with template_cls(self.env, self.trac_env_name,
                               authname, ticket) as doc:
-                if ticket['type'] == 'ECM':
+                if ticket['type'] in ('ECM', 'FEE'):
                     ticket['sourcefile'] = '%s.docm' % ticket['configurationitem']
-                    if ((ticket['ecmtype'] == 'Technical Note' and ticket['fromecm'] == 'New Technical Note') or
-                        ticket['ecmtype'] == 'Document Delivery'):
-                        doc.add(ticket['sourcefile'])
-                    else:
-                        doc.checkout(ticket['sourcefile'])
-                    doc.lock(ticket['sourcefile'])
-                    doc.update_data(ticket['sourcefile'])
-                    doc.upgrade_document(ticket['sourcefile'])
                     ticket['pdffile'] = '%s.pdf' % ticket['configurationitem']
-                    if ((ticket['ecmtype'] == 'Technical Note' and ticket['fromecm'] == 'New Technical Note') or
-                        ticket['ecmtype'] == 'Document Delivery'):
-                        doc.add(ticket['pdffile'])
+                    docfiles = [ticket['sourcefile'], ticket['pdffile']]
+                    if ticket['type'] == 'ECM':
+                        new_document = ((ticket['ecmtype'] == 'Technical Note' and ticket['fromecm'] == 'New Technical Note') or
+                                        ticket['ecmtype'] == 'Document Delivery')
                     else:
-                        doc.checkout(ticket['pdffile'])
-                    doc.lock(ticket['pdffile'])
-                elif ticket['type'] == 'FEE':
-                    ticket['sourcefile'] = '%s.docm' % ticket['configurationitem']
-                    if ticket['fromfee'] == 'New Evolution Sheet':
-                        doc.add(ticket['sourcefile'])
+                        new_document = ticket['fromfee'] == 'New Evolution Sheet'
+                    if new_document:
+                        doc.add_files(docfiles)
                     else:
-                        doc.checkout(ticket['sourcefile'])
-                    doc.lock(ticket['sourcefile'])
+                        doc.checkout_files(docfiles)
+                    doc.lock_files(docfiles)
                     doc.update_data(ticket['sourcefile'])
                     doc.upgrade_document(ticket['sourcefile'])
-                    ticket['pdffile'] = '%s.pdf' % ticket['configurationitem']
-                    if ticket['fromfee'] == 'New Evolution Sheet':
-                        doc.add(ticket['pdffile'])
-                    else:
-                        doc.checkout(ticket['pdffile'])
-                    doc.lock(ticket['pdffile'])
-                
+
                 revision = doc.commit()
                 # Existing ECM/FEE
                 if revision == '' and ticket['type'] in ('ECM', 'FEE'):
                     # Remove the locks
-                    doc.unlock(ticket['sourcefile'])
-                    doc.unlock(ticket['pdffile'])
+                    doc.unlock_files([ticket['sourcefile'], ticket['pdffile']])
                     # Get revision
                     revision = util.get_last_path_rev_author(self.env, util.get_url(ticket['sourceurl']))[2]
                 if revision:
@@ -16,14 +16,17 @@ from trac.util.html import html as tag
 from jinja2 import Environment, FileSystemLoader, TemplateNotFound
 
 # Trac
+from trac.admin.api import IAdminCommandProvider
 from trac.attachment import Attachment
-from trac.core import TracError
+from trac.core import Component, implements, TracError
+from trac.resource import ResourceNotFound
 from trac.ticket import Ticket
 from trac.ticket.model import Type
 from trac.util import get_pkginfo
-from trac.util.datefmt import localtz
-from trac.util.text import unicode_quote, pretty_size
-from trac.versioncontrol.api import NoSuchNode
+from trac.util.datefmt import localtz, pretty_timedelta
+from trac.util.text import unicode_quote, pretty_size, printout
+from trac.versioncontrol.api import Changeset, Node, NoSuchNode
+from trac.web.api import IRequestFilter
 from trac.web.chrome import Chrome
 
 # Standard lib
@@ -35,12 +38,14 @@ import re
 import hashlib
 import shutil
 import smtplib
-import subprocess
+import sqlite3
 import sys
 import syslog
+import threading
 import time
 import urllib.request
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -50,19 +55,167 @@ from io import StringIO
 from tempfile import mkdtemp
 from xml.dom.minidom import parseString, parse
 from xml.etree import ElementTree
-from lxml import etree
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP64_LIMIT, BadZipFile
 
 # 3rd party modules
 import posix_ipc
 
 # Same package
-from artusplugin import util, model, _
+from artusplugin import util, model, pdfservice, _
 from artusplugin.form import TicketForm
+from artusplugin.ooxml import OOXMLPackage, TemplateCache
+from artusplugin.svnclient import get_svn_client
 import artusplugin
 import trac
 
 
+class WorkingCopyLock(object):
+    """ Shared/exclusive lock of a working copy, shared by all processes
+
+    Built on two named POSIX semaphores:
+    -> the 'turnstile' (initial value 1), named after the working copy
+       as was the single exclusive semaphore before: a writer holds it
+       for the whole exclusive section, readers only pass through it
+       so that a waiting writer is not starved by new readers
+    -> the 'room' (initial value max_readers): a reader holds one slot,
+       a writer drains all the slots to wait for the readers to leave
+    Wait and hold times are accumulated per mode in WorkingCopyLock.stats
+    and logged by each process at a fixed interval (see log_stats).
+    """
+
+    max_readers = 32
+    stats = {}
+    _stats_since = time.time()
+    _stats_lock = threading.Lock()
+
+    def __init__(self, sem_name, timeout=None, log_level=None):
+        self.sem_name = sem_name
+        self.timeout = timeout
+        self.log_level = log_level
+        self.turnstile = posix_ipc.Semaphore(
+            name=sem_name,
+            flags=posix_ipc.O_CREAT,
+            initial_value=1)
+        self.room = posix_ipc.Semaphore(
+            name='%s:room' % sem_name,
+            flags=posix_ipc.O_CREAT,
+            initial_value=self.max_readers)
+        self.mode = None
+        self.acquired_at = None
+
+    def acquire(self, mode='exclusive'):
+        start = time.time()
+        deadline = start + self.timeout if self.timeout else None
+        try:
+            self._acquire(self.turnstile, deadline)
+            if mode == 'shared':
+                try:
+                    self._acquire(self.room, deadline)
+                finally:
+                    self.turnstile.release()
+            else:
+                acquired = 0
+                try:
+                    while acquired < self.max_readers:
+                        self._acquire(self.room, deadline)
+                        acquired += 1
+                except posix_ipc.BusyError:
+                    for i in range(acquired):
+                        self.room.release()
+                    self.turnstile.release()
+                    raise
+        except posix_ipc.BusyError:
+            self._record(mode, time.time() - start, timeout=True)
+            raise TracError("The working copy is busy (%s lock not obtained "
+                            "within %s s), please retry later" % (mode, self.timeout))
+        self.mode = mode
+        self.acquired_at = time.time()
+        self._record(mode, self.acquired_at - start)
+
+    @staticmethod
+    def _acquire(sem_handle, deadline):
+        if deadline is None:
+            sem_handle.acquire()
+        else:
+            sem_handle.acquire(max(deadline - time.time(), 0))
+
+    def try_acquire(self):
+        """ Exclusive lock if it can be obtained at once
+            Return whether the lock is held """
+        try:
+            self.turnstile.acquire(0)
+        except posix_ipc.BusyError:
+            return False
+        acquired = 0
+        try:
+            while acquired < self.max_readers:
+                self.room.acquire(0)
+                acquired += 1
+        except posix_ipc.BusyError:
+            for i in range(acquired):
+                self.room.release()
+            self.turnstile.release()
+            return False
+        self.mode = 'exclusive'
+        return True
+
+    def release(self):
+        if self.mode == 'shared':
+            self.room.release()
+        elif self.mode == 'exclusive':
+            for i in range(self.max_readers):
+                self.room.release()
+            self.turnstile.release()
+        if self.mode and self.acquired_at:
+            hold = time.time() - self.acquired_at
+            with WorkingCopyLock._stats_lock:
+                stats = self._get_stats(self.mode)
+                stats['hold'] += hold
+                stats['max_hold'] = max(stats['max_hold'], hold)
+        self.mode = None
+        self.acquired_at = None
+
+    @staticmethod
+    def _get_stats(mode):
+        return WorkingCopyLock.stats.setdefault(mode, {
+            'count': 0, 'wait': 0.0, 'max_wait': 0.0,
+            'hold': 0.0, 'max_hold': 0.0, 'timeouts': 0})
+
+    def _record(self, mode, wait, timeout=False):
+        with WorkingCopyLock._stats_lock:
+            stats = self._get_stats(mode)
+            stats['count'] += 1
+            stats['wait'] += wait
+            stats['max_wait'] = max(stats['max_wait'], wait)
+            if timeout:
+                stats['timeouts'] += 1
+        if timeout or self.log_level == 'INFO' or wait > 5:
+            syslog.syslog("%s lock on %s: waited %.3f s%s" % (
+                mode, self.sem_name, wait, ' (timeout)' if timeout else ''))
+
+    @staticmethod
+    def log_stats(interval):
+        """ Log and reset the stats of the process
+            if they are older than interval seconds """
+        with WorkingCopyLock._stats_lock:
+            now = time.time()
+            if now - WorkingCopyLock._stats_since < interval:
+                return
+            stats = WorkingCopyLock.stats
+            WorkingCopyLock.stats = {}
+            since = WorkingCopyLock._stats_since
+            WorkingCopyLock._stats_since = now
+        for mode, mode_stats in sorted(stats.items()):
+            # Held locks may be released after a reset
+            count = mode_stats['count'] or 1
+            syslog.syslog("Working copy %s locks (process %s, last %d s): %s acquired, "
+                          "%s timeouts, wait %.3f s avg / %.3f s max, "
+                          "hold %.3f s avg / %.3f s max" % (
+                              mode, os.getpid(), now - since, mode_stats['count'], mode_stats['timeouts'],
+                              mode_stats['wait'] / count, mode_stats['max_wait'],
+                              mode_stats['hold'] / count, mode_stats['max_hold']))
+
+
 class Ticket_Cache(object):
     """ This class and its subclasses are used for handling the working copy
 
@@ -74,9 +227,12 @@ class Ticket_Cache(object):
         """ Return subclass associated to ticket type """
         return cacheddocument_subclasses[ticket_type]
 
-    def __init__(self, env, trac_env_name, authname, ticket):
+    def __init__(self, env, trac_env_name, authname, ticket, mode='exclusive'):
         self.env = env
         self.log_level = env.config.get('logging', 'log_level')
+        # 'shared' for read-only work (status, existence, size...),
+        # 'exclusive' for working copy mutations
+        self.mode = mode
         self.trac_env_name = trac_env_name
         self.authname = authname
         self.ticket_type = ticket['type']
@@ -116,118 +272,178 @@ class Ticket_Cache(object):
         sha1 = hashlib.sha1()
         sha1.update(util.get_url(self.sourceurl).encode('utf-8'))
         self.sourceurl_hash = format(sha1.hexdigest())
-        self.sem_handle = posix_ipc.Semaphore(
-            name=self.sem_name,
-            flags=posix_ipc.O_CREAT,
-            initial_value=1)
+        self.svn = get_svn_client(env)
+        self.repos_index = util.RepositoryIndex(env)
+        # Revision of the working copy if it has just been cloned
+        # from the template pool (see WorkingCopyPool)
+        self.cloned_rev = None
+        self.wc_lock = WorkingCopyLock(
+            self.sem_name,
+            env.config.getint('artusplugin', 'ticket_cache_lock_timeout', 300),
+            self.log_level)
 
     def __enter__(self):
-        self.sem_handle.acquire()
+        # The working copy creation requires an exclusive lock
+        mode = self.mode if self.exist_wc() else 'exclusive'
+        self.wc_lock.acquire(mode)
         try:
             if not self.exist_wc():
                 self.create_wc()
         except Exception as e:
-            self.sem_handle.release()
+            self.wc_lock.release()
             raise TracError(e)
 
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.sem_handle.release()
+        self.wc_lock.release()
 
     def exist_wc(self):
         # Test existence of working copy
         return os.path.isdir("%s/.svn" % self.path)
 
     def create_wc(self):
-        # Create working copy
-        unix_cmd_list = ['mkdir -p "%s"' % self.path]
-        unix_cmd_list += [util.SVN_TEMPLATE_CMD % {'subcommand': 'co --depth empty'} +
-                          '"' + self.repo_url + '" "' + self.path + '"']
-        retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
+        # Create working copy (from the template pool if possible)
+        if self.env.config.getbool('artusplugin', 'wc_template_pool', True) and self.sem_rel_path:
+            rev = self.resolve_revision(self.revision)
+            if rev:
+                pool = WorkingCopyPool(self.env, self.trac_env_name, self.svn)
+                if pool.clone(self.repo_url, self.sem_rel_path, self.sourceurl_hash,
+                              rev, self.path):
+                    self.cloned_rev = rev
+                    return
+        retcode, lines = self.svn.checkout(self.repo_url, self.path)
         if retcode != 0:
             raise TracError('\n'.join(lines))
 
+    def resolve_revision(self, revision):
+        """ Revision number, HEAD being resolved to the youngest revision """
+        if revision == 'HEAD':
+            return self.repos_index.get_head_rev(util.get_url(self.sourceurl))
+        try:
+            return int(revision)
+        except ValueError:
+            return None
+
+    def is_cloned_at(self, revision):
+        """ Test if the working copy has just been cloned at the given revision:
+            its files are then those of the repository at that revision """
+        return self.cloned_rev is not None and self.cloned_rev == self.resolve_revision(revision)
+
     def update_wc(self):
         # Update working copy
-        unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'up'} +
-                         '"' + self.path + '"']
-        retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
+        retcode, lines = self.svn.update(self.path)
         if retcode != 0:
             raise TracError('\n'.join(lines))
 
     def switch_wc(self, url):
         # Switch working copy
-        unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'switch'} +
-                         '--ignore-ancestry "' + url + '" "' + self.path + '"']
-        retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
+        retcode, lines = self.svn.switch(url, self.path)
         if retcode != 0:
             raise TracError('\n'.join(lines))
 
     def add(self, docfile):
-        if docfile:
+        self.add_files([docfile])
+
+    def add_files(self, docfiles):
+        """ Add the given docfiles (or check them out if they already exist
+            in the repository) with one svn invocation
+            Return {docfile: 'added' | 'checked out' | 'skipped'}
+        """
+        results = dict((docfile, 'skipped') for docfile in docfiles if docfile)
+        new_docfiles = []
+        existing_docfiles = []
+        for docfile in results:
             if not self.exist_in_repo(docfile, 'HEAD'):
+                docpath = '%s/%s' % (self.path, docfile)
                 if not self.exist_in_wc(docfile) and docfile.endswith('.docm'):
                     # Source template
-                    docpath = '%s/%s' % (self.path, docfile)
                     shutil.copy(self.template, docpath)
                 if not self.exist_in_wc(docfile) and docfile.endswith('.pdf'):
                     # PDF template
-                    docpath = '%s/%s' % (self.path, docfile)
                     open(docpath, 'a').close()
                 if self.exist_in_wc(docfile):
-                    unix_cmd_list = ['cd "%s";%s' % (self.path, util.SVN_TEMPLATE_CMD % {'subcommand': 'add --force'} +
-                                                '"' + docfile + '"')]
-                    unix_cmd_list += ['cd "%s";%s' % (self.path, util.SVN_TEMPLATE_CMD % {'subcommand': 'propset --force svn:needs-lock "*"'} +
-                                                    '"' + docfile + '"')]
-                    retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
-                    if retcode != 0:
-                        raise TracError('\n'.join(lines))
+                    new_docfiles.append(docfile)
                 else:
                     raise TracError('File not found: %s' % docpath)
             else:
-                self.checkout(docfile)
+                existing_docfiles.append(docfile)
+        if new_docfiles:
+            retcode, lines = self.svn.add(self.path, new_docfiles)
+            if retcode == 0:
+                retcode, lines = self.svn.propset('svn:needs-lock', '*', self.path, new_docfiles)
+            if retcode != 0:
+                raise TracError('\n'.join(lines))
+            for docfile in new_docfiles:
+                results[docfile] = 'added'
+        results.update(self.checkout_files(existing_docfiles))
+        return results
 
     def checkout(self, docfile):
-        if docfile and self.exist_in_repo(docfile, self.revision):
-            unix_cmd_list = ['cd "%s";%s' % (self.path, util.SVN_TEMPLATE_CMD % {'subcommand': 'up'} +
-                                           '-r %s ' % self.revision  + '"' + docfile + '"')]
-            retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
+        self.checkout_files([docfile])
+
+    def checkout_files(self, docfiles):
+        """ Check out the given docfiles at the ticket revision
+            with one svn invocation
+            Return {docfile: 'checked out' | 'skipped'}
+        """
+        results = dict((docfile, 'skipped') for docfile in docfiles if docfile)
+        targets = [docfile for docfile in results
+                   if self.exist_in_repo(docfile, self.revision)]
+        for docfile in targets:
+            results[docfile] = 'checked out'
+        if self.is_cloned_at(self.revision):
+            # Already copied from the template
+            targets = [docfile for docfile in targets if not self.exist_in_wc(docfile)]
+        if targets:
+            retcode, lines = self.svn.update(self.path, targets, self.revision)
             if retcode != 0:
                 raise TracError('\n'.join(lines))
+            WorkingCopyPool.share_pristines(self.path)
+        return results
 
     def update(self, docfile):
-        if docfile and docfile != 'N/A':
+        self.update_files([docfile])
+
+    def update_files(self, docfiles):
+        """ Update the given docfiles to HEAD with one svn invocation
+            Return {docfile: 'updated' | 'removed' | 'skipped'}
+        """
+        results = dict((docfile, 'skipped') for docfile in docfiles
+                       if docfile and docfile != 'N/A')
+        targets = []
+        for docfile in results:
             if not self.exist_in_repo(docfile, 'HEAD'):
                 # File has been removed, WC directory must be updated
-                unix_cmd_list = ['cd "%s";%s' % (self.path, util.SVN_TEMPLATE_CMD % {'subcommand': 'up'} +
-                                               '"."')]
-                retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
-                if retcode != 0:
-                    raise TracError('\n'.join(lines))
+                results[docfile] = 'removed'
+                if '.' not in targets:
+                    targets.insert(0, '.')
             else:
-                unix_cmd_list = ['cd "%s";%s' % (self.path, util.SVN_TEMPLATE_CMD % {'subcommand': 'up'} +
-                                               '"' + docfile + '"')]
-                retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
-                if retcode != 0:
-                    raise TracError('\n'.join(lines))
+                results[docfile] = 'updated'
+                targets.append(docfile)
+        if self.is_cloned_at('HEAD'):
+            # Already copied from the template of the youngest revision
+            targets = []
+        if targets:
+            retcode, lines = self.svn.update(self.path, targets)
+            if retcode != 0:
+                raise TracError('\n'.join(lines))
+            WorkingCopyPool.share_pristines(self.path)
+        return results
 
     def exist_in_repo(self, docfile, revision):
         """
             Test existence of the given docfile in the repository at the given revision
         """
         if docfile:
-            unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'info'} +
-                             '"%s/%s@%s" &> /dev/null' % (
-                             util.get_repo_url(self.env,
-                                               util.get_url(self.sourceurl)),
-                             docfile,
-                             revision)]
-            retcode = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())[0]
-            if retcode != 0:
-                return False
-            else:
-                return True
+            found = self.repos_index.exists('%s/%s' % (util.get_url(self.sourceurl), docfile),
+                                            revision)
+            if found is None:
+                found = self.svn.exists('%s/%s' % (util.get_repo_url(self.env,
+                                                                     util.get_url(self.sourceurl)),
+                                                   docfile),
+                                        revision)
+            return found
         else:
             return False
 
@@ -248,50 +464,61 @@ class Ticket_Cache(object):
             -> locks => 'lock_agent', 'lock_client'
             on the given docfile
         """
-        change_status = None
-        lock_agent = None
-        lock_ticket = None
-        lock_client = None
-        if (docfile and
-            ((status == 'wc-status' and self.exist_in_wc(docfile)) or
-             (status == 'repos-status' and self.exist_in_repo(docfile, 'HEAD')))):
-            # missing pristine warning eg is filtered out
-            unix_cmd = util.SVN_TEMPLATE_CMD % {
-                'subcommand': 'status --xml --show-updates --verbose'} + \
-                '"%s/%s" 2> /dev/null' % (self.path, docfile)
-            unix_cmd_list = [unix_cmd]
-            retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
-            if retcode == 0:
-                xml_string = ''
-                for line in lines:
-                    xml_string += line
-                dom = parseString(xml_string.encode('utf-8'))
-                status_list = dom.getElementsByTagName(status)
-                if status_list:
-                    change_status = status_list[0].getAttribute("item")
-                    lock_list = status_list[0].getElementsByTagName("lock")
-                    if lock_list:
-                        owner_list = lock_list[0].getElementsByTagName("owner")
-                        if owner_list and owner_list[0].childNodes:
-                            lock_agent = owner_list[0].childNodes[0].data
-                        comment_list = status_list[0].getElementsByTagName("comment")
-                        if comment_list and comment_list[0].childNodes:
-                            re_client = _('ticket:(\d+) \(on behalf of ([^)]+)\)')
-                            match = re.search(re_client, comment_list[0].childNodes[0].data)
-                            if match:
-                                lock_ticket = match.group(1)
-                                lock_client = match.group(2)
-        return {'change_status': change_status,
-                'lock_agent': lock_agent,
-                'lock_ticket': lock_ticket,
-                'lock_client': lock_client}
+        return self.statuses([docfile], (status,))[docfile][status]
+
+    def statuses(self, docfiles, status_list=('wc-status', 'repos-status')):
+        """
+            Same as status() for several docfiles and both statuses
+            with one svn invocation:
+            {docfile: {'wc-status': status, 'repos-status': status}}
+        """
+        results = {}
+        targets = []
+        for docfile in docfiles:
+            results[docfile] = {}
+            for status in status_list:
+                results[docfile][status] = {'change_status': None,
+                                            'lock_agent': None,
+                                            'lock_ticket': None,
+                                            'lock_client': None}
+                if (docfile and
+                    ((status == 'wc-status' and self.exist_in_wc(docfile)) or
+                     (status == 'repos-status' and self.exist_in_repo(docfile, 'HEAD')))):
+                    results[docfile][status]['queried'] = True
+                    if docfile not in targets:
+                        targets.append(docfile)
+        svn_statuses = self.svn.status(self.path, targets)
+        for docfile in targets:
+            for status in status_list:
+                if results[docfile][status].pop('queried', False):
+                    svn_status = svn_statuses[docfile][status]
+                    results[docfile][status]['change_status'] = svn_status['change_status']
+                    results[docfile][status]['lock_agent'] = svn_status['lock_agent']
+                    if svn_status['lock_comment']:
+                        re_client = _('ticket:(\d+) \(on behalf of ([^)]+)\)')
+                        match = re.search(re_client, svn_status['lock_comment'])
+                        if match:
+                            results[docfile][status]['lock_ticket'] = match.group(1)
+                            results[docfile][status]['lock_client'] = match.group(2)
+        return results
 
     def lock(self, docfile):
-        if docfile and self.exist_in_wc(docfile):
-            wc_status = self.status(docfile, 'wc-status')
+        self.lock_files([docfile])
+
+    def lock_files(self, docfiles):
+        """ Lock the given docfiles with one svn invocation
+            All locks are checked before any is set
+            Return {docfile: 'locked' | 'already locked' | 'skipped'}
+        """
+        results = dict((docfile, 'skipped') for docfile in docfiles if docfile)
+        candidates = [docfile for docfile in results if self.exist_in_wc(docfile)]
+        statuses = self.statuses(candidates)
+        targets = []
+        for docfile in candidates:
+            wc_status = statuses[docfile]['wc-status']
             if wc_status['change_status'] in ('added', 'unversioned'):
-                return
-            repos_status = self.status(docfile, 'repos-status')
+                continue
+            repos_status = statuses[docfile]['repos-status']
             if repos_status['lock_agent']:
                 if repos_status['lock_agent'] != 'trac':
                     raise TracError("Sorry, the file %s is already locked outside of trac by %s"
@@ -302,32 +529,49 @@ class Ticket_Cache(object):
                 else:
                     if self.log_level == 'INFO':
                         syslog.syslog("lock was already set in the working copy")
+                    results[docfile] = 'already locked'
             else:
-                unix_cmd_list = ['cd "%s";%s' % (self.path, util.SVN_TEMPLATE_CMD % {'subcommand': 'lock --force -m "%s" "%s"' % (
-                    _('ticket:%(id)s (on behalf of %(user)s)', id=str(self.id), user=self.authname),
-                    docfile)})]
-                retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
-                if retcode != 0:
-                    raise TracError('\n'.join(lines))
-                else:
-                    self.set_access(docfile)
+                targets.append(docfile)
+        if targets:
+            retcode, lines = self.svn.lock(self.path, targets,
+                                           _('ticket:%(id)s (on behalf of %(user)s)',
+                                             id=str(self.id), user=self.authname))
+            if retcode != 0:
+                raise TracError('\n'.join(lines))
+            for docfile in targets:
+                self.set_access(docfile)
+                results[docfile] = 'locked'
+        return results
 
     def unlock(self, docfile):
-        if docfile and self.exist_in_wc(docfile):
-            wc_status = self.status(docfile, 'wc-status')
+        self.unlock_files([docfile])
+
+    def unlock_files(self, docfiles):
+        """ Unlock the given docfiles with one svn invocation
+            Return {docfile: 'unlocked' | 'not locked' | 'skipped'}
+        """
+        results = dict((docfile, 'skipped') for docfile in docfiles if docfile)
+        candidates = [docfile for docfile in results if self.exist_in_wc(docfile)]
+        statuses = self.statuses(candidates, ('wc-status',))
+        targets = []
+        for docfile in candidates:
+            wc_status = statuses[docfile]['wc-status']
             if wc_status['change_status'] in ('added', 'unversioned'):
-                return
+                continue
             if (not wc_status['lock_agent']):
                 if self.log_level == 'INFO':
                     syslog.syslog("lock was not set in the working copy")
+                results[docfile] = 'not locked'
             else:
-                unix_cmd_list = ['cd "%s";%s' % (self.path, util.SVN_TEMPLATE_CMD % {'subcommand': 'unlock --force'} +
-                                               '"' + docfile + '"')]
-                retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
-                if retcode != 0:
-                    raise TracError('\n'.join(lines))
-                else:
-                    self.set_access(docfile)
+                targets.append(docfile)
+        if targets:
+            retcode, lines = self.svn.unlock(self.path, targets)
+            if retcode != 0:
+                raise TracError('\n'.join(lines))
+            for docfile in targets:
+                self.set_access(docfile)
+                results[docfile] = 'unlocked'
+        return results
 
     def get_flag_rel_path(self, docfile):
         """
@@ -392,30 +636,16 @@ class Ticket_Cache(object):
         # Set svn:ignore property
         my_ignore_list = ['.ignore', '.unzip', '.sign', 'trac_data.xml']
         theirs_ignore_list = []
-        unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'propget svn:ignore'} + '"' + self.path + '" &> /dev/null']
-        retcode = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())[0]
+        retcode, lines = self.svn.propget('svn:ignore', self.path)
         if retcode == 0:
-            unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'propget svn:ignore'} + '"' + self.path + '"']
-            lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())[1]
             theirs_ignore_list = [line.strip('\n') for line in lines if line != '\n']
         ignore_string = '\n'.join(theirs_ignore_list + [item for item in my_ignore_list if item not in theirs_ignore_list])
-        unix_cmd_list = ['echo -en "' + ignore_string + '" ' + '> "' + self.path + '/.ignore"']
-        unix_cmd_list += [util.SVN_TEMPLATE_CMD % {'subcommand': 'propset svn:ignore -F "' +
-                          self.path + '/.ignore"'} + '"' + self.path + '"']
-        unix_cmd_list += ['cd "%s";%s' % (self.path, util.SVN_TEMPLATE_CMD % {'subcommand': 'commit -m "%s"' %
-                            _('ticket:%(id)s (on behalf of %(user)s)', id=str(self.id), user=self.authname)})]
-        retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
+        retcode, lines = self.svn.propset('svn:ignore', ignore_string, self.path)
+        if retcode == 0:
+            retcode, lines, revision = self.svn.commit(
+                self.path, _('ticket:%(id)s (on behalf of %(user)s)', id=str(self.id), user=self.authname))
         if retcode != 0:
             raise TracError('\n'.join(lines))
-        else:
-            revision = ''
-            for line in lines:
-                if line.startswith(u'Révision '):
-                    regular_expression = u'\ARévision (\d+) propagée\.\n\Z'
-                    match = re.search(regular_expression, line)
-                    if match:
-                        revision = match.group(1)
-                    break
         return revision
 
     def get_customxml_filepath(self, dir = None):
@@ -433,12 +663,8 @@ class Ticket_Cache(object):
             raise TracError(message, 'Hostname mismatch ?', True)
 
     def get_customxml_root_elt(self, file_path):
-        input_zip = ZipFile(file_path)
-        items = {name: input_zip.read(name) for name in input_zip.namelist() if re.match('customXml/item\d+\.xml', name)}
-        for customxml_content in items.values():
-            customxml_root_elt = ElementTree.fromstring(customxml_content)
-            if customxml_root_elt.tag in [self.root_tag] + self.root_tag_legacy_list:
-                return customxml_root_elt
+        """ Shared (read-only) root element of the template custom XML """
+        return TemplateCache.get(file_path).get_customxml_root_elt([self.root_tag] + self.root_tag_legacy_list)
 
     def get_pdffile_list(self):
         return [f for f in os.listdir(self.path) if f.endswith('.pdf')]
@@ -540,137 +766,108 @@ class Ticket_Cache(object):
     def unzip(self, docfile):
         """ Open docm """
         if docfile and docfile.endswith('.docm') and self.exist_in_wc(docfile):
-            unix_cmd_list = ['rm -Rf "%s";mkdir -p "%s"' % (
-                self.cache_unzip, self.cache_unzip)]
-            # Using "7za" instead of "unzip" that seems to be not working properly according to:
-            # https://forums.centos.org/viewtopic.php?t=5451
-            # "unzip" reporting CRC errors on large files
-            unix_cmd_list += ['7za e -spf -o"%s" "%s/%s"' % (
-                 self.cache_unzip, self.path, docfile)]
-            retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list,
-                                                 util.lineno())
-            if retcode != 0:
-                raise TracError('\n'.join(lines))
+            try:
+                with OOXMLPackage('%s/%s' % (self.path, docfile)) as package:
+                    package.extract_all(self.cache_unzip)
+            except (IOError, OSError, BadZipFile) as e:
+                raise TracError('%s: %s' % (docfile, e))
 
     def zip(self, docfile):
-        """ Close docm """
+        """ Close docm
+            (members left unchanged in the unzip directory are copied as is) """
         if docfile and docfile.endswith('.docm') and self.exist_in_wc(docfile):
-            unix_cmd_list = ['rm -f "%s/%s"' % (
-                self.path, docfile)]
-            # Used "zip" command because could not get it working with 7za
-            unix_cmd_list += ['cd "%s";zip -r "%s/%s" . -i \*' % (
-                self.cache_unzip, self.path, docfile)]
-            retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list,
-                                                 util.lineno())
-            if retcode != 0:
-                raise TracError('\n'.join(lines))
+            try:
+                with OOXMLPackage('%s/%s' % (self.path, docfile)) as package:
+                    package.load_dir(self.cache_unzip)
+                    package.save()
+            except (IOError, OSError, BadZipFile) as e:
+                raise TracError('%s: %s' % (docfile, e))
 
     def upgrade_document(self, docfile):
         """ Upgrade document from newer template
             (limited to word document)
         """
         if docfile and docfile.endswith('.docm') and self.exist_in_wc(docfile) and self.template:
-            self.unzip(docfile)
-
-            document_upgraded = False
-
-            # Namespace is updated if needed
-            for line, new in util.inplace(self.get_customxml_filepath()):
-                for schemas_url_legacy in self.schemas_url_legacy_list:
-                    if schemas_url_legacy in line:
-                        line = line.replace(schemas_url_legacy, self.schemas_url)
-                        break
-                new.write(line)
+            with OOXMLPackage('%s/%s' % (self.path, docfile)) as package:
+                self._upgrade_package(package)
+
+    def _upgrade_package(self, package):
+        """ The document package is edited in memory and only saved if upgraded
+            (namespace and/or VBA project) """
+        customxml_name = package.find_customxml([self.root_tag] + self.root_tag_legacy_list)
+        if not customxml_name:
+            message = tag.span('%s: The custom XML could not be identified in the following document:' % util.lineno())
+            message(tag.p(package.path))
+            raise TracError(message, 'Hostname mismatch ?', True)
 
-            doc_customxml_dom = parse(self.get_customxml_filepath())
-            try:
-                # Get the current template reference (without edition)
-                template_ref = os.path.splitext(os.path.basename(self.template))[0]
-                # Get the document template reference (including edition)
-                doc_elt = doc_customxml_dom.getElementsByTagName("ns0:TemplateRef")[0]
-                doc_template_ref = doc_elt.firstChild.nodeValue
-                # Get the current edition ultimate pointed to path, where all editions are located
-                template_path = os.path.realpath(self.template)
-                # Get the compatible template for providing an upgraded VBA code
-                template_path = re.sub(r"%s_E[0-9]+" % template_ref, doc_template_ref, template_path)
-            except IndexError:
-                # Get current edition symbolic link target path
-                template_path = os.readlink(self.template)
-                # Get default edition template path for providing an upgraded VBA code
-                template_path = re.sub(r"current", r"default", template_path)
-                # Get default edition ultimate pointed to path
-                template_path = os.path.realpath(template_path)
-            if not os.path.exists(template_path):
-                # No upgrade
-                return
+        # Namespace is updated if needed
+        package.upgrade_namespace(customxml_name, self.schemas_url_legacy_list, self.schemas_url)
 
-            # Check if the VBA code has been upgraded
-            doc_elt = doc_customxml_dom.getElementsByTagName("ns0:Template")[0]
-            doc_mt = doc_elt.getAttribute("ModificationDateTime")
-            tmpl_customxml_root_elt = self.get_customxml_root_elt(template_path)
-            tmpl_elt = tmpl_customxml_root_elt.find('{%s}Template' % self.ns0)
-
-            if tmpl_elt:
-                tmpl_mt = tmpl_elt.attrib['ModificationDateTime']
-
-                if tmpl_mt > doc_mt:
-                    cmd = ('cd %s;'
-                           '/usr/bin/rm -f %s %s;'
-                           '/usr/bin/unzip "%s" '
-                           '"%s" %s' % (
-                               self.cache_unzip,
-                               self.vbaprojectfiles,
-                               self.vbadatafile,
-                               template_path,
-                               self.vbaprojectfiles,
-                               self.vbadatafile
-                               ))
-                    retcode = subprocess.call(cmd, shell=True)
-                    if retcode != 0:
-                        raise TracError("Could not upgrade VBA project "
-                                        "of current document - "
-                                        "unzip return code: %s" % retcode)
-                    else:
-                        document_upgraded = True
-                        syslog.syslog("%s(%s): VBA project upgraded from template '%s' - ticket %s (%s)" %
-                                      (self.trac_env_name, self.authname, template_path, self.id, self.ticket_type))
-
-                        customxml_tree = ElementTree.parse(self.get_customxml_filepath())
-                        customxml_tmpl = customxml_tree.find('{%s}Template' % self.ns0)
-
-                        if customxml_tmpl:
-                            customxml_tmpl.set('ModificationDateTime', tmpl_mt)
-                            customxml_tree.write(self.get_customxml_filepath())
-                            syslog.syslog("%s(%s): Modification DateTime updated - ticket %s (%s)" %
-                                          (self.trac_env_name, self.authname, self.id, self.ticket_type))
-                        else:
-                            message = tag.span('%s: Template not found or empty in template file:' % util.lineno())
-                            message(tag.p(self.get_customxml_filepath()))
-                            raise TracError(message, 'Hostname mismatch ?', True)
-
-                        for xml_file in ['document.xml'] + fnmatch.filter(os.listdir('%s/word' % self.cache_unzip), 'footer[1-99].xml'):
-                            xml_filepath = '%s/word/%s' % (self.cache_unzip, xml_file)
-                            xml_tree = etree.parse(xml_filepath)
-                            xml_root = xml_tree.getroot()
-                            xml_ns = xml_root.nsmap['w']
-                            for data_binding in xml_tree.findall('.//w:dataBinding', xml_root.nsmap):
-                                prefix_mappings = data_binding.get('{%s}prefixMappings' % xml_ns)
-                                if prefix_mappings:
-                                    for schemas_url_legacy in self.schemas_url_legacy_list:
-                                        if schemas_url_legacy in prefix_mappings:
-                                            prefix_mappings = prefix_mappings.replace(schemas_url_legacy, self.schemas_url)
-                                            break
-                                    data_binding.set('{%s}prefixMappings' % xml_ns, prefix_mappings)
-                            xml_tree.write(xml_filepath)
-                        syslog.syslog("%s(%s): Databinding upgraded - ticket %s (%s)" %
-                                      (self.trac_env_name, self.authname, self.id, self.ticket_type))
-            else:
-                message = tag.span('%s: Template not found or empty in template file:' % util.lineno())
-                message(tag.p(template_path))
-                raise TracError(message, 'Hostname mismatch ?', True)
+        doc_customxml_dom = parseString(package.read(customxml_name))
+        try:
+            # Get the current template reference (without edition)
+            template_ref = os.path.splitext(os.path.basename(self.template))[0]
+            # Get the document template reference (including edition)
+            doc_elt = doc_customxml_dom.getElementsByTagName("ns0:TemplateRef")[0]
+            doc_template_ref = doc_elt.firstChild.nodeValue
+            # Get the current edition ultimate pointed to path, where all editions are located
+            template_path = os.path.realpath(self.template)
+            # Get the compatible template for providing an upgraded VBA code
+            template_path = re.sub(r"%s_E[0-9]+" % template_ref, doc_template_ref, template_path)
+        except IndexError:
+            # Get current edition symbolic link target path
+            template_path = os.readlink(self.template)
+            # Get default edition template path for providing an upgraded VBA code
+            template_path = re.sub(r"current", r"default", template_path)
+            # Get default edition ultimate pointed to path
+            template_path = os.path.realpath(template_path)
+        if os.path.exists(template_path):
+            self._upgrade_vba(package, customxml_name, doc_customxml_dom, template_path)
+
+        if package.modified:
+            package.save()
+
+    def _upgrade_vba(self, package, customxml_name, doc_customxml_dom, template_path):
+        """ Upgrade the VBA project of the package from a newer template """
+        # Check if the VBA code has been upgraded
+        doc_elt = doc_customxml_dom.getElementsByTagName("ns0:Template")[0]
+        doc_mt = doc_elt.getAttribute("ModificationDateTime")
+        tmpl_customxml_root_elt = self.get_customxml_root_elt(template_path)
+        tmpl_elt = tmpl_customxml_root_elt.find('{%s}Template' % self.ns0)
+
+        if tmpl_elt:
+            tmpl_mt = tmpl_elt.attrib['ModificationDateTime']
+
+            if tmpl_mt > doc_mt:
+                vba_patterns = [self.vbaprojectfiles, self.vbadatafile]
+                vba_parts = TemplateCache.get(template_path).get_parts(vba_patterns)
+                if not package.swap_parts(vba_parts, vba_patterns):
+                    raise TracError("Could not upgrade VBA project "
+                                    "of current document - "
+                                    "no VBA project found in template '%s'" % template_path)
+                syslog.syslog("%s(%s): VBA project upgraded from template '%s' - ticket %s (%s)" %
+                              (self.trac_env_name, self.authname, template_path, self.id, self.ticket_type))
+
+                customxml_root = ElementTree.fromstring(package.read(customxml_name))
+                customxml_tmpl = customxml_root.find('{%s}Template' % self.ns0)
+
+                if customxml_tmpl:
+                    customxml_tmpl.set('ModificationDateTime', tmpl_mt)
+                    package.write(customxml_name, ElementTree.tostring(customxml_root))
+                    syslog.syslog("%s(%s): Modification DateTime updated - ticket %s (%s)" %
+                                  (self.trac_env_name, self.authname, self.id, self.ticket_type))
+                else:
+                    message = tag.span('%s: Template not found or empty in template file:' % util.lineno())
+                    message(tag.p('%s/%s' % (package.path, customxml_name)))
+                    raise TracError(message, 'Hostname mismatch ?', True)
 
-            if document_upgraded:
-                self.zip(docfile)
+                package.rewrite_data_bindings(self.schemas_url_legacy_list, self.schemas_url)
+                syslog.syslog("%s(%s): Databinding upgraded - ticket %s (%s)" %
+                              (self.trac_env_name, self.authname, self.id, self.ticket_type))
+        else:
+            message = tag.span('%s: Template not found or empty in template file:' % util.lineno())
+            message(tag.p(template_path))
+            raise TracError(message, 'Hostname mismatch ?', True)
 
     def get_version_status(self, docfile):
         """ Return document version status
@@ -725,10 +922,437 @@ class Ticket_Cache(object):
         return unlock_description
 
 
+class WorkingCopyPool(object):
+    """ Pool of template working copies
+
+    Templates are checkouts of document folders (files included) at a
+    given revision, HEAD being resolved to the youngest revision, grouped
+    by branch root (sem_rel_path) and kept at:
+        /var/cache/trac/tickets/.pool/<env><branch root>/<url hash>.<revision>
+    A template is checked out once and never updated: a newer HEAD gets
+    its own template, the older ones being evicted by TicketCacheManager.
+    A ticket working copy is created by a local copy of the template
+    (svn 1.7+ working copies are relocatable) instead of a checkout, its
+    pristines being hardlinked, so that no server access is needed.
+    Pristines (content-addressed, never modified in place) are shared
+    between working copies through hardlinks to a common store.
+    """
+
+    root = '/var/cache/trac/tickets/.pool'
+    pristine_store = '/var/cache/trac/tickets/.pristine'
+
+    def __init__(self, env, trac_env_name, svn):
+        self.env = env
+        self.trac_env_name = trac_env_name
+        self.svn = svn
+
+    def get_template_path(self, sem_rel_path, url_hash, revision):
+        return '%s/%s%s/%s.%s' % (self.root, self.trac_env_name,
+                                  sem_rel_path, url_hash, revision)
+
+    def clone(self, repo_url, sem_rel_path, url_hash, revision, path):
+        """ Create the working copy at path from the template of the revision
+            (a number), the template being checked out first if need be.
+            Return False if the working copy has to be checked out """
+        template = self.get_template_path(sem_rel_path, url_hash, revision)
+        sem_handle = self.get_semaphore(template)
+        sem_handle.acquire()
+        try:
+            if not os.path.isdir('%s/.svn' % template):
+                retcode, lines = self.svn.checkout('%s@%s' % (util.get_url(repo_url), revision),
+                                                   template, depth='files')
+                if retcode != 0:
+                    shutil.rmtree(template, ignore_errors=True)
+                    return False
+                self.share_pristines(template)
+            try:
+                self.copy_template(template, path)
+            except (IOError, OSError) as e:
+                syslog.syslog("Template %s could not be copied: %s" % (template, e))
+                shutil.rmtree('%s/.svn' % path, ignore_errors=True)
+                return False
+            # Last use of the template (see TicketCacheManager)
+            os.utime(template)
+        finally:
+            sem_handle.release()
+        return True
+
+    @staticmethod
+    def copy_template(template, path):
+        """ Copy the template to path, its pristines being hardlinked """
+        pristine_dir = '%s/.svn/pristine' % template
+        for dirpath, dirnames, filenames in os.walk(template):
+            target_dir = os.path.normpath(os.path.join(path, os.path.relpath(dirpath, template)))
+            os.makedirs(target_dir, exist_ok=True)
+            linked = dirpath == pristine_dir or dirpath.startswith(pristine_dir + '/')
+            for filename in filenames:
+                source = os.path.join(dirpath, filename)
+                target = os.path.join(target_dir, filename)
+                if linked:
+                    os.link(source, target)
+                else:
+                    shutil.copy2(source, target, follow_symlinks=False)
+
+    @staticmethod
+    def get_semaphore(template):
+        """ Semaphore held while the template is updated or copied """
+        return posix_ipc.Semaphore(
+            name='/%s' % template.replace('/', ':'),
+            flags=posix_ipc.O_CREAT,
+            initial_value=1)
+
+    @classmethod
+    def share_pristines(cls, path):
+        """ Replace the pristines of the working copy at path
+            by hardlinks to the common store """
+        pristine_dir = '%s/.svn/pristine' % path
+        if not os.path.isdir(pristine_dir):
+            return
+        if not os.path.isdir(cls.pristine_store):
+            os.makedirs(cls.pristine_store, exist_ok=True)
+        for dirpath, dirnames, filenames in os.walk(pristine_dir):
+            for filename in filenames:
+                if not filename.endswith('.svn-base'):
+                    continue
+                pristine = os.path.join(dirpath, filename)
+                shared = os.path.join(cls.pristine_store, filename)
+                try:
+                    if not os.path.exists(shared):
+                        os.link(pristine, shared)
+                    elif not os.path.samefile(pristine, shared):
+                        tmp = '%s.%s.tmp' % (pristine, os.getpid())
+                        os.link(shared, tmp)
+                        os.replace(tmp, pristine)
+                except OSError as e:
+                    syslog.syslog("Pristine %s could not be shared: %s" % (pristine, e))
+
+
+class TicketCacheManager(Component):
+    """ Keeps the ticket working copies of the environment under a disk budget
+
+    Ticket caches (/var/cache/trac/tickets/<env>/<user>/<type>/<ci>/t<id>)
+    and pool templates are evicted least recently used first, except:
+    -> working copies holding svn locks
+    -> working copies of tickets in edition (01-assigned_for_edition)
+    -> working copies in use (their semaphore cannot be acquired)
+    Options ([artusplugin] section):
+        tickets_cache_max_size: disk budget, eg 20G (default), 500M
+        tickets_cache_gc_interval: seconds between background runs (3600),
+                                   0 disables background runs
+        ticket_cache_lock_stats_interval: seconds between the logs of the
+                                          working copy lock stats of each
+                                          process (3600), 0 disables them
+    """
+
+    implements(IAdminCommandProvider, IRequestFilter)
+
+    root = '/var/cache/trac/tickets'
+    _last_run = 0
+    _run_lock = threading.Lock()
+
+    def __init__(self):
+        self.trac_env_name = util.get_program_data(self.env)['trac_env_name']
+
+    # IAdminCommandProvider
+
+    def get_admin_commands(self):
+        yield ('artus cache gc', '[dry-run]',
+               'Evict least recently used ticket working copies '
+               'until the disk budget is met',
+               None, self._do_gc)
+        yield ('artus cache blobs', '[prune]',
+               'Show the repository contents cache statistics, '
+               'evicting least recently used contents beyond the budget if asked',
+               None, self._do_blobs)
+        yield ('artus cache validity', '[reset]',
+               'Show the kept checks of the signing certificate chain validity, '
+               'clearing them if asked (eg after a certificate renewal)',
+               None, self._do_validity)
+        yield ('artus cache directory', '[refresh|clear]',
+               'Show the age of the users directory cache, '
+               'looking all its users up again or clearing it if asked',
+               None, self._do_directory)
+
+    def _do_gc(self, dry_run=None):
+        evicted, reclaimed, total = self.collect(dry_run == 'dry-run')
+        printout('%s working copies %s, %s reclaimed (cache size: %s)' % (
+            evicted, 'to be evicted' if dry_run == 'dry-run' else 'evicted',
+            pretty_size(reclaimed), pretty_size(total - reclaimed)))
+
+    def _do_blobs(self, prune=None):
+        blob_cache = util.BlobCache(self.env)
+        if prune == 'prune':
+            evicted, reclaimed = blob_cache.prune()
+            printout('%s contents evicted, %s reclaimed' % (evicted, pretty_size(reclaimed)))
+        stats = blob_cache.get_stats()
+        lookups = stats['hits'] + stats['misses']
+        printout('%s contents (%s), %s hits, %s misses (hit ratio: %s%%)' % (
+            stats['blobs'], pretty_size(stats['size']), stats['hits'], stats['misses'],
+            stats['hits'] * 100 // lookups if lookups else 0))
+
+    def _do_validity(self, reset=None):
+        if reset == 'reset':
+            printout('%s certificate validity checks cleared' % pdfservice.CertificateValidity.reset())
+        else:
+            for key, entry in sorted(pdfservice.CertificateValidity.get_checks().items()):
+                printout('%s: valid until %s' % (key, time.strftime(
+                    '%Y-%m-%d %H:%M:%S', time.localtime(entry['expires']))))
+
+    def _do_directory(self, action=None):
+        directory_cache = util.DirectoryCache(self.env)
+        if action == 'clear':
+            printout('%s users cleared' % directory_cache.clear())
+            return
+        if action == 'refresh':
+            entries = directory_cache.refresh([user for user, entry in directory_cache.get_entries()])
+            printout('%s users looked up, %s found' % (
+                len(entries), len([entry for entry in entries.values() if entry['found']])))
+        entries = directory_cache.get_entries()
+        now = time.time()
+        for user, entry in entries:
+            printout('%-30s %-40s %-10s %s' % (
+                user, entry['mail'] or '', 'found' if entry['found'] else 'not found',
+                'age %s' % pretty_timedelta(entry['time'])
+                if entry['time'] else 'expired'))
+        printout('%s users, %s expired' % (
+            len(entries), len([entry for user, entry in entries if not directory_cache.is_fresh(entry, now)])))
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        stats_interval = self.env.config.getint('artusplugin', 'ticket_cache_lock_stats_interval', 3600)
+        if stats_interval:
+            WorkingCopyLock.log_stats(stats_interval)
+        interval = self.env.config.getint('artusplugin', 'tickets_cache_gc_interval', 3600)
+        if interval and time.time() - TicketCacheManager._last_run > interval:
+            with TicketCacheManager._run_lock:
+                if time.time() - TicketCacheManager._last_run > interval:
+                    TicketCacheManager._last_run = time.time()
+                    thread = threading.Thread(target=self._background_collect)
+                    thread.daemon = True
+                    thread.start()
+        return handler
+
+    def post_process_request(self, req, template, data, metadata):
+        return template, data, metadata
+
+    def _background_collect(self):
+        # Only one process runs the garbage collection at a time
+        sem_handle = posix_ipc.Semaphore(
+            name='/tickets_cache_gc:%s' % self.trac_env_name,
+            flags=posix_ipc.O_CREAT,
+            initial_value=1)
+        try:
+            sem_handle.acquire(0)
+        except posix_ipc.BusyError:
+            return
+        try:
+            evicted, reclaimed, total = self.collect()
+            syslog.syslog("Ticket cache of %s: %s working copies evicted, "
+                          "%s bytes reclaimed (cache size: %s bytes)" % (
+                              self.trac_env_name, evicted, reclaimed, total - reclaimed))
+        except Exception as e:
+            syslog.syslog("Ticket cache garbage collection failed: %s" % e)
+        finally:
+            sem_handle.release()
+
+    def get_budget(self):
+        return util.parse_size(self.env.config.get('artusplugin', 'tickets_cache_max_size', '20G'))
+
+    def collect(self, dry_run=False):
+        """ Evict caches until the budget is met
+            Return (evicted caches, reclaimed bytes, initial cache size) """
+        budget = self.get_budget()
+        entries = self.get_entries()
+        total = sum(entry['size'] for entry in entries)
+        evicted = 0
+        reclaimed = 0
+        for entry in sorted(entries, key=lambda entry: entry['atime']):
+            if total - reclaimed <= budget:
+                break
+            if entry['protected']:
+                continue
+            if dry_run or self.evict(entry['path']):
+                evicted += 1
+                reclaimed += entry['size']
+        if not dry_run:
+            reclaimed += self.prune_pristine_store()
+        return evicted, reclaimed, total
+
+    def get_entries(self):
+        """ Ticket caches and pool templates of the environment """
+        entries = []
+        seen_inodes = set()
+        env_root = '%s/%s' % (self.root, self.trac_env_name)
+        # <user>/<type>/<ci>/t<id>
+        for path in self._subdirs(env_root, 4):
+            match = re.search(r'/t(\d+)$', path)
+            if match:
+                size, atime = self._usage(path, seen_inodes)
+                entries.append({'path': path,
+                                'size': size,
+                                'atime': atime,
+                                'protected': self.is_protected(path, int(match.group(1)))})
+        # pool templates
+        pool_root = '%s/%s' % (WorkingCopyPool.root, self.trac_env_name)
+        for dirpath, dirnames, filenames in os.walk(pool_root):
+            if '.svn' in dirnames:
+                size, atime = self._usage(dirpath, seen_inodes)
+                entries.append({'path': dirpath,
+                                'size': size,
+                                'atime': atime,
+                                'protected': self.is_busy('/%s' % dirpath.replace('/', ':'))})
+                dirnames[:] = []
+        return entries
+
+    @staticmethod
+    def _subdirs(path, depth):
+        if depth == 0:
+            yield path
+        elif os.path.isdir(path):
+            for name in os.listdir(path):
+                if not name.startswith('.'):
+                    for subdir in TicketCacheManager._subdirs(os.path.join(path, name), depth - 1):
+                        yield subdir
+
+    @staticmethod
+    def _usage(path, seen_inodes):
+        """ Disk usage (shared pristines counted once) and last access """
+        size = 0
+        atime = os.stat(path).st_mtime
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    st = os.lstat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                atime = max(atime, st.st_atime, st.st_mtime)
+                if st.st_nlink > 1:
+                    if (st.st_dev, st.st_ino) in seen_inodes:
+                        continue
+                    seen_inodes.add((st.st_dev, st.st_ino))
+                size += st.st_size
+        return size, atime
+
+    def is_protected(self, path, ticket_id):
+        try:
+            if Ticket(self.env, ticket_id)['status'] == '01-assigned_for_edition':
+                return True
+        except ResourceNotFound:
+            pass
+        for dirpath, dirnames, filenames in os.walk(path):
+            if '.svn' in dirnames:
+                dirnames.remove('.svn')
+                if self.has_locks(dirpath) or self.is_in_use(dirpath):
+                    return True
+        return False
+
+    @staticmethod
+    def has_locks(wc_path):
+        """ Test if the working copy holds svn locks """
+        try:
+            db = sqlite3.connect('file:%s/.svn/wc.db?mode=ro' % wc_path, uri=True)
+            try:
+                return db.execute("SELECT COUNT(*) FROM lock").fetchone()[0] > 0
+            finally:
+                db.close()
+        except sqlite3.Error:
+            # Unknown state: the working copy is kept
+            return True
+
+    @staticmethod
+    def get_sem_name(wc_path):
+        """ Name of the working copy semaphore (see Ticket_Cache) """
+        match = re.match(r'(.+/t\d+(?:/\w+)?/(?:trunk|tags|branches)(?:/B\d+)?)(?:/.+)', wc_path)
+        if not match:
+            return None
+        return '/%s' % match.group(1).replace('/', ':')
+
+    def is_in_use(self, wc_path):
+        """ Test if the working copy semaphore is held (see Ticket_Cache) """
+        sem_name = self.get_sem_name(wc_path)
+        if not sem_name:
+            return False
+        return self.is_busy(sem_name) or self.is_busy('%s:room' % sem_name,
+                                                      WorkingCopyLock.max_readers)
+
+    @staticmethod
+    def is_busy(sem_name, initial_value=1):
+        try:
+            sem_handle = posix_ipc.Semaphore(name=sem_name)
+        except posix_ipc.ExistentialError:
+            return False
+        if initial_value > 1:
+            return sem_handle.value < initial_value
+        try:
+            sem_handle.acquire(0)
+        except posix_ipc.BusyError:
+            return True
+        sem_handle.release()
+        return False
+
+    def evict(self, path):
+        """ Remove the ticket cache or pool template at path
+            The working copies are locked while being removed: they are
+            skipped if in use or holding svn locks meanwhile """
+        wc_paths = []
+        held = []
+        try:
+            if path.startswith(WorkingCopyPool.root + '/'):
+                wc_paths.append(path)
+                sem_handle = WorkingCopyPool.get_semaphore(path)
+                try:
+                    sem_handle.acquire(0)
+                except posix_ipc.BusyError:
+                    return False
+                held.append(sem_handle)
+            else:
+                sem_names = set()
+                for dirpath, dirnames, filenames in os.walk(path):
+                    if '.svn' in dirnames:
+                        dirnames.remove('.svn')
+                        wc_paths.append(dirpath)
+                        sem_name = self.get_sem_name(dirpath)
+                        if sem_name:
+                            sem_names.add(sem_name)
+                for sem_name in sorted(sem_names):
+                    wc_lock = WorkingCopyLock(sem_name)
+                    if not wc_lock.try_acquire():
+                        return False
+                    held.append(wc_lock)
+            # svn locks taken since the entries were listed
+            if any(self.has_locks(wc_path) for wc_path in wc_paths):
+                return False
+            try:
+                shutil.rmtree(path)
+            except OSError as e:
+                syslog.syslog("Ticket cache %s could not be evicted: %s" % (path, e))
+                return False
+            return True
+        finally:
+            for lock in held:
+                lock.release()
+
+    @staticmethod
+    def prune_pristine_store():
+        """ Remove the shared pristines no working copy links to any more """
+        reclaimed = 0
+        if os.path.isdir(WorkingCopyPool.pristine_store):
+            for entry in os.scandir(WorkingCopyPool.pristine_store):
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_nlink == 1:
+                        os.remove(entry.path)
+                        reclaimed += st.st_size
+                except OSError:
+                    pass
+        return reclaimed
+
+
 class ECM_Cache(Ticket_Cache):
 
-    def __init__(self, env, trac_env_name, authname, ticket):
-        super(ECM_Cache, self).__init__(env, trac_env_name, authname, ticket)
+    def __init__(self, env, trac_env_name, authname, ticket, mode='exclusive'):
+        super(ECM_Cache, self).__init__(env, trac_env_name, authname, ticket, mode)
         self.template = None
         template_fn = self.env.config.get('artusplugin', 'ECM_template')
         if template_fn:
@@ -784,27 +1408,17 @@ class ECM_Cache(Ticket_Cache):
         app_properties_path = "/srv/trac/common/TracPdfFill.properties"
 
         # Fill in form fields
-        unix_cmd_list = ['sudo /usr/bin/java '
-                         '-jar /srv/trac/common/TracPdfFill.jar'
-                         ' -P "%s"'
-                         ' -a "%s"'
-                         ' -t "%s" "%s" "%s"'
-                         ' -s "%s"'
-                         ' -d "%s"' % (
-                             app_properties_path,
-                             "FillFields",
-                             self.distribution['From'],
-                             self.distribution['To'],
-                             self.distribution['Copy'],
-                             src,
-                             dest)]
-
-        # Copy modified PDF to the working copy (if not empty)
-        unix_cmd_list += ['if [[ -s "%s" ]] ; then cp -f "%s" "%s"; fi'
-                          % (dest, dest, src)]
-
-        retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list,
-                                             util.lineno())
+        # and copy modified PDF to the working copy (if not empty)
+        retcode, lines = pdfservice.run_jobs(self.env, [pdfservice.PdfJob(
+            pdfservice.FILL_JAR,
+            ['-P', app_properties_path,
+             '-a', 'FillFields',
+             '-t', self.distribution['From'],
+             self.distribution['To'],
+             self.distribution['Copy'],
+             '-s', src,
+             '-d', dest],
+            (dest, src))])
         if retcode != 0:
             raise TracError('\n'.join(lines))
 
@@ -848,10 +1462,8 @@ class ECM_Cache(Ticket_Cache):
 
     def create_wc(self):
         # Create repository url if it does not exist yet
-        unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'mkdir -m "%s" --parents "%s" &> /dev/null' % (
-            _('ticket:%(id)s (on behalf of %(user)s)', id=str(self.id), user=self.authname),
-            util.get_url(self.repo_url))}]
-        util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
+        self.svn.mkdir(util.get_url(self.repo_url),
+                       _('ticket:%(id)s (on behalf of %(user)s)', id=str(self.id), user=self.authname))
         # Create working copy
         super(ECM_Cache, self).create_wc()
 
@@ -954,33 +1566,23 @@ class ECM_Cache(Ticket_Cache):
                 f.write("fieldrectangle%s=%s\n" % (i, urYValue.text))
 
         # Create form fields in the PDF
-        unix_cmd_list = ['sudo /usr/bin/java '
-                         '-jar /srv/trac/common/TracPdfFill.jar'
-                         ' -P "%s"'
-                         ' -p "%s"'
-                         ' -a "%s"'
-                         ' -s "%s"'
-                         ' -d "%s"' % (
-                             app_properties_path,
-                             tmpl_properties_path,
-                             "CreateFields",
-                             src,
-                             dest)]
-
-        # Copy modified PDF to the working copy (if not empty)
-        unix_cmd_list += ['if [[ -s "%s" ]] ; then cp -f "%s" "%s"; fi'
-                          % (dest, dest, src)]
-
-        retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list,
-                                             util.lineno())
+        # and copy modified PDF to the working copy (if not empty)
+        retcode, lines = pdfservice.run_jobs(self.env, [pdfservice.PdfJob(
+            pdfservice.FILL_JAR,
+            ['-P', app_properties_path,
+             '-p', tmpl_properties_path,
+             '-a', 'CreateFields',
+             '-s', src,
+             '-d', dest],
+            (dest, src))])
         if retcode != 0:
             raise TracError('\n'.join(lines))
 
 
 class FEE_Cache(Ticket_Cache):
 
-    def __init__(self, env, trac_env_name, authname, ticket):
-        super(FEE_Cache, self).__init__(env, trac_env_name, authname, ticket)
+    def __init__(self, env, trac_env_name, authname, ticket, mode='exclusive'):
+        super(FEE_Cache, self).__init__(env, trac_env_name, authname, ticket, mode)
         self.template = None
         template_fn = self.env.config.get('artusplugin', 'FEE_template')
         if template_fn:
@@ -1029,27 +1631,17 @@ class FEE_Cache(Ticket_Cache):
         app_properties_path = "/srv/trac/common/TracPdfFill.properties"
 
         # Fill in form fields
-        unix_cmd_list = ['sudo /usr/bin/java '
-                         '-jar /srv/trac/common/TracPdfFill.jar'
-                         ' -P "%s"'
-                         ' -a "%s"'
-                         ' -t "%s" "%s" "%s"'
-                         ' -s "%s"'
-                         ' -d "%s"' % (
-                             app_properties_path,
-                             "FillFields",
-                             self.distribution['From'],
-                             self.distribution['To'],
-                             self.distribution['Copy'],
-                             src,
-                             dest)]
-
-        # Copy modified PDF to the working copy (if not empty)
-        unix_cmd_list += ['if [[ -s "%s" ]] ; then cp -f "%s" "%s"; fi'
-                          % (dest, dest, src)]
-
-        retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list,
-                                             util.lineno())
+        # and copy modified PDF to the working copy (if not empty)
+        retcode, lines = pdfservice.run_jobs(self.env, [pdfservice.PdfJob(
+            pdfservice.FILL_JAR,
+            ['-P', app_properties_path,
+             '-a', 'FillFields',
+             '-t', self.distribution['From'],
+             self.distribution['To'],
+             self.distribution['Copy'],
+             '-s', src,
+             '-d', dest],
+            (dest, src))])
         if retcode != 0:
             raise TracError('\n'.join(lines))
 
@@ -1093,10 +1685,8 @@ class FEE_Cache(Ticket_Cache):
 
     def create_wc(self):
         # Create repository url if it does not exist yet
-        unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'mkdir -m "%s" --parents "%s" &> /dev/null' % (
-            _('ticket:%(id)s (on behalf of %(user)s)', id=str(self.id), user=self.authname),
-            util.get_url(self.repo_url))}]
-        util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
+        self.svn.mkdir(util.get_url(self.repo_url),
+                       _('ticket:%(id)s (on behalf of %(user)s)', id=str(self.id), user=self.authname))
         # Create working copy
         super(FEE_Cache, self).create_wc()
 
@@ -1214,25 +1804,15 @@ class FEE_Cache(Ticket_Cache):
                 f.write("fieldrectangle%s=%s\n" % (i, urYValue.text))
 
         # Create form fields in the PDF
-        unix_cmd_list = ['sudo /usr/bin/java '
-                         '-jar /srv/trac/common/TracPdfFill.jar'
-                         ' -P "%s"'
-                         ' -p "%s"'
-                         ' -a "%s"'
-                         ' -s "%s"'
-                         ' -d "%s"' % (
-                             app_properties_path,
-                             tmpl_properties_path,
-                             "CreateFields",
-                             src,
-                             dest)]
-
-        # Copy modified PDF to the working copy (if not empty)
-        unix_cmd_list += ['if [[ -s "%s" ]] ; then cp -f "%s" "%s"; fi'
-                          % (dest, dest, src)]
-
-        retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list,
-                                             util.lineno())
+        # and copy modified PDF to the working copy (if not empty)
+        retcode, lines = pdfservice.run_jobs(self.env, [pdfservice.PdfJob(
+            pdfservice.FILL_JAR,
+            ['-P', app_properties_path,
+             '-p', tmpl_properties_path,
+             '-a', 'CreateFields',
+             '-s', src,
+             '-d', dest],
+            (dest, src))])
         if retcode != 0:
             raise TracError('\n'.join(lines))
 
@@ -1240,8 +1820,8 @@ class FEE_Cache(Ticket_Cache):
 
 class DOC_Cache(Ticket_Cache):
 
-    def __init__(self, env, trac_env_name, authname, ticket):
-        super(DOC_Cache, self).__init__(env, trac_env_name, authname, ticket)
+    def __init__(self, env, trac_env_name, authname, ticket, mode='exclusive'):
+        super(DOC_Cache, self).__init__(env, trac_env_name, authname, ticket, mode)
         tagged_item = ticket['summary'].strip('DOC_')
         indexes = [tg.status_index for tg in model.Tag.select(
             self.env,
@@ -1485,10 +2065,332 @@ class SourceData(object):
         return xml_string
 
 
+class SplitZipWriter(object):
+    """ Writes entries into zip volumes <base_path>.N.zip of at most max_size bytes
+
+    The split is sequential (as zipsplit -s): an entry which does not fit
+    into the current volume starts the next one. The index of the volumes
+    (<base_path>.idx) gives the volume number of each entry, as zipsplit -i.
+    A single volume is named <base_path>.zip.
+    """
+
+    # Central directory header (without name and extra) and end of central directory record
+    central_header_size = 46
+    end_record_size = 22
+
+    def __init__(self, base_path, max_size):
+        self.base_path = base_path
+        self.max_size = max_size
+        self.volumes = []
+        self.index = []
+        self.zip = None
+        self.date_time = time.localtime()[:6]
+        self.closed_bytes = 0
+
+    @property
+    def bytes_written(self):
+        return self.closed_bytes + (self.zip.start_dir if self.zip is not None else 0)
+
+    def add(self, arcname, opener=None, size=0):
+        """ Add a file whose content is read from opener() or,
+            if opener is None, a directory """
+        if self.zip is None:
+            self._open_volume()
+        while True:
+            offset = self.zip.start_dir
+            self._write(arcname, opener, size)
+            if self._volume_size() <= self.max_size:
+                break
+            if len(self.zip.filelist) == 1:
+                raise IOError('Entry too big to split: %s' % arcname)
+            # The entry is moved to the next volume
+            self._rollback(offset)
+            self._open_volume()
+        self.index.append((len(self.volumes), self.zip.filelist[-1].filename))
+
+    def close(self):
+        """ Close the volumes and write the index
+            Return the number of volumes """
+        if self.zip is not None:
+            self.zip.close()
+            self.closed_bytes += os.path.getsize(self.volumes[-1])
+            self.zip = None
+        with open('%s.idx' % self.base_path, 'w') as f:
+            for no, arcname in self.index:
+                f.write('%d %s\n' % (no, arcname))
+        if len(self.volumes) == 1:
+            os.rename(self.volumes[0], '%s.zip' % self.base_path)
+        return len(self.volumes)
+
+    def _open_volume(self):
+        if self.zip is not None:
+            self.zip.close()
+            self.closed_bytes += os.path.getsize(self.volumes[-1])
+        path = '%s.%d.zip' % (self.base_path, len(self.volumes) + 1)
+        self.volumes.append(path)
+        self.zip = ZipFile(path, 'w', ZIP_DEFLATED)
+
+    def _volume_size(self):
+        return (self.zip.start_dir +
+                sum(self.central_header_size + len(info.filename.encode('utf-8')) + len(info.extra)
+                    for info in self.zip.filelist) +
+                self.end_record_size)
+
+    def _write(self, arcname, opener, size):
+        if opener is None:
+            info = ZipInfo('%s/' % arcname.rstrip('/'), self.date_time)
+            info.external_attr = (0o40775 << 16) | 0x10
+            self.zip.writestr(info, b'')
+        else:
+            info = ZipInfo(arcname, self.date_time)
+            info.compress_type = ZIP_DEFLATED
+            info.external_attr = 0o664 << 16
+            source = opener()
+            try:
+                with self.zip.open(info, 'w', force_zip64=size > ZIP64_LIMIT) as target:
+                    shutil.copyfileobj(source, target, 1 << 20)
+            finally:
+                if hasattr(source, 'close'):
+                    source.close()
+
+    def _rollback(self, offset):
+        info = self.zip.filelist.pop()
+        del self.zip.NameToInfo[info.filename]
+        self.zip.fp.seek(offset)
+        self.zip.fp.truncate()
+        self.zip.start_dir = offset
+
+
+class DocumentFolderScan(object):
+    """ Files of a document folder with their effective revision
+
+    The effective revision of a file is the revision of its last change
+    which is not a copy (tagging). The effective revisions of the files of
+    a folder are read from a single walk of the folder history (at most
+    max_walk changesets), the history of a file being walked only if it
+    was not changed within those, eg when copied alone into the folder.
+    Folder scans are keyed by (repository, path, last changed revision)
+    and effective revisions by (repository, path, revision of the file),
+    which never change: both are kept for the process in bounded LRUs.
+    """
+
+    max_folders = 2000
+    max_files = 50000
+    max_walk = 200
+    _folders = OrderedDict()
+    _files = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, files):
+        self.files = files
+
+    @classmethod
+    def _lookup(cls, entries, key):
+        with cls._lock:
+            if key in entries:
+                entries.move_to_end(key)
+                return entries[key]
+        return None
+
+    @classmethod
+    def _store(cls, entries, key, value, max_entries):
+        with cls._lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > max_entries:
+                entries.popitem(last=False)
+
+    @classmethod
+    def get(cls, node):
+        key = (node.repos.reponame, node.path, node.created_rev)
+        scan = cls._lookup(cls._folders, key)
+        if scan is None:
+            files = [entry for entry in node.get_entries() if entry.isfile]
+            real_revs = cls.get_real_revs(node, files)
+            scan = cls([(entry.name, real_revs[entry.name]) for entry in files])
+            cls._store(cls._folders, key, scan, cls.max_folders)
+        return scan
+
+    @staticmethod
+    def _file_key(node):
+        return (node.repos.reponame, node.path, node.created_rev)
+
+    @classmethod
+    def get_real_revs(cls, node, files):
+        """ {name: effective revision} of the given files of the folder node """
+        real_revs = {}
+        pending = {}
+        for entry in files:
+            rev = cls._lookup(cls._files, cls._file_key(entry))
+            if rev is None:
+                pending[entry.name] = entry
+            else:
+                real_revs[entry.name] = rev
+        walked = 0
+        if pending:
+            for path, rev, chg in node.get_history():
+                if not pending or walked == cls.max_walk:
+                    break
+                walked += 1
+                if chg == Changeset.COPY:
+                    # Folder copied (tagging): its files are copied along
+                    continue
+                folder = path.strip('/')
+                for change_path, kind, change, base_path, base_rev in \
+                        node.repos.get_changeset(rev).get_changes():
+                    change_path = change_path.strip('/')
+                    name = os.path.basename(change_path)
+                    if (name in pending and os.path.dirname(change_path) == folder and
+                            kind == Node.FILE and change not in (Changeset.COPY, Changeset.DELETE)):
+                        real_revs[name] = rev
+                        cls._store(cls._files, cls._file_key(pending.pop(name)), rev, cls.max_files)
+        for name, entry in pending.items():
+            real_revs[name] = cls.get_real_rev(entry)
+        return real_revs
+
+    @classmethod
+    def get_real_rev(cls, node):
+        key = cls._file_key(node)
+        rev = cls._lookup(cls._files, key)
+        if rev is None:
+            for h in node.get_history(10):
+                if h[2] == 'copy':
+                    continue
+                rev = h[1]
+                break
+            cls._store(cls._files, key, rev, cls.max_files)
+        return rev
+
+    def get_pdf_files(self):
+        return [(name, rev) for (name, rev) in self.files
+                if name.lower().endswith('.pdf')]
+
+    def get_src_files(self, suffx):
+        return [(name, rev) for (name, rev) in self.files
+                if name.split('.')[-1] in suffx]
+
+    @staticmethod
+    def index_by_stem(files):
+        """ Files indexed by their name without extension """
+        index = {}
+        for name, rev in files:
+            index.setdefault(name.rsplit('.', 1)[0], []).append((name, rev))
+        return index
+
+
+class PackageCatalog(object):
+    """ Catalog of the packages of a PDF-packaging directory
+
+    A SQLite database (.catalog.db) in the directory gives the number of
+    archives of each package and its manifest: the archive number and the
+    path of each entry, in archive order. It is written when a package is
+    built, so that the packages and their content are read without scanning
+    the directory or parsing the text index (<package>.idx), which is
+    still written for the users and read for older packages.
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.path = '%s/.catalog.db' % base_dir
+
+    def _connect(self):
+        cnx = sqlite3.connect(self.path, timeout=30)
+        cnx.execute("CREATE TABLE IF NOT EXISTS package "
+                    "(name text PRIMARY KEY, archives integer, time integer)")
+        cnx.execute("CREATE TABLE IF NOT EXISTS entry "
+                    "(package text, seq integer, archive integer, tgname text, path text)")
+        cnx.execute("CREATE INDEX IF NOT EXISTS entry_package_idx ON entry (package, seq)")
+        return cnx
+
+    def record(self, name, archives, index):
+        """ index: (archive number, archive path) of each entry """
+        cnx = self._connect()
+        try:
+            with cnx:
+                cnx.execute("DELETE FROM entry WHERE package=?", (name,))
+                cnx.execute("INSERT OR REPLACE INTO package VALUES (?, ?, ?)",
+                            (name, archives, int(time.time())))
+                cnx.executemany("INSERT INTO entry VALUES (?, ?, ?, ?, ?)",
+                                [(name, seq, no) + tuple((arcname.split('/', 1) + [''])[:2])
+                                 for seq, (no, arcname) in enumerate(index)])
+        finally:
+            cnx.close()
+
+    def remove(self, name):
+        if not os.access(self.path, os.F_OK):
+            return
+        cnx = self._connect()
+        try:
+            with cnx:
+                cnx.execute("DELETE FROM entry WHERE package=?", (name,))
+                cnx.execute("DELETE FROM package WHERE name=?", (name,))
+        finally:
+            cnx.close()
+
+    def get_archives_paths(self, name):
+        """ Paths of the archives of the package
+            (None if the package is not in the catalog) """
+        if not os.access(self.path, os.F_OK):
+            return None
+        cnx = self._connect()
+        try:
+            row = cnx.execute("SELECT archives FROM package WHERE name=?", (name,)).fetchone()
+        finally:
+            cnx.close()
+        if row is None:
+            return None
+        if row[0] == 1:
+            paths = ['%s/%s.zip' % (self.base_dir, name)]
+        else:
+            paths = ['%s/%s.%d.zip' % (self.base_dir, name, no) for no in range(1, row[0] + 1)]
+        if paths and not os.access(paths[0], os.F_OK):
+            # Package removed from the directory
+            self.remove(name)
+            return None
+        return paths
+
+    def get_content(self, name):
+        """ Archive number -> document -> paths of the package
+            (None if the package is not in the catalog) """
+        if self.get_archives_paths(name) is None:
+            return None
+        archives_content = OrderedDict()
+        cnx = self._connect()
+        try:
+            for no, tgname, path in cnx.execute("SELECT archive, tgname, path FROM entry "
+                                                "WHERE package=? ORDER BY seq", (name,)):
+                archives_content.setdefault(str(no), OrderedDict()).setdefault(tgname, []).append(path)
+        finally:
+            cnx.close()
+        return archives_content
+
+
 class PDFPackage(object):
     """ Extracts documents from the repository and
         packages them into one or more archives """
 
+    _convert_lock = threading.Lock()
+
+    @staticmethod
+    def scan_folder(env, doc_url):
+        """ Returns the repository path of the document folder and its scan
+            (None if the folder cannot be found) """
+        repos = util.get_repository(env, doc_url)
+        match = re.search(r'(?:.+)?(/(?:trunk|tags|branches)/.+)', doc_url)
+        repo_url = util.get_url(match.group(1))
+        repo_rev = util.get_revision(doc_url)
+        # there is a race condition with post-commit hook
+        for i in range(1, 5):  # @UnusedVariable
+            try:
+                node = repos.get_node(repo_url, repo_rev)
+                break
+            except Exception:
+                time.sleep(1)
+                continue
+        else:
+            return repo_url, None
+        return repo_url, DocumentFolderScan.get(node)
+
     @staticmethod
     def get_src_files(env, doc_url, select=True, sourcefile=None):
         """
@@ -1520,36 +2422,11 @@ class PDFPackage(object):
         """
         if doc_url:
             log_level = env.config.get('logging', 'log_level')
-            repos = util.get_repository(env, doc_url)
-            match = re.search(r'(?:.+)?(/(?:trunk|tags|branches)/.+)', doc_url)
-            repo_url = util.get_url(match.group(1))
-            repo_rev = util.get_revision(doc_url)
-            # there is a race condition with post-commit hook
-            for i in range(1, 5):  # @UnusedVariable
-                try:
-                    node = repos.get_node(repo_url, repo_rev)
-                    break
-                except Exception:
-                    time.sleep(1)
-                    continue
-            else:
+            repo_url, scan = PDFPackage.scan_folder(env, doc_url)
+            if scan is None:
                 return []
-
-            def get_real_rev(node):
-                for h in node.get_history(10):
-                    if h[2] == 'copy':
-                        continue
-                    rev = h[1]
-                    break
-                return rev
-
-            files = [(entry.name, get_real_rev(entry))
-                     for entry in node.get_entries() if entry.isfile]
-            pdf_files = [(name, rev) for (name, rev) in files
-                         if name.lower().endswith('.pdf')]
-            suffx = util.get_prop_values(env, 'source_files_suffix')
-            src_files = [(name, rev) for (name, rev) in files
-                         if name.split('.')[-1] in suffx]
+            pdf_files = scan.get_pdf_files()
+            src_files = scan.get_src_files(util.get_prop_values(env, 'source_files_suffix'))
             src_selected = []
             if select:
                 if len(src_files) == 0:
@@ -1560,10 +2437,9 @@ class PDFPackage(object):
                         # Forced selection
                         src_selected.append((sourcefile, True))
                     else:
+                        pdf_index = DocumentFolderScan.index_by_stem(pdf_files)
                         for src_file in src_files:
-                            pdfs = [(name, rev) for (name, rev) in pdf_files
-                                    if name.rsplit('.', 1)[0] ==
-                                    src_file[0].rsplit('.', 1)[0]]
+                            pdfs = pdf_index.get(src_file[0].rsplit('.', 1)[0], [])
                             if (len(pdfs) == 0 or
                                 (len(pdfs) == 1 and
                                  src_file[1] <= pdfs[0][1])):
@@ -1627,46 +2503,20 @@ class PDFPackage(object):
         """
         if doc_url:
             log_level = env.config.get('logging', 'log_level')
-            repos = util.get_repository(env, doc_url)
-            match = re.search(r'(?:.+)?(/(?:trunk|tags|branches)/.+)', doc_url)
-            repo_url = util.get_url(match.group(1))
-            repo_rev = util.get_revision(doc_url)
-            # there is a race condition with post-commit hook
-            for i in range(1, 5):  # @UnusedVariable
-                try:
-                    node = repos.get_node(repo_url, repo_rev)
-                    break
-                except Exception:
-                    time.sleep(1)
-                    continue
-            else:
+            repo_url, scan = PDFPackage.scan_folder(env, doc_url)
+            if scan is None:
                 return []
-
-            def get_real_rev(node):
-                for h in node.get_history(10):
-                    if h[2] == 'copy':
-                        continue
-                    rev = h[1]
-                    break
-                return rev
-
-            files = [(entry.name, get_real_rev(entry))
-                     for entry in node.get_entries() if entry.isfile]
-            pdf_files = [(name, rev) for (name, rev) in files
-                         if name.lower().endswith('.pdf')]
-            suffx = util.get_prop_values(env, 'source_files_suffix')
-            src_files = [(name, rev) for (name, rev) in files
-                         if name.split('.')[-1] in suffx]
+            pdf_files = scan.get_pdf_files()
+            src_files = scan.get_src_files(util.get_prop_values(env, 'source_files_suffix'))
             pdf_selected = []
             if select:
                 if len(pdf_files) == 0:
                     if log_level == 'INFO':
                         syslog.syslog("INFO for doc url %s: No PDF found" % doc_url)
                 else:
+                    src_index = DocumentFolderScan.index_by_stem(src_files)
                     for pdf_file in pdf_files:
-                        sources = [(name, rev) for (name, rev) in src_files
-                                   if name.rsplit('.', 1)[0] ==
-                                   pdf_file[0].rsplit('.', 1)[0]]
+                        sources = src_index.get(pdf_file[0].rsplit('.', 1)[0], [])
                         if sourcefile and sourcefile in dict(sources):
                             if sourcerev:
                                 if pdf_file[1] >= sourcerev:
@@ -1722,15 +2572,7 @@ class PDFPackage(object):
 
     @staticmethod
     def get_archives_number(ticket):
-        program_data = util.get_program_data(ticket.env)
-        trac_env_name = program_data['trac_env_name']
-        base_dir = '/var/cache/trac/PDF-packaging/%s' % trac_env_name
-        # Creates base_dir and intermediate directories if they don't exist
-        if not os.access(base_dir, os.F_OK):
-            os.makedirs(base_dir)
-        archives_number = len([f for f in os.listdir(base_dir) if re.search(r'^%s(\.\d+)?\.zip$' % ticket['summary'], f)])
-
-        return archives_number
+        return len(PDFPackage.get_archives_paths(ticket))
 
     @staticmethod
     def get_archives_paths(ticket):
@@ -1740,8 +2582,11 @@ class PDFPackage(object):
         # Creates base_dir and intermediate directories if they don't exist
         if not os.access(base_dir, os.F_OK):
             os.makedirs(base_dir)
-        archives_names = [f for f in os.listdir(base_dir) if re.search(r'^%s(\.\d+)?\.zip$' % ticket['summary'], f)]
-        archives_paths = ['%s/%s' % (base_dir, a) for a in archives_names]
+        archives_paths = PackageCatalog(base_dir).get_archives_paths(ticket['summary'])
+        if archives_paths is None:
+            # Package not in the catalog
+            archives_names = [f for f in os.listdir(base_dir) if re.search(r'^%s(\.\d+)?\.zip$' % ticket['summary'], f)]
+            archives_paths = ['%s/%s' % (base_dir, a) for a in archives_names]
 
         return archives_paths
 
@@ -1753,6 +2598,10 @@ class PDFPackage(object):
         # Creates base_dir and intermediate directories if they don't exist
         if not os.access(base_dir, os.F_OK):
             os.makedirs(base_dir)
+        archives_content = PackageCatalog(base_dir).get_content(ticket['summary'])
+        if archives_content is not None:
+            return archives_content
+        # Package not in the catalog
         idx_path = '%s/%s.idx' % (base_dir, ticket['summary'])
         archives_content = OrderedDict()
         try:
@@ -1784,22 +2633,24 @@ class PDFPackage(object):
     def get_archives_documents_paths(archives_documents, selected_documents):
         archives_documents_paths = OrderedDict()
         for tgname in archives_documents.keys():
-            selected_fn = list(selected_documents[tgname])  # makes a copy
+            # Selected file names not found yet (counted as they may be duplicated)
+            remaining = Counter(selected_documents[tgname])
             for counter, path in enumerate(archives_documents[tgname]):
                 ext = path.split('.')[-1]
                 if ext.lower() == 'pdf':
                     fn = path.split('/')[-1]
-                    if fn in selected_fn:
+                    if remaining[fn]:
                         # Not renamed
                         archives_documents_paths.setdefault(tgname, []).append(path)
-                        selected_fn.remove(fn)
+                        remaining[fn] -= 1
                     else:
                         # renamed
                         index = counter
                 else:
                     archives_documents_paths.setdefault(tgname, []).append(path)
-            if selected_fn:
-                archives_documents_paths.setdefault(tgname, []).insert(index, selected_fn[0])
+            if +remaining:
+                first_fn = next(fn for fn in selected_documents[tgname] if remaining[fn])
+                archives_documents_paths.setdefault(tgname, []).insert(index, first_fn)
 
         return archives_documents_paths
 
@@ -1830,7 +2681,20 @@ class PDFPackage(object):
         for pdf in self.pdf_list:
             self.pdf_tag_files.append(pdf.split('/'))
 
-    def build(self):
+    def build(self, progress=None, resume=False):
+        """ Build the archives
+            progress(phase, done, total, bytes_written) is called as the build
+            goes on, returning False cancels the build.
+            If resume, the documents already staged by a previous build of the
+            package are kept. """
+        self.blob_cache = util.BlobCache(self.env)
+        try:
+            self._build(progress, resume)
+        finally:
+            # Hits and misses of the build
+            self.blob_cache.flush()
+
+    def _build(self, progress, resume):
         # Creates base_dir and intermediate directories if they don't exist
         if not os.access(self.base_dir, os.F_OK):
             os.makedirs(self.base_dir)
@@ -1842,141 +2706,220 @@ class PDFPackage(object):
             self.flags += os.O_BINARY
         self.build_result = 'success'
         self.build_message = ''
-        self.archive_name = 'archive.zip'
-        self.archive_path = '%s/%s' % (self.base_path, self.archive_name)
         self.zip_dirpath = "%s/zip_content" % self.base_path
-        self.zipsplits = []
         self.ticket_types = [t.name for t in Type.select(self.env)]
         self.pdf_selected = {}
 
         # Cleaning
+        catalog = PackageCatalog(self.base_dir)
+        catalog.remove(self.package_name)
         for f in os.listdir(self.base_dir):
             if re.search('%s.*?\.(zip|idx)' % self.package_name, f):
                 os.remove(os.path.join(self.base_dir, f))
-        if os.access(self.base_path, os.F_OK):
-            shutil.rmtree(self.base_path)
-        os.mkdir(self.base_path)
-        os.mkdir(self.zip_dirpath)
+        self.staged_path = '%s/.staged' % self.base_path
+        self.staged = set()
+        self.staged_lock = threading.Lock()
+        if resume and os.access(self.zip_dirpath, os.F_OK):
+            if os.access(self.staged_path, os.F_OK):
+                with open(self.staged_path) as f:
+                    self.staged = set(line.rstrip('\n') for line in f)
+        else:
+            if os.access(self.base_path, os.F_OK):
+                shutil.rmtree(self.base_path)
+            os.mkdir(self.base_path)
+            os.mkdir(self.zip_dirpath)
 
         # Setup of zip content
-        for pdf_tag_file in self.pdf_tag_files:
-            if pdf_tag_file[0] not in self.pdf_selected:
-                tg = model.Tag(self.env, name=pdf_tag_file[0])
-                pdf_data = PDFPackage.get_pdf_files(self.env, tg.tag_url)
-                tkid = util.get_doc_tktid(
-                    self.env, tg.tagged_item)
-                if tkid:
-                    ticket = Ticket(self.env, tkid)
-                    pdffile = ticket['pdffile']
-                    if pdffile and pdffile != 'N/A':
-                        for counter, item in enumerate(pdf_data):
-                            if item[0] == pdffile:
-                                pdf_data[counter] = (pdffile, True)
-                                break
-                self.pdf_selected[tg.name] = dict(pdf_data)
-            # Rename IF main PDF file
-            if self.pdf_rename and self.pdf_selected[tg.name][pdf_tag_file[1]]:
-                targetfilename = "%s.pdf" % pdf_tag_file[0]
-                # For external documents
-                targetfilename = targetfilename.replace(
-                    "%s_EXT_" % self.program_name, "", 1)
-            else:
-                targetfilename = pdf_tag_file[1]
-            doc_dirpath = "%s/%s" % (self.zip_dirpath, tg.name)
-            if not os.access(doc_dirpath, os.F_OK):
-                os.mkdir(doc_dirpath)
-            repos = util.get_repository(self.env, tg.tag_url)
+        # The tags and documents are resolved concurrently, then the repository
+        # files are fetched ahead of the archives writing, which keeps the sorted order.
+        # Only the files to be processed (P(RF)/CHKLST attachments, source files)
+        # are staged on disk
+        workers = max(1, self.env.config.getint('artusplugin', 'pdf_packaging_workers', 4))
+        entries = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
             try:
-                if repos.reponame:
-                    node_url = tg.tag_url[len(repos.reponame) + 1:]
-                else:
-                    node_url = tg.tag_url
-                node = repos.get_node('%s/%s' % (util.get_url(node_url),
-                                                 pdf_tag_file[1]),
-                                      util.get_revision(node_url))
-                doc_filepath = '%s/%s' % (doc_dirpath, targetfilename)
-                targetfile = os.fdopen(os.open(doc_filepath, self.flags, 666), 'w')
-                shutil.copyfileobj(node.get_content(), targetfile)
-                targetfile.close()
-                # Add associated (P)RF/CHKLST IF main PDF file
-                if self.prf_chklst and self.pdf_selected[tg.name][pdf_tag_file[1]]:
-                    self._attach_prf_chklst(tg, self.base_path, doc_dirpath, targetfilename)
-                # Add associated source files IF main PDF file
-                if self.source_files and self.pdf_selected[tg.name][pdf_tag_file[1]]:
-                    retcode, lines = self._export_source_files(tg, doc_dirpath)
-                    if retcode != 0:
+                tag_names = list(OrderedDict.fromkeys(pdf_tag_file[0] for pdf_tag_file in self.pdf_tag_files))
+                tags = {}
+                for tag_name, (tg, pdf_data) in zip(tag_names,
+                                                    executor.map(self._get_tag_data, tag_names)):
+                    tags[tag_name] = tg
+                    self.pdf_selected[tag_name] = dict(pdf_data)
+                futures = [executor.submit(self._setup_document, tags[pdf_tag_file[0]], pdf_tag_file)
+                           for pdf_tag_file in self.pdf_tag_files]
+                for done, future in enumerate(futures, 1):
+                    arcname, entry, message = future.result()
+                    if progress and not progress('preparing', done, len(futures)):
+                        for future in futures:
+                            future.cancel()
+                        self.build_result = 'cancelled'
+                        return
+                    if message:
                         self.build_result = 'failure'
-                        self.build_message = ' '.join(lines)
+                        self.build_message = message
                         return
-            except NoSuchNode:
-                pass  # ignore broken repositories used for testing
+                    if arcname:
+                        if arcname in entries:
+                            raise IOError('File exists: %s' % arcname)
+                        if entry:
+                            entries[arcname] = entry
             except Exception:
-                exc_info = sys.exc_info()
-                exc_obj = exc_info[1]
-                exc_tb = exc_info[2]
-                fname = exc_tb.tb_frame.f_code.co_filename
-                self.build_result = 'failure'
-                self.build_message = '%s:%s %s' % (fname, exc_tb.tb_lineno, exc_obj)
+                self._set_failure(sys.exc_info())
                 return
 
-        # An archive is made
-        cmd = 'cd "%s";find . | sort | /usr/bin/zip "%s" -@' % (self.zip_dirpath, self.archive_path)
-        unix_cmd_list = [cmd]
-        retcode, lines = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
-        if retcode != 0:
-            self.build_result = 'failure'
-            self.build_message = ' '.join(lines)
-            return
+            # Staged files and directories
+            for dirpath, dirnames, filenames in os.walk(self.zip_dirpath):
+                for dirname in dirnames:
+                    entries[os.path.relpath(os.path.join(dirpath, dirname), self.zip_dirpath)] = (
+                        'dir', None, 0)
+                for filename in filenames:
+                    filepath = os.path.join(dirpath, filename)
+                    entries[os.path.relpath(filepath, self.zip_dirpath)] = (
+                        'file', filepath, os.path.getsize(filepath))
+
+            self.how_many = None
+            if not entries:
+                self.build_result = 'failure'
+                self.build_message = 'Could not find built archive'
+                return
 
-        self.how_many = None
-        if os.access(self.archive_path, os.F_OK):
             if self.max_size == 'No split':
-                max_size = '2000000000'
+                max_size = 2000000000
             else:
-                max_size = '%s000000' % self.max_size[:-1]
+                max_size = int(self.max_size[:-1]) * 1000000
 
-            # Split archive
-            cmd = '/usr/bin/zipsplit -i -s -n %s -b "%s" "%s"' % (
-                max_size, self.base_path, self.archive_path)
-            retcode, lines = util.unix_cmd_apply(self.env, [cmd], util.lineno())
+            # The archives are written, entries being sorted as 'find | sort' would do
+            # (under the locale of the commands, as './<arcname>')
+            arcnames = [name[2:] for name in util.collate_sort(['./%s' % arcname for arcname in entries])]
+            fetched = {}
 
-            if retcode != 0:
+            def fetch_ahead(index):
+                for arcname in arcnames[index:index + 2 * workers]:
+                    kind, source, size = entries[arcname]
+                    if kind == 'node' and arcname not in fetched:
+                        fetched[arcname] = executor.submit(self._fetch_node, source)
+
+            writer = SplitZipWriter('%s/%s' % (self.base_dir, self.package_name), max_size)
+            try:
+                for index, arcname in enumerate(arcnames):
+                    if progress and not progress('writing', index, len(arcnames), writer.bytes_written):
+                        for future in fetched.values():
+                            future.cancel()
+                        writer.close()
+                        self.build_result = 'cancelled'
+                        return
+                    fetch_ahead(index)
+                    kind, source, size = entries[arcname]
+                    if kind == 'dir':
+                        writer.add(arcname)
+                    elif kind == 'file':
+                        writer.add(arcname, lambda filepath=source: open(filepath, 'rb'), size)
+                    else:
+                        blob_path = fetched.pop(arcname).result()
+                        writer.add(arcname, lambda blob_path=blob_path: open(blob_path, 'rb'), size)
+                self.how_many = writer.close()
+                catalog.record(self.package_name, self.how_many, writer.index)
+                if progress:
+                    progress('writing', len(arcnames), len(arcnames), writer.bytes_written)
+            except Exception as e:
+                for future in fetched.values():
+                    future.cancel()
                 self.build_result = 'failure'
-                self.build_message = ' '.join(lines)
+                self.build_message = '%s' % e
                 return
-            else:
-                # Each splitted archive is made available
-                # Naming rule of each split is not well documented
-                # It seems it is limited to 8 characters + '.zip'
-                # So splits are NOT determined through a template
-                for f in os.listdir(self.base_path):
-                    if os.path.splitext(f)[1] == '.zip' and f != self.archive_name:
-                        self.zipsplits.append(f)
-                self.how_many = len(self.zipsplits)
 
-                for idx in range(1, self.how_many + 1):
-                    original_path = '%s/%s' % (self.base_path, self.zipsplits[idx - 1])
-                    final_path = '%s/%s.%d.zip' % (
-                        self.base_dir, self.package_name, idx)
-                    if os.access(original_path, os.F_OK):
-                        os.rename(original_path, final_path)
-                if self.how_many == 1:
-                    original_path = final_path
-                    final_path = '%s/%s.zip' % (
-                        self.base_dir, self.package_name)
-                    if os.access(original_path, os.F_OK):
-                        os.rename(original_path, final_path)
-
-                # The index file is made available
-                original_path = '%s/zipsplit.idx' % self.base_path
-                final_path = '%s/%s.idx' % (
-                    self.base_dir, self.package_name)
-                if os.access(original_path, os.F_OK):
-                    os.rename(original_path, final_path)
+        try:
+            self.blob_cache.prune()
+        except Exception as e:
+            syslog.syslog("Blob cache of %s not pruned: %s" % (self.trac_env_name, e))
+
+    def _set_failure(self, exc_info):
+        exc_obj = exc_info[1]
+        exc_tb = exc_info[2]
+        while exc_tb.tb_next:
+            exc_tb = exc_tb.tb_next
+        fname = exc_tb.tb_frame.f_code.co_filename
+        self.build_result = 'failure'
+        self.build_message = '%s:%s %s' % (fname, exc_tb.tb_lineno, exc_obj)
+
+    def _get_tag_data(self, tag_name):
+        """ Tag and PDF files of the tagged document """
+        tg = model.Tag(self.env, name=tag_name)
+        pdf_data = PDFPackage.get_pdf_files(self.env, tg.tag_url)
+        tkid = util.get_doc_tktid(
+            self.env, tg.tagged_item)
+        if tkid:
+            ticket = Ticket(self.env, tkid)
+            pdffile = ticket['pdffile']
+            if pdffile and pdffile != 'N/A':
+                for counter, item in enumerate(pdf_data):
+                    if item[0] == pdffile:
+                        pdf_data[counter] = (pdffile, True)
+                        break
+        return tg, pdf_data
+
+    def _setup_document(self, tg, pdf_tag_file):
+        """ Returns the archive name of the PDF file, its entry if it is
+            to be fetched from the repository and an error message if any """
+        # Rename IF main PDF file
+        if self.pdf_rename and self.pdf_selected[tg.name][pdf_tag_file[1]]:
+            targetfilename = "%s.pdf" % pdf_tag_file[0]
+            # For external documents
+            targetfilename = targetfilename.replace(
+                "%s_EXT_" % self.program_name, "", 1)
         else:
-            self.build_result = 'failure'
-            self.build_message = 'Could not find built archive'
-            return
+            targetfilename = pdf_tag_file[1]
+        doc_dirpath = "%s/%s" % (self.zip_dirpath, tg.name)
+        if not os.access(doc_dirpath, os.F_OK):
+            os.makedirs(doc_dirpath, exist_ok=True)
+        repos = util.get_repository(self.env, tg.tag_url)
+        try:
+            if repos.reponame:
+                node_url = tg.tag_url[len(repos.reponame) + 1:]
+            else:
+                node_url = tg.tag_url
+            node_path = '%s/%s' % (util.get_url(node_url), pdf_tag_file[1])
+            node_rev = util.get_revision(node_url)
+            node = repos.get_node(node_path, node_rev)
+            arcname = '%s/%s' % (tg.name, targetfilename)
+            entry = None
+            staged_key = '/'.join(pdf_tag_file)
+            if staged_key in self.staged:
+                # Resumed build: attachments and source files already staged
+                if not (self.prf_chklst and self.pdf_selected[tg.name][pdf_tag_file[1]]):
+                    entry = ('node', (tg.tag_url, node_path, node_rev), node.get_content_length())
+                return arcname, entry, None
+            # Add associated (P)RF/CHKLST IF main PDF file
+            if self.prf_chklst and self.pdf_selected[tg.name][pdf_tag_file[1]]:
+                # The attachments make a new file: the cached content is linked
+                doc_filepath = '%s/%s' % (doc_dirpath, targetfilename)
+                if os.access(doc_filepath, os.F_OK):
+                    # Left by an interrupted build
+                    os.remove(doc_filepath)
+                self.blob_cache.link(node, doc_filepath)
+                # The PDF conversions are done one at a time
+                with self._convert_lock:
+                    self._attach_prf_chklst(tg, self.base_path, doc_dirpath, targetfilename)
+            else:
+                entry = ('node', (tg.tag_url, node_path, node_rev), node.get_content_length())
+            # Add associated source files IF main PDF file
+            if self.source_files and self.pdf_selected[tg.name][pdf_tag_file[1]]:
+                retcode, lines = self._export_source_files(tg, doc_dirpath)
+                if retcode != 0:
+                    return None, None, ' '.join(lines)
+            with self.staged_lock:
+                with open(self.staged_path, 'a') as f:
+                    f.write('%s\n' % staged_key)
+            return arcname, entry, None
+        except NoSuchNode:
+            # ignore broken repositories used for testing
+            return None, None, None
+
+    def _fetch_node(self, source):
+        """ Returns the path of the cached content of the node """
+        tag_url, node_path, node_rev = source
+        # The repository objects are per thread
+        repos = util.get_repository(self.env, tag_url)
+        return self.blob_cache.get_path(repos.get_node(node_path, node_rev))
 
     def _attach_prf_chklst(self, tg, base_path, doc_dirpath, targetfilename):
         db = self.env.get_db_cnx()
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Artus
+# All rights reserved.
+#
+# Author: Michel Guillot <michel.guillot@meggitt.com>
+
+""" Background commit of the ticket working copies """
+
+# Trac
+from trac.core import Component, implements
+from trac.db.api import DatabaseManager
+from trac.db.schema import Table, Column, Index
+from trac.env import IEnvironmentSetupParticipant
+from trac.resource import ResourceNotFound
+from trac.ticket import Ticket
+from trac.util.datefmt import utc
+from trac.web.api import IRequestFilter
+
+# Standard lib
+import os
+import syslog
+import threading
+import time
+from datetime import datetime
+
+# Same package
+from artusplugin import util, _
+
+__all__ = ['CommitQueue', 'commit_document']
+
+# Database version identifier for upgrades.
+db_version = 1
+
+# Database schema
+schema = [
+    # Commit jobs
+    Table('artus_commit_job', key='id')[
+        Column('id', auto_increment=True),
+        Column('ticket', type='int'),
+        Column('authname'),
+        Column('wc_path'),
+        Column('status'),
+        Column('attempts', type='int'),
+        Column('revision'),
+        Column('message'),
+        Column('owner'),
+        Column('time', type='int64'),
+        Column('changetime', type='int64'),
+        Column('next_try', type='int64'),
+        Index(['ticket']),
+        Index(['status'])]
+]
+
+# Errors worth a retry: locked working copy (E155004) or missing pristine (E155010, E155032)
+TRANSIENT_ERRORS = ('E155004', 'E155010', 'E155032', u'verrouillée', u'texte de référence')
+
+
+def commit_document(env, doc, ticket, authname):
+    """ Commit the source and pdf files of the working copy
+        and track the new revision in the ticket
+        (to be called with the working copy locked) """
+    revision = doc.commit()
+    if revision != '':
+        # The locks have been automatically removed
+        if (ticket['sourcefile'] and ticket['sourcefile'] != 'N/A'):
+            doc.set_access(ticket['sourcefile'])
+        if (ticket['pdffile'] and ticket['pdffile'] != 'N/A'):
+            doc.set_access(ticket['pdffile'])
+        # Beware recursion and cache semaphore !
+        # Used for ECM/FEE author tracking
+        ticket['sourceurl'] = '%s?rev=%s' % (
+            util.get_url(ticket['sourceurl']),
+            revision)
+        now = datetime.now(utc)
+        ticket.save_changes('trac', _('Source Url changed (on behalf of %(user)s)', user=authname), now)
+    else:
+        # Remove the locks
+        doc.unlock_files([docfile for docfile in (ticket['sourcefile'], ticket['pdffile'])
+                          if docfile and docfile != 'N/A'])
+    return revision
+
+
+class CommitQueue(Component):
+    """ Persistent queue of working copy commits
+
+    Jobs are stored in the artus_commit_job table and run by a worker
+    thread in each web server process. A job is only started when all
+    the previous jobs on the same working copy are done.
+    The worker is started by the requests as long as jobs are pending, so
+    that the jobs queued before a restart (or left running by a dead
+    process) are run without waiting for another commit.
+    Options ([artusplugin] section):
+        async_commit: commit from the queue instead of the request (false)
+        commit_queue_max_attempts: attempts on transient errors (3)
+    """
+
+    implements(IEnvironmentSetupParticipant, IRequestFilter)
+
+    poll_interval = 2
+    retry_delay = 10
+    stale_delay = 3600
+    # Seconds between the checks of pending jobs by the requests
+    check_interval = 60
+
+    _last_check = 0
+    _worker = None
+    _worker_lock = threading.Lock()
+    _wakeup = threading.Event()
+
+    def __init__(self):
+        self.trac_env_name = util.get_program_data(self.env)['trac_env_name']
+        self.owner = '%s:%s' % (os.uname()[1], os.getpid())
+
+    # IEnvironmentSetupParticipant
+
+    def environment_created(self):
+        """Called when a new Trac environment is created."""
+        self.upgrade_environment()
+
+    def environment_needs_upgrade(self):
+        """Called when Trac checks whether the environment needs to be upgraded.
+        Returns `True` if upgrade is needed, `False` otherwise."""
+        dbm = DatabaseManager(self.env)
+        return dbm.get_database_version('artus_commit_queue_version') != db_version
+
+    def upgrade_environment(self):
+        """Actually perform an environment upgrade."""
+        dbm = DatabaseManager(self.env)
+        if dbm.get_database_version('artus_commit_queue_version') == 0:
+            dbm.create_tables(schema)
+        dbm.set_database_version(db_version, 'artus_commit_queue_version')
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        if time.time() - CommitQueue._last_check > self.check_interval:
+            CommitQueue._last_check = time.time()
+            if not self.is_worker_alive():
+                try:
+                    if self.has_pending_jobs():
+                        self.start_worker()
+                except Exception as e:
+                    syslog.syslog("Commit queue: pending jobs not checked: %s" % e)
+        return handler
+
+    def post_process_request(self, req, template, data, metadata):
+        return template, data, metadata
+
+    # Public API
+
+    def is_enabled(self):
+        return self.env.config.getbool('artusplugin', 'async_commit', False)
+
+    def enqueue(self, ticket, authname, wc_path):
+        """ Queue the commit of the working copy, return the job id """
+        now = int(time.time())
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO artus_commit_job
+                    (ticket, authname, wc_path, status, attempts, revision,
+                     message, owner, time, changetime, next_try)
+                VALUES (%s, %s, %s, 'queued', 0, '', '', '', %s, %s, %s)
+                """, (ticket.id, authname, wc_path, now, now, now))
+            job_id = db.get_last_id(cursor, 'artus_commit_job')
+        self.start_worker()
+        CommitQueue._wakeup.set()
+        return job_id
+
+    def get_job_status(self, ticket_id, authname=None):
+        """ Status of the last commit job of the ticket
+            (None if no job has been queued) """
+        sql = ("SELECT id, status, attempts, revision, message, time, changetime "
+               "FROM artus_commit_job WHERE ticket=%s")
+        args = [ticket_id]
+        if authname:
+            sql += " AND authname=%s"
+            args.append(authname)
+        sql += " ORDER BY id DESC LIMIT 1"
+        for row in self.env.db_query(sql, args):
+            job = dict(zip(('id', 'status', 'attempts', 'revision',
+                            'message', 'time', 'changetime'), row))
+            if job['status'] in ('queued', 'running'):
+                # Jobs queued before a restart of this process
+                self.start_worker()
+            return job
+        return None
+
+    def has_pending_jobs(self):
+        for row in self.env.db_query("""
+                SELECT 1 FROM artus_commit_job
+                WHERE status IN ('queued', 'running') LIMIT 1
+                """):
+            return True
+        return False
+
+    # Worker
+
+    @staticmethod
+    def is_worker_alive():
+        # Threads do not survive a fork
+        worker = CommitQueue._worker
+        return worker is not None and worker.is_alive()
+
+    def start_worker(self):
+        with CommitQueue._worker_lock:
+            if not self.is_worker_alive():
+                CommitQueue._worker = threading.Thread(target=self._work,
+                                                       name='artus-commit-queue')
+                CommitQueue._worker.daemon = True
+                CommitQueue._worker.start()
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim_job()
+            except Exception as e:
+                syslog.syslog("Commit queue: cannot claim a job: %s" % e)
+                job = None
+            if job:
+                self._run_job(job)
+            else:
+                CommitQueue._wakeup.wait(self.poll_interval)
+                CommitQueue._wakeup.clear()
+
+    def _claim_job(self):
+        """ Take the oldest job whose working copy has no older job pending """
+        now = int(time.time())
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            # Jobs left running by a dead process are queued again
+            cursor.execute("""
+                UPDATE artus_commit_job SET status='queued', owner=''
+                WHERE status='running' AND changetime < %s
+                """, (now - self.stale_delay,))
+            cursor.execute("""
+                SELECT j.id, j.ticket, j.authname, j.wc_path, j.attempts
+                FROM artus_commit_job j
+                WHERE j.status='queued' AND j.next_try <= %s
+                AND NOT EXISTS (SELECT 1 FROM artus_commit_job k
+                                WHERE k.wc_path=j.wc_path AND k.id < j.id
+                                AND k.status IN ('queued', 'running'))
+                ORDER BY j.id LIMIT 1
+                """, (now,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            cursor.execute("""
+                UPDATE artus_commit_job SET status='running', owner=%s, changetime=%s
+                WHERE id=%s AND status='queued'
+                """, (self.owner, now, row[0]))
+            if cursor.rowcount != 1:
+                # Claimed by another process
+                return None
+        return dict(zip(('id', 'ticket', 'authname', 'wc_path', 'attempts'), row))
+
+    def _run_job(self, job):
+        from artusplugin import cache
+        attempts = job['attempts'] + 1
+        try:
+            ticket = Ticket(self.env, job['ticket'])
+            template_cls = cache.Ticket_Cache.get_subclass(ticket['type'])
+            with template_cls(self.env, self.trac_env_name,
+                              job['authname'], ticket) as doc:
+                revision = commit_document(self.env, doc, ticket, job['authname'])
+            self._update_job(job['id'], 'done', attempts, revision, '')
+        except Exception as e:
+            message = '%s' % e
+            max_attempts = self.env.config.getint('artusplugin', 'commit_queue_max_attempts', 3)
+            if (not isinstance(e, ResourceNotFound) and attempts < max_attempts and
+                    any(error in message for error in TRANSIENT_ERRORS)):
+                status = 'queued'
+            else:
+                status = 'failed'
+            syslog.syslog("Commit queue: job %s (ticket #%s) attempt %s %s: %s" % (
+                job['id'], job['ticket'], attempts,
+                'will be retried' if status == 'queued' else 'failed', message))
+            self._update_job(job['id'], status, attempts, '', message,
+                             self.retry_delay * attempts)
+
+    def _update_job(self, job_id, status, attempts, revision, message, delay=0):
+        now = int(time.time())
+        with self.env.db_transaction as db:
+            db("""
+                UPDATE artus_commit_job
+                SET status=%s, attempts=%s, revision=%s, message=%s,
+                    changetime=%s, next_try=%s
+                WHERE id=%s
+                """, (status, attempts, revision, message, now, now + delay, job_id))
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Artus
+# All rights reserved.
+#
+# Author: Michel Guillot <michel.guillot@meggitt.com>
+
+""" Document conversions through long-lived LibreOffice converter workers """
+
+# Standard lib
+import json
+import os
+import queue
+import selectors
+import subprocess
+import syslog
+import threading
+import time
+
+# Same package
+from artusplugin import util
+
+__all__ = ['convert', 'ConverterPool']
+
+# Script run by the LibreOffice python (see converter_worker.py)
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'converter_worker.py')
+# Script converting one document (used when no worker can be started)
+CONVERTER_SCRIPT = '/srv/trac/common/DocumentConverter.py'
+
+
+class ConversionError(Exception):
+    pass
+
+
+class ConverterWorker(object):
+    """ A LibreOffice python process keeping its UNO connection
+        to the LibreOffice instance between conversions
+
+    Requests and responses are JSON lines on its stdin/stdout.
+    The process is (re)started when needed: not started yet, crashed,
+    not answering a health check or a conversion in time.
+    """
+
+    start_timeout = 30
+    ping_timeout = 30
+    # A worker idle for longer is checked before being used
+    idle_delay = 60
+
+    def __init__(self, install_dir, port):
+        self.install_dir = install_dir
+        self.port = port
+        self.process = None
+        self.last_used = 0
+
+    def start(self):
+        self.stop()
+        self.process = subprocess.Popen(['%s/program/python' % self.install_dir,
+                                         WORKER_SCRIPT, str(self.port)],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL,
+                                        cwd=util.apache_homedir,
+                                        env={'LC_ALL': 'fr_FR.utf8',
+                                             'HOME': util.apache_homedir,
+                                             'PYTHONIOENCODING': 'utf-8'})
+        response = self._read(self.start_timeout)
+        if not response.get('ready'):
+            self.stop()
+            raise ConversionError('Converter worker not ready')
+        self.last_used = time.time()
+
+    def stop(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def request(self, message, timeout):
+        if not self.is_alive():
+            self.start()
+        elif time.time() - self.last_used > self.idle_delay:
+            # Health check
+            self._send({'cmd': 'ping'})
+            if not self._read(self.ping_timeout).get('ok'):
+                self.start()
+        self._send(message)
+        response = self._read(timeout)
+        self.last_used = time.time()
+        return response
+
+    def _send(self, message):
+        try:
+            self.process.stdin.write(('%s\n' % json.dumps(message)).encode('utf-8'))
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            self.stop()
+            raise ConversionError('Converter worker stopped: %s' % e)
+
+    def _read(self, timeout):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.process.stdout, selectors.EVENT_READ)
+            if not selector.select(timeout):
+                self.stop()
+                raise ConversionError('Converter worker timeout (%ss)' % timeout)
+        line = self.process.stdout.readline()
+        if not line:
+            # Crashed (eg segmentation fault)
+            self.stop()
+            raise ConversionError('Converter worker stopped')
+        return json.loads(line.decode('utf-8'))
+
+
+class ConverterPool(object):
+    """ Bounded pool of converter workers of a LibreOffice instance
+
+    Conversions wait for a free worker, so that no more than
+    LOo_converter_workers conversions run at the same time in the process.
+    Options ([artusplugin] section):
+        LOo_install_dir, LOo_port: LibreOffice instance
+        LOo_converter_workers: workers of the pool (2)
+        LOo_convert_timeout: seconds allowed for a conversion (300)
+    """
+
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, env):
+        install_dir = env.config.get('artusplugin', 'LOo_install_dir')
+        port = env.config.get('artusplugin', 'LOo_port')
+        size = max(1, env.config.getint('artusplugin', 'LOo_converter_workers', 2))
+        key = (install_dir, port)
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            # Workers are not shared with forked processes
+            if pool is None or pool.pid != os.getpid():
+                pool = cls._pools[key] = cls(install_dir, port, size)
+        pool.timeout = env.config.getint('artusplugin', 'LOo_convert_timeout', 300)
+        return pool
+
+    def __init__(self, install_dir, port, size):
+        self.pid = os.getpid()
+        self.timeout = 300
+        self.workers = queue.Queue()
+        for i in range(size):
+            self.workers.put(ConverterWorker(install_dir, port))
+
+    def convert(self, input_path, output_path):
+        """ Convert input_path to output_path (format given by the suffix)
+            A conversion interrupted by a worker crash is tried again once """
+        worker = self.workers.get()
+        try:
+            for attempt in (1, 2):
+                try:
+                    response = worker.request({'input': input_path,
+                                               'output': output_path},
+                                              self.timeout)
+                    break
+                except ConversionError as e:
+                    if attempt == 2 or 'timeout' in '%s' % e:
+                        raise
+            if not response.get('ok'):
+                raise ConversionError(response.get('error', 'Conversion failed'))
+        finally:
+            self.workers.put(worker)
+
+
+def convert(env, input_path, output_path):
+    """ Convert a document with the LibreOffice instance
+        Returns 0 on success, as unix_cmd_apply """
+    try:
+        ConverterPool.get(env).convert(input_path, output_path)
+        return 0
+    except ConversionError as e:
+        syslog.syslog("Conversion of %s through the converter workers failed: %s" % (input_path, e))
+    # The conversion is done by a dedicated process
+    unix_cmd_list = ['%s/program/python %s "%s" "%s" %s' %
+                     (env.config.get('artusplugin', 'LOo_install_dir'),
+                      CONVERTER_SCRIPT,
+                      input_path,
+                      output_path,
+                      env.config.get('artusplugin', 'LOo_port'))]
+    return util.unix_cmd_apply(env, unix_cmd_list, util.lineno())[0]
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Artus
+# All rights reserved.
+#
+# Author: Michel Guillot <michel.guillot@meggitt.com>
+
+""" LibreOffice converter worker (see converter.ConverterWorker)
+
+Run by the LibreOffice python: <LOo_install_dir>/program/python converter_worker.py <port>
+Reads JSON requests on stdin, one per line:
+    {"input": <path>, "output": <path>}    converts input to output
+    {"cmd": "ping"}                        checks the connection
+and writes a JSON response for each: {"ok": true} or {"ok": false, "error": <message>}
+"""
+
+# Standard lib
+import json
+import sys
+
+sys.path.insert(0, '/srv/trac/common')
+
+# LibreOffice
+from DocumentConverter import DocumentConverter
+
+
+def main():
+    port = int(sys.argv[1])
+    # stdout is kept for the responses
+    channel = sys.stdout
+    sys.stdout = sys.stderr
+    converter = None
+
+    channel.write('%s\n' % json.dumps({'ready': True}))
+    channel.flush()
+    for line in sys.stdin:
+        try:
+            request = json.loads(line)
+            if converter is None:
+                converter = DocumentConverter(port)
+            if request.get('cmd') != 'ping':
+                converter.convert(request['input'], request['output'])
+            response = {'ok': True}
+        except Exception as e:
+            # Connected again for the next request
+            converter = None
+            response = {'ok': False, 'error': '%s' % e}
+        channel.write('%s\n' % json.dumps(response))
+        channel.flush()
+
+
+if __name__ == '__main__':
+    main()
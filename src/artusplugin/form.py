@@ -33,6 +33,7 @@ from trac.web.chrome import Chrome
 
 # Standard lib
 from backports.tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from xml.dom.minidom import parseString, parse
 from lxml import etree as ElementTree
@@ -46,12 +47,14 @@ import shutil
 import sys
 import syslog
 import tempfile
+import time
 import urllib3
 import zipfile
 
 # Same package
-from artusplugin import util, Ooo, _
+from artusplugin import util, converter, Ooo, _
 from artusplugin.model import NamingRule
+from artusplugin.ooxml import TemplateCache
 
 
 def striptags(html):
@@ -257,43 +260,102 @@ class MSOFormTemplate(TicketFormTemplate):
         """ Close docm/xlsm """
         util.zip_dir(tmpdir, filename)
 
+    def get_artefacts(self, template_path):
+        """ Custom XML and VBA parts of the template (process-wide cache) """
+        if self.repo_form:
+            repos = util.get_repository(self.env, template_path)
+            node = repos.get_node(template_path, self.source_rev)
+            return TemplateCache.get_node(node)
+        else:
+            return TemplateCache.get(template_path)
+
+    def get_customxml_dom(self, template_path):
+        customxml_dom = self.get_artefacts(template_path).get_customxml_dom(
+            [self.root_tag] + self.root_tag_legacy_list)
+        if customxml_dom is None:
+            message = tag.span('%s: The custom XML could not be identified in the following template:' % util.lineno())
+            message(tag.p(template_path))
+            raise TracError(message, 'Hostname mismatch ?', True)
+        return customxml_dom
+
     def get_creation_datetime(self, template_path):
-        with TemporaryDirectory() as tmpdir:
-            self._unzip(self.get_cache_name(tmpdir, template_path), tmpdir)
-            customxml_dom = parse(self.get_customxml_filepath(tmpdir))
-            lst = customxml_dom.getElementsByTagName("Template")
-            if lst:
-                elt = lst[0]
-                return elt.getAttribute("CreationDateTime")
-            else:
-                return None
+        lst = self.get_customxml_dom(template_path).getElementsByTagName("Template")
+        if lst:
+            elt = lst[0]
+            return elt.getAttribute("CreationDateTime")
+        else:
+            return None
 
     def get_modification_datetime(self, template_path):
-        with TemporaryDirectory() as tmpdir:
-            self._unzip(self.get_cache_name(tmpdir, template_path), tmpdir)
-            customxml_dom = parse(self.get_customxml_filepath(tmpdir))
-            lst = customxml_dom.getElementsByTagName("Template")
-            if lst:
-                elt = lst[0]
-                return elt.getAttribute("ModificationDateTime")
-            else:
-                return None
+        lst = self.get_customxml_dom(template_path).getElementsByTagName("Template")
+        if lst:
+            elt = lst[0]
+            return elt.getAttribute("ModificationDateTime")
+        else:
+            return None
 
     def get_vba_hash(self, template_path):
-        hash_md5 = hashlib.md5()
-        with TemporaryDirectory() as tmpdir:
-            self._unzip(self.get_cache_name(tmpdir, template_path), tmpdir)
-            vba_filename = '%s/%s' % (tmpdir, self.vbaprojectfile)
-            with open(vba_filename, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        return self.get_artefacts(template_path).get_md5(self.vbaprojectfile)
 
 
 formtemplate_subclasses = {'OpenOffice': OOoFormTemplate,
                            'MS Office': MSOFormTemplate}
 
 
+class TicketPDFCache(object):
+    """ PDF conversions of the tickets, kept under <base_dir>/.cache
+
+    A conversion is keyed by the ticket id, the form revision given by
+    the ticket description and the last change of the form and its
+    attachments in the repository. Conversions not used for
+    pdf_print_cache_days days (30) are removed.
+    """
+
+    def __init__(self, env, base_dir):
+        self.env = env
+        self.path = '%s/.cache' % base_dir
+
+    def pdf_convert(self, tf, ticket, base_path):
+        """ As TicketForm.pdf_convert """
+        try:
+            key = tf.get_pdf_cache_key(ticket)
+        except Exception as e:
+            syslog.syslog("PDF cache key of ticket %s not available: %s" % (ticket.id, e))
+            key = None
+        if key is None:
+            return tf.pdf_convert(ticket, base_path)
+        key, name = key
+        cached_path = '%s/%s.pdf' % (self.path, key)
+        pdf_path = '%s/%s/%s.pdf' % (base_path, name, name)
+        if os.access(cached_path, os.F_OK):
+            os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+            if os.access(pdf_path, os.F_OK):
+                os.remove(pdf_path)
+            os.link(cached_path, pdf_path)
+            os.utime(cached_path)
+            return pdf_path
+        pdf_path = tf.pdf_convert(ticket, base_path)
+        if pdf_path:
+            os.makedirs(self.path, exist_ok=True)
+            tmp_path = '%s.%s.tmp' % (cached_path, os.getpid())
+            shutil.copyfile(pdf_path, tmp_path)
+            os.replace(tmp_path, cached_path)
+        return pdf_path
+
+    def prune(self):
+        if not os.access(self.path, os.F_OK):
+            return
+        max_age = self.env.config.getint('artusplugin', 'pdf_print_cache_days', 30) * 86400
+        now = time.time()
+        for filename in os.listdir(self.path):
+            filepath = os.path.join(self.path, filename)
+            try:
+                if now - os.path.getmtime(filepath) > max_age:
+                    os.remove(filepath)
+            except OSError:
+                pass
+
+
 class TicketForm(object):
     """ This class and its subclasses are used for handling the ticket form:
         editing, archiving
@@ -437,7 +499,22 @@ class TicketForm(object):
             return comment
 
     @staticmethod
-    def tickets_pdf_convert(env, trac_env_name, authname, ticket_list):
+    def get_pdf_print_name(trac_env_name, authname):
+        """ <trac_env_name>_<datetime>_<authname> """
+        return '%s_%s_%s' % (trac_env_name,
+                             str(datetime.now(localtz).strftime(
+                                 '%Y-%m-%d_%H-%M-%S')),
+                             authname)
+
+    @staticmethod
+    def tickets_pdf_convert(env, trac_env_name, authname, ticket_list,
+                            package_name=None, progress=None):
+        """ progress(phase, done, total) is called after each ticket,
+            returning False cancels the job ('cancelled' is then returned).
+            The tickets already converted under package_name are skipped,
+            the archive being made once all of them are converted.
+            Tickets are converted concurrently ([artusplugin] pdf_print_workers,
+            default 2) and the PDF files are cached per ticket form revision. """
         base_dir = '/var/cache/trac/PDF-printing/%s' % trac_env_name
         # Case where only one element is selected
         if not type(ticket_list) == list:
@@ -447,13 +524,21 @@ class TicketForm(object):
             os.makedirs(base_dir)
         # The job will be executed under a temporary sub-directory of base_dir
         # named as follows: <trac_env_name>_<datetime>_<authname>
-        base_path = '%s/%s_%s_%s' % (base_dir,
-                                     trac_env_name,
-                                     str(datetime.now(localtz).strftime(
-                                         '%Y-%m-%d_%H-%M-%S')),
-                                     authname)
+        if not package_name:
+            package_name = TicketForm.get_pdf_print_name(trac_env_name, authname)
+        base_path = '%s/%s' % (base_dir, package_name)
         if not os.access(base_path, os.F_OK):
             os.mkdir(base_path)
+        done_path = '%s/.done' % base_path
+        # ticket id -> PDF file, relative to base_path ('' if not printed)
+        converted = {}
+        if os.access(done_path, os.F_OK):
+            with open(done_path) as f:
+                for line in f:
+                    trac_id, sep, pdf_name = line.rstrip('\n').partition('\t')
+                    if sep and (not pdf_name or os.access('%s/%s' % (base_path, pdf_name), os.F_OK)):
+                        converted[trac_id] = pdf_name
+        pdf_cache = TicketPDFCache(env, base_dir)
 
         # The list of tickets is extracted from the repository,
         # forms are converted to PDF and an archive is made
@@ -463,33 +548,72 @@ class TicketForm(object):
                        for tid in ticket_list
                        if tid not in seen and not seen.add(tid)]
 
-        for trac_id in ticket_list:
+        def convert(trac_id):
             ticket = Ticket(env, trac_id)
             tp_data = TicketForm.get_ticket_process_data(env, authname, ticket)
             tf = tp_data['ticket_form']
-            pdf_path = tf.pdf_convert(ticket, base_path)
-
-            # An archive is made incrementally
-            if pdf_path:
-                cmd = """\
-/usr/bin/zip -j "%s/%s.zip" "%s" -c <<EOF
-Ticket TRAC #%s
-EOF
-                """ % (base_path,
-                       os.path.basename(base_path),
-                       pdf_path,
-                       trac_id)
-                unix_cmd_list = [cmd]
-                # Effective application of the list of commands
-                util.unix_cmd_apply(env, unix_cmd_list, util.lineno())
-
-        # The finalized archive becomes available
-        original_path = '%s/%s.zip' % (base_path, os.path.basename(base_path))
-        final_path = '%s/%s.zip' % (base_dir, os.path.basename(base_path))
-        if os.access(original_path, os.F_OK):
-            os.rename(original_path, final_path)
+            return pdf_cache.pdf_convert(tf, ticket, base_path)
+
+        workers = max(1, env.config.getint('artusplugin', 'pdf_print_workers', 2))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(trac_id, executor.submit(convert, trac_id) if str(trac_id) not in converted else None)
+                       for trac_id in ticket_list]
+            for counter, (trac_id, future) in enumerate(futures, 1):
+                if future is not None:
+                    try:
+                        pdf_path = future.result()
+                    except Exception as e:
+                        syslog.syslog("%s(%s): ticket %s not printed: %s" % (
+                            trac_env_name, authname, trac_id, e))
+                        pdf_path = None
+                    pdf_name = os.path.relpath(pdf_path, base_path) if pdf_path else ''
+                    converted[str(trac_id)] = pdf_name
+                    with open(done_path, 'a') as f:
+                        f.write('%s\t%s\n' % (trac_id, pdf_name))
+                if progress and not progress('converting', counter, len(ticket_list)):
+                    for trac_id, future in futures:
+                        if future is not None:
+                            future.cancel()
+                    return 'cancelled'
+
+        pdf_cache.prune()
+
+        # The archive is made in the tickets order from the converted tickets
+        # (a job stopped meanwhile makes it again when resumed)
+        pdf_paths = [(trac_id, '%s/%s' % (base_path, converted[str(trac_id)]))
+                     for trac_id in ticket_list if converted.get(str(trac_id))]
+        if pdf_paths:
+            archive_path = '%s/%s.zip' % (base_path, os.path.basename(base_path))
+            with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for trac_id, pdf_path in pdf_paths:
+                    info = zipfile.ZipInfo(os.path.basename(pdf_path),
+                                           time.localtime(os.path.getmtime(pdf_path))[:6])
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    info.external_attr = 0o664 << 16
+                    info.comment = ('Ticket TRAC #%s' % trac_id).encode('utf-8')
+                    with open(pdf_path, 'rb') as source, archive.open(info, 'w') as target:
+                        shutil.copyfileobj(source, target, 1 << 20)
+            # The finalized archive becomes available
+            final_path = '%s/%s.zip' % (base_dir, os.path.basename(base_path))
+            os.rename(archive_path, final_path)
             # Job completed: send an email to the client
             util.send_pdf_print_email(env, authname, base_path)
+        return 'done'
+
+    def get_pdf_cache_key(self, ticket):
+        """ Identifies the ticket form and attachments as converted to PDF
+            (None if they cannot be found) """
+        repos = util.get_repository(self.env, self.repo_path)
+        if repos is None:
+            return None
+        try:
+            node = repos.get_node('%s/%s' % (self.repo_subpath, ticket['summary']))
+        except NoSuchNode:
+            return None
+        revision = util.get_revision_from_description(
+            ticket['summary'],
+            ticket['description'])
+        return '%s_%s_%s' % (ticket.id, revision, node.rev), node.name
 
     def __init__(self, env, ticket_type, tid, ticket_id, skill, tagname, authname):
         self.env = env
@@ -666,7 +790,9 @@ EOF
         try:
             # Extract ticket form and associated attachments
             node = repos.get_node('%s/%s' % (self.repo_subpath, ticket['summary']))
-            util.create_fs_from_repo(base_path, node)
+            blob_cache = util.BlobCache(self.env)
+            util.create_fs_from_repo(base_path, node, blob_cache)
+            blob_cache.flush()
             ticket_path = '%s/%s' % (base_path, node.name)
             ticket_filename = "%s/%s.%s" % (ticket_path,
                                             node.name,
@@ -679,20 +805,12 @@ EOF
             # Update ticket form
             self.prepare_pdf(ticket_filename, updated_id)
             # Convert ticket form to PDF
-            unix_cmd_list = ['%s/program/python /srv/trac/common/DocumentConverter.py '
-                             '"%s/%s.%s" "%s/%s.pdf" %s' %
-                             (self.pdf_converter_install_dir,
-                              ticket_path,
-                              node.name,
-                              self.suffix,
-                              ticket_path,
-                              node.name,
-                              self.pdf_converter_port)]
-            # Effective application of the list of commands -
             # NOTE: Conversion of ticket and attachment are done separately
             # because of sporadic segmentation faults (-11) on tickets
             # which would prevent attachments conversion if done together
-            retcode = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())[0]
+            retcode = converter.convert(self.env,
+                                        '%s/%s.%s' % (ticket_path, node.name, self.suffix),
+                                        '%s/%s.pdf' % (ticket_path, node.name))
             if retcode == 0:
                 attachments_path = '%s/attachments' % ticket_path
                 if os.path.exists(attachments_path):
@@ -717,18 +835,11 @@ EOF
                                 attachments_to_be_converted.append(fn)
                                 attachments_to_be_deleted.append(fn)
                         # Convert supported attachments to PDF
-                        unix_cmd_list = []
                         for fn in attachments_to_be_converted:
-                            unix_cmd_list += ['%s/program/python /srv/trac/common/DocumentConverter.py '
-                                              '"%s/%s" "%s/%s.pdf" %s' %
-                                              (self.env.config.get('artusplugin', 'LOo_install_dir'),
-                                               attachments_path,
-                                               fn,
-                                               attachments_path,
-                                               urllib3.unquote(fn.rsplit('.', 1)[-2]),
-                                               self.env.config.get('artusplugin', 'LOo_port'))]
-                        # Effective application of the list of commands
-                        util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())
+                            converter.convert(self.env,
+                                              '%s/%s' % (attachments_path, fn),
+                                              '%s/%s.pdf' % (attachments_path,
+                                                             urllib3.unquote(fn.rsplit('.', 1)[-2])))
                         # Removes attachments not included into the PDF file
                         for fn in attachments_to_be_deleted:
                             os.remove("%s/%s" % (attachments_path, fn))
@@ -2590,18 +2701,7 @@ class MSOMOMForm(MSOForm):
                       (self.trac_env_name, self.authname, ticket_id))
 
         # Convert ticket form to Word - inplace conversion
-        unix_cmd_list = ['%s/program/python '
-                         '/srv/trac/common/DocumentConverter.py '
-                         '"%s" "%s" %s' %
-                         (self.env.config.get('artusplugin',
-                          'LOo_install_dir'),
-                          odtpath,
-                          docxpath,
-                          self.env.config.get('artusplugin',
-                          'LOo_port'))]
-
-        # Effective application of the list of commands -
-        retcode = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())[0]
+        retcode = converter.convert(self.env, odtpath, docxpath)
 
         if retcode == 0:
             syslog.syslog("%s(%s): MoM converted to docx (ticket %s)" %
@@ -3728,17 +3828,7 @@ class MoM(TicketAttachment):
 
         # Convert ticket form to Word
         docxpath = "%s.docx" % odtpath.rsplit('.', 1)[0]
-        unix_cmd_list = ['%s/program/python '
-                         '/srv/trac/common/DocumentConverter.py '
-                         '"%s" "%s" %s' %
-                         (self.env.config.get('artusplugin',
-                          'LOo_install_dir'),
-                          odtpath,
-                          docxpath,
-                          self.env.config.get('artusplugin',
-                          'LOo_port'))]
-        # Effective application of the list of commands -
-        retcode = util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())[0]
+        retcode = converter.convert(self.env, odtpath, docxpath)
 
         if retcode == 0:
             syslog.syslog("%s(%s): MoM converted to docx (ticket %s)" %
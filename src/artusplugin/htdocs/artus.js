@@ -4,6 +4,8 @@ qa_review_skills = ['DIR', 'PROC-1', 'PROC-2', 'PROC-3', 'PROC-4', 'PROC-5', 'PR
 qa_audit_skills = ['QMS', 'CLI', 'INT'];
 
 var beforeunload_event_handler_set = false;
+var commit_status_polled = false;
+var pdf_jobs_timer = null;
 
 $(document).ready(function($) {
 	// Run as soon as the DOM hierarchy has been fully constructed
@@ -89,6 +91,10 @@ function OnGeneralDocumentReady() {
 	 * when admin pages are loaded
 	 */
 	on_logout_click();
+	if (typeof g_pdf_jobs != 'undefined') {
+		// PDF packaging/printing jobs of the user
+		poll_pdf_jobs();
+	}
 	if (typeof g_ticket_type !== "undefined") {
 		// filter_ticket_stream
 		let component = UIComponents.buttons.CreateTicketSubmitChanges;
@@ -121,6 +127,10 @@ function OnGeneralDocumentReady() {
 				}
 				// Go to edition mode if requested
 				get_edition_mode();
+				if (typeof g_commit_queue != 'undefined') {
+					// Background commit of the document
+					poll_commit_status();
+				}
 			}
 			if (g_ticket_type == 'MOM' && g_ticket_momform == 'Archived') {
 				// Set lock status
@@ -2039,6 +2049,15 @@ function artus_reqListener(status, fieldname, fieldvalue) {
 	else if (fieldname == "pre-fill_mom") {
 		unset_overlay();
 	}
+	else if (fieldname == "commit_status") {
+		show_commit_status(JSON.parse(fieldvalue));
+	}
+	else if (fieldname == "pdf_jobs") {
+		show_pdf_jobs(JSON.parse(fieldvalue));
+	}
+	else if (fieldname == "cancel_job") {
+		poll_pdf_jobs();
+	}
 }
 
 function artus_xhr(fieldname, data, async, method) {
@@ -2273,6 +2292,97 @@ function setup_workflow(force_reassign) {
 	artus_xhr("workflow", data, async, "GET");
 }
 
+function poll_commit_status() {
+	var data = {};
+	data.ticket_id = ticketid_get();
+	var async = true;
+	artus_xhr("commit_status", data, async, "GET");
+}
+
+function show_commit_status(job) {
+	// Last background commit of the ticket by the user (see CommitQueue)
+	$('#commit_status').remove();
+	if (job == null) {
+		return;
+	}
+	if (job.status == 'queued' || job.status == 'running') {
+		commit_status_polled = true;
+		let msg = (job.status == 'queued') ? 'The commit of the document is queued' : 'The document is being committed';
+		if (job.attempts > 0) {
+			msg += ' (attempt ' + (job.attempts + 1) + ')';
+		}
+		$('#content').prepend('<div id="commit_status" class="system-message"><p>' + msg + '...</p></div>');
+		setTimeout(poll_commit_status, 3000);
+	}
+	else if (job.status == 'done') {
+		if (commit_status_polled) {
+			// Show the new revision
+			location.reload();
+		}
+	}
+	else if (job.status == 'failed') {
+		let msg = 'The commit of the document has failed: ' + $('<div>').text(job.message).html();
+		$('#content').prepend('<div id="commit_status" class="system-message warning"><p>' + msg + '</p></div>');
+		// Reported once
+		let key = 'artus_commit_failed_' + g_trac_env_name + '_' + job.id;
+		if (commit_status_polled || !localStorage.getItem(key)) {
+			localStorage.setItem(key, '1');
+			jqAlert(msg, 'Commit failed - Type <ESC> to close this window.', null);
+		}
+	}
+}
+
+function poll_pdf_jobs() {
+	var data = {};
+	var async = true;
+	artus_xhr("pdf_jobs", data, async, "GET");
+}
+
+function cancel_pdf_job(job_id) {
+	var data = {};
+	data.action = "cancel_job";
+	data.job_id = job_id;
+	var async = true;
+	artus_xhr("cancel_job", data, async, "POST");
+}
+
+function show_pdf_jobs(jobs) {
+	// Jobs pending or finished within the last hour (see JobQueue)
+	var labels = {'pdf_package': 'Documents package', 'pdf_print': 'Tickets printing'};
+	var folders = {'pdf_package': '/PDF-packaging/', 'pdf_print': '/PDF-printing/'};
+	var now = Date.now() / 1000;
+	var pending = false;
+	var rows = '';
+	$.each(jobs, function(i, job) {
+		var active = (job.status == 'queued' || job.status == 'running');
+		if (!active && now - job.changetime > 3600) {
+			return;
+		}
+		pending = pending || active;
+		var state = job.status;
+		if (job.status == 'running' && job.total > 0) {
+			state += ' - ' + job.phase + ' ' + job.done + '/' + job.total;
+		}
+		else if (job.status == 'failed') {
+			state += ': ' + $('<div>').text(job.message).html();
+		}
+		else if (job.status == 'done') {
+			state = '<a href="' + folders[job.kind] + g_trac_env_name + '">done</a>';
+		}
+		var action = active ? '<input type="button" value="Cancel" onclick="cancel_pdf_job(' + job.id + ')" />' : '';
+		rows += '<tr><td>' + (labels[job.kind] || job.kind) + ' #' + job.id + '</td><td>' +
+			state + '</td><td>' + action + '</td></tr>';
+	});
+	$('#pdf_jobs').remove();
+	if (rows) {
+		$('#content').prepend('<div id="pdf_jobs" class="system-message"><table>' + rows + '</table></div>');
+	}
+	clearTimeout(pdf_jobs_timer);
+	if (pending) {
+		pdf_jobs_timer = setTimeout(poll_pdf_jobs, 5000);
+	}
+}
+
 function set_lock_unlock_description(src_file, pdf_file) {
 	var data = {};
 	data.ticket_id = ticketid_get();
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Artus
+# All rights reserved.
+#
+# Author: Michel Guillot <michel.guillot@meggitt.com>
+
+""" Background PDF packaging and printing jobs """
+
+# Trac
+from trac.core import Component, implements
+from trac.db.api import DatabaseManager
+from trac.db.schema import Table, Column, Index
+from trac.env import IEnvironmentSetupParticipant
+from trac.web.api import IRequestFilter
+
+# Standard lib
+import json
+import os
+import syslog
+import threading
+import time
+
+# Same package
+from artusplugin import util
+
+__all__ = ['JobQueue']
+
+# Database version identifier for upgrades.
+db_version = 1
+
+# Database schema
+schema = [
+    # PDF packaging/printing jobs
+    Table('artus_job', key='id')[
+        Column('id', auto_increment=True),
+        Column('kind'),
+        Column('authname'),
+        Column('args'),
+        Column('status'),
+        Column('phase'),
+        Column('done', type='int'),
+        Column('total', type='int'),
+        Column('bytes', type='int64'),
+        Column('message'),
+        Column('cancel', type='int'),
+        Column('attempts', type='int'),
+        Column('owner'),
+        Column('time', type='int64'),
+        Column('changetime', type='int64'),
+        Index(['authname']),
+        Index(['status'])]
+]
+
+
+class JobQueue(Component):
+    """ Persistent queue of PDF packaging and printing jobs
+
+    Jobs are stored in the artus_job table and run by worker threads
+    of the web server processes, at most pdf_jobs_workers at a time
+    for the whole environment. A running job is kept alive by a heartbeat,
+    independent of its progress reports (a single document conversion may
+    be long): a job left running by a stopped process of this host, or by
+    a process of another host whose heartbeat has stopped, is taken again
+    and resumes from what has already been staged.
+    The workers are started by the requests as long as jobs are queued or
+    running, so that the jobs of a stopped process are resumed without
+    waiting for another job. The jobs of the user are shown with their
+    progress on the pages (see show_pdf_jobs in artus.js), where they can
+    be cancelled.
+    Options ([artusplugin] section):
+        pdf_jobs_workers: jobs run at the same time (2)
+    Job kinds:
+        pdf_package: PDFPackage build (documents packaging)
+        pdf_print: TicketForm.tickets_pdf_convert (tickets printing)
+    """
+
+    implements(IEnvironmentSetupParticipant, IRequestFilter)
+
+    poll_interval = 5
+    # Seconds between the checks of pending jobs by the requests
+    check_interval = 60
+    # Finished jobs are shown for recent_delay seconds
+    recent_delay = 3600
+    # Running jobs are marked alive every heartbeat_interval seconds
+    heartbeat_interval = 60
+    # and taken again when not marked alive for stale_delay seconds
+    stale_delay = 600
+    # Progress is saved at most every progress_interval seconds
+    progress_interval = 2
+
+    _last_check = 0
+    _workers = []
+    _workers_lock = threading.Lock()
+    _wakeup = threading.Event()
+
+    def __init__(self):
+        self.trac_env_name = util.get_program_data(self.env)['trac_env_name']
+        self.hostname = os.uname()[1]
+
+    # IEnvironmentSetupParticipant
+
+    def environment_created(self):
+        """Called when a new Trac environment is created."""
+        self.upgrade_environment()
+
+    def environment_needs_upgrade(self):
+        """Called when Trac checks whether the environment needs to be upgraded.
+        Returns `True` if upgrade is needed, `False` otherwise."""
+        dbm = DatabaseManager(self.env)
+        return dbm.get_database_version('artus_job_version') != db_version
+
+    def upgrade_environment(self):
+        """Actually perform an environment upgrade."""
+        dbm = DatabaseManager(self.env)
+        if dbm.get_database_version('artus_job_version') == 0:
+            dbm.create_tables(schema)
+        dbm.set_database_version(db_version, 'artus_job_version')
+
+    # IRequestFilter
+
+    def pre_process_request(self, req, handler):
+        if time.time() - JobQueue._last_check > self.check_interval:
+            JobQueue._last_check = time.time()
+            try:
+                if self.has_pending_jobs():
+                    self.start_workers()
+            except Exception as e:
+                syslog.syslog("PDF jobs: pending jobs not checked: %s" % e)
+        return handler
+
+    def post_process_request(self, req, template, data, metadata):
+        return template, data, metadata
+
+    # Public API
+
+    def get_max_workers(self):
+        return max(1, self.env.config.getint('artusplugin', 'pdf_jobs_workers', 2))
+
+    def enqueue(self, kind, authname, args):
+        """ Queue a job, return its id """
+        now = int(time.time())
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO artus_job
+                    (kind, authname, args, status, phase, done, total, bytes,
+                     message, cancel, attempts, owner, time, changetime)
+                VALUES (%s, %s, %s, 'queued', '', 0, 0, 0, '', 0, 0, '', %s, %s)
+                """, (kind, authname, json.dumps(args), now, now))
+            job_id = db.get_last_id(cursor, 'artus_job')
+        self.start_workers()
+        JobQueue._wakeup.set()
+        return job_id
+
+    def get_jobs(self, authname, limit=20):
+        """ Last jobs of the user, most recent first """
+        jobs = []
+        for row in self.env.db_query("""
+                SELECT id, kind, status, phase, done, total, bytes, message, time, changetime
+                FROM artus_job WHERE authname=%s ORDER BY id DESC LIMIT %s
+                """, (authname, limit)):
+            jobs.append(dict(zip(('id', 'kind', 'status', 'phase', 'done', 'total',
+                                  'bytes', 'message', 'time', 'changetime'), row)))
+        if any(job['status'] in ('queued', 'running') for job in jobs):
+            # Jobs queued before a restart of this process
+            self.start_workers()
+        return jobs
+
+    def has_pending_jobs(self):
+        for row in self.env.db_query("""
+                SELECT 1 FROM artus_job WHERE status IN ('queued', 'running') LIMIT 1
+                """):
+            return True
+        return False
+
+    def has_recent_jobs(self, authname):
+        """ Test if the user has jobs pending or finished lately """
+        for row in self.env.db_query("""
+                SELECT 1 FROM artus_job
+                WHERE authname=%s AND (status IN ('queued', 'running') OR changetime > %s)
+                LIMIT 1
+                """, (authname, int(time.time()) - self.recent_delay)):
+            return True
+        return False
+
+    def cancel(self, job_id, authname):
+        """ Cancel a job of the user: a queued job is cancelled at once,
+            a running job at its next progress report """
+        now = int(time.time())
+        with self.env.db_transaction as db:
+            db("""
+                UPDATE artus_job SET status='cancelled', changetime=%s
+                WHERE id=%s AND authname=%s AND status='queued'
+                """, (now, job_id, authname))
+            db("""
+                UPDATE artus_job SET cancel=1
+                WHERE id=%s AND authname=%s AND status='running'
+                """, (job_id, authname))
+
+    # Workers
+
+    def start_workers(self):
+        with JobQueue._workers_lock:
+            JobQueue._workers = [worker for worker in JobQueue._workers if worker.is_alive()]
+            for i in range(len(JobQueue._workers), self.get_max_workers()):
+                worker = threading.Thread(target=self._work, name='artus-pdf-jobs')
+                worker.daemon = True
+                worker.start()
+                JobQueue._workers.append(worker)
+
+    def _work(self):
+        owner = '%s:%s:%s' % (self.hostname, os.getpid(), threading.current_thread().ident)
+        while True:
+            try:
+                job = self._claim_job(owner)
+            except Exception as e:
+                syslog.syslog("PDF jobs: cannot claim a job: %s" % e)
+                job = None
+            if job:
+                self._run_job(job, owner)
+            else:
+                JobQueue._wakeup.wait(self.poll_interval)
+                JobQueue._wakeup.clear()
+
+    def _is_dead(self, owner):
+        """ The owner (host:pid:thread) is a process of this host which has stopped
+            None if it cannot be checked (another host) """
+        fields = owner.split(':')
+        if len(fields) != 3 or fields[0] != self.hostname:
+            return None
+        try:
+            os.kill(int(fields[1]), 0)
+        except ProcessLookupError:
+            return True
+        except ValueError:
+            return None
+        except OSError:
+            return False
+        return False
+
+    def _claim_job(self, owner):
+        """ Take the oldest queued job if a worker slot is free """
+        now = int(time.time())
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            # Jobs left running by a stopped process are queued again,
+            # the heartbeat telling for the processes of the other hosts
+            cursor.execute("SELECT id, owner, changetime FROM artus_job WHERE status='running'")
+            running = cursor.fetchall()
+            for job_id, job_owner, changetime in running:
+                dead = self._is_dead(job_owner)
+                if dead or (dead is None and changetime < now - self.stale_delay):
+                    cursor.execute("""
+                        UPDATE artus_job SET status='queued', owner=''
+                        WHERE id=%s AND status='running'
+                        """, (job_id,))
+            cursor.execute("SELECT COUNT(*) FROM artus_job WHERE status='running'")
+            if cursor.fetchone()[0] >= self.get_max_workers():
+                return None
+            cursor.execute("""
+                SELECT id, kind, authname, args, attempts FROM artus_job
+                WHERE status='queued' ORDER BY id LIMIT 1
+                """)
+            row = cursor.fetchone()
+            if not row:
+                return None
+            cursor.execute("""
+                UPDATE artus_job SET status='running', owner=%s, changetime=%s,
+                    attempts=attempts+1
+                WHERE id=%s AND status='queued'
+                """, (owner, now, row[0]))
+            if cursor.rowcount != 1:
+                # Claimed by another process
+                return None
+        job = dict(zip(('id', 'kind', 'authname', 'args', 'attempts'), row))
+        job['args'] = json.loads(job['args'])
+        # Started before: staged work is reused
+        job['resume'] = job['attempts'] > 0
+        return job
+
+    def _run_job(self, job, owner):
+        progress = JobProgress(self, job['id'])
+        stopped = threading.Event()
+
+        def heartbeat():
+            while not stopped.wait(self.heartbeat_interval):
+                try:
+                    with self.env.db_transaction as db:
+                        db("""
+                            UPDATE artus_job SET changetime=%s
+                            WHERE id=%s AND owner=%s AND status='running'
+                            """, (int(time.time()), job['id'], owner))
+                except Exception as e:
+                    syslog.syslog("PDF jobs: job %s heartbeat failed: %s" % (job['id'], e))
+
+        thread = threading.Thread(target=heartbeat, name='artus-pdf-jobs-heartbeat')
+        thread.daemon = True
+        thread.start()
+        try:
+            self._do_job(job, progress)
+        finally:
+            stopped.set()
+
+    def _do_job(self, job, progress):
+        try:
+            if job['kind'] == 'pdf_package':
+                status, message = self._run_pdf_package(job, progress)
+            elif job['kind'] == 'pdf_print':
+                status, message = self._run_pdf_print(job, progress)
+            else:
+                status, message = 'failed', 'Unknown job kind: %s' % job['kind']
+        except Exception as e:
+            status, message = 'failed', '%s' % e
+            syslog.syslog("PDF jobs: job %s (%s) failed: %s" % (job['id'], job['kind'], e))
+        self._update_job(job['id'], status=status, message=message)
+
+    def _run_pdf_package(self, job, progress):
+        from artusplugin import cache
+        args = job['args']
+        pdf_package = cache.PDFPackage(self.env,
+                                       job['authname'],
+                                       args['pdf_list'],
+                                       args['pdf_rename'],
+                                       args['max_size'],
+                                       args['prf_chklst'],
+                                       args['source_files'],
+                                       args.get('package_name'))
+        if not args.get('package_name'):
+            # The package name is kept for a resume
+            args['package_name'] = pdf_package.package_name
+            self._update_job(job['id'], args=json.dumps(args))
+        pdf_package.build(progress, job['resume'])
+        if pdf_package.build_result == 'cancelled':
+            return 'cancelled', ''
+        pdf_package.notify(self.compmgr)
+        if pdf_package.build_result == 'success':
+            return 'done', '%s/%s' % (os.path.basename(pdf_package.base_dir), pdf_package.package_name)
+        return 'failed', pdf_package.build_message
+
+    def _run_pdf_print(self, job, progress):
+        from artusplugin import form
+        args = job['args']
+        if not args.get('package_name'):
+            # The package name is kept for a resume
+            args['package_name'] = form.TicketForm.get_pdf_print_name(self.trac_env_name, job['authname'])
+            self._update_job(job['id'], args=json.dumps(args))
+        result = form.TicketForm.tickets_pdf_convert(self.env,
+                                                     self.trac_env_name,
+                                                     job['authname'],
+                                                     args['ticket_list'],
+                                                     args['package_name'],
+                                                     progress)
+        if result == 'cancelled':
+            return 'cancelled', ''
+        return 'done', args['package_name']
+
+    def _update_job(self, job_id, **fields):
+        fields['changetime'] = int(time.time())
+        names = sorted(fields)
+        with self.env.db_transaction as db:
+            db("UPDATE artus_job SET %s WHERE id=%%s" % ', '.join('%s=%%s' % name for name in names),
+               [fields[name] for name in names] + [job_id])
+
+    def _is_cancelled(self, job_id):
+        for cancel, in self.env.db_query("SELECT cancel FROM artus_job WHERE id=%s", (job_id,)):
+            return bool(cancel)
+        return True
+
+
+class JobProgress(object):
+    """ Progress callback given to the jobs:
+        progress(phase, done, total, bytes_written) returns False
+        when the job has been cancelled """
+
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+        self.last_update = 0
+        self.cancelled = False
+
+    def __call__(self, phase, done, total, bytes_written=0):
+        now = time.time()
+        if now - self.last_update >= self.queue.progress_interval or done == total:
+            self.last_update = now
+            self.queue._update_job(self.job_id, phase=phase, done=done,
+                                   total=total, bytes=bytes_written)
+            self.cancelled = self.queue._is_cancelled(self.job_id)
+        return not self.cancelled
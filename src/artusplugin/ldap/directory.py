@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" Directory client shared by the threads of a process (python-ldap)
+
+Bound LDAP connections to the MEGGITT and ARTUS directories are kept in
+pools and reused by the lookups, a connection being bound again when the
+server has dropped it. Users are looked up in bulk: one OR-filter search
+for a batch of users.
+"""
+
+# Standard lib
+import ldap
+import os
+import queue
+import syslog
+import threading
+from contextlib import contextmanager
+from ldap.filter import escape_filter_chars
+
+# MEGGITT and ARTUS LDAP
+from artusplugin.ldap.meggitt_ldap import data as MEGGITT_ldap_data
+from artusplugin.ldap.artus_ldap import data as ARTUS_ldap_data
+
+# Users per search
+BATCH_SIZE = 100
+# Seconds allowed to connect and for a search (a hung server does not
+# block the worker for ever)
+NETWORK_TIMEOUT = 10
+SEARCH_TIMEOUT = 30
+
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class LdapPool(object):
+    """ Bound connections to a directory """
+
+    def __init__(self, uri, bind_username, bind_password, size=4):
+        self.uri = uri
+        self.bind_username = bind_username
+        self.bind_password = bind_password
+        self.connections = queue.LifoQueue(size)
+
+    def _connect(self):
+        connection = ldap.initialize(self.uri)
+        connection.protocol_version = ldap.VERSION3
+        connection.set_option(ldap.OPT_REFERRALS, 0)
+        connection.set_option(ldap.OPT_NETWORK_TIMEOUT, NETWORK_TIMEOUT)
+        connection.set_option(ldap.OPT_TIMEOUT, SEARCH_TIMEOUT)
+        connection.simple_bind_s(self.bind_username, self.bind_password)
+        return connection
+
+    @contextmanager
+    def connection(self):
+        try:
+            connection = self.connections.get_nowait()
+        except queue.Empty:
+            connection = self._connect()
+        try:
+            yield connection
+        except ldap.LDAPError:
+            # Not reused
+            try:
+                connection.unbind_s()
+            except ldap.LDAPError:
+                pass
+            raise
+        else:
+            try:
+                self.connections.put_nowait(connection)
+            except queue.Full:
+                connection.unbind_s()
+
+    def search(self, base_dn, scope, search_filter, attrs):
+        """ Returns the (dn, attrs) entries found
+            The search is done again on a new connection if the server was lost """
+        for attempt in (1, 2):
+            try:
+                with self.connection() as connection:
+                    return [(dn, entry) for dn, entry in
+                            connection.search_st(base_dn, scope, search_filter, attrs,
+                                                 timeout=SEARCH_TIMEOUT)
+                            if dn]
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT) as e:
+                syslog.syslog("LDAP %s: %s%s" % (self.uri, e, ', reconnecting' if attempt == 1 else ''))
+                if attempt == 2:
+                    raise
+
+
+class Directory(object):
+    """ MEGGITT and ARTUS directories """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        """ Directory of the current process """
+        with cls._instance_lock:
+            # Connections are not shared with forked processes
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.meggitt = LdapPool("ldap://%s:389" % MEGGITT_ldap_data['server_name'],
+                                MEGGITT_ldap_data['bind_username'],
+                                MEGGITT_ldap_data['bind_password'])
+        self.artus = LdapPool("ldap://%s:389 ldap://%s:389" % (ARTUS_ldap_data['main_server'],
+                                                               ARTUS_ldap_data['secondary_server']),
+                              ARTUS_ldap_data['bind_username'],
+                              ARTUS_ldap_data['bind_password'])
+
+    @staticmethod
+    def _batches(userids):
+        userids = sorted(set(userids))
+        for i in range(0, len(userids), BATCH_SIZE):
+            yield userids[i:i + BATCH_SIZE]
+
+    def lookup_meggitt(self, userids):
+        """ Users of the MEGGITT directory (artus users, then artus external users)
+            Returns {userid: {'mail': ..., 'mailNickname': ..., 'displayName': ...}}
+            for the users found, userid matching mailNickname or <mailNickname>.external """
+        found = {}
+        for batch in self._batches(userids):
+            by_nickname = {}
+            for userid in batch:
+                by_nickname[userid.lower()] = userid
+                by_nickname['%s.external' % userid.lower()] = userid
+            search_filter = "(&(objectClass=user)(|%s))" % ''.join(
+                "(mailNickname=%s)" % escape_filter_chars(nickname) for nickname in sorted(by_nickname))
+            for base_dn in (MEGGITT_ldap_data['artus_users'],
+                            MEGGITT_ldap_data['artus_external_users']):
+                for dn, entry in self.meggitt.search(base_dn, ldap.SCOPE_ONELEVEL, search_filter,
+                                                     ['mail', 'mailNickname', 'displayName']):
+                    attrs = dict((name, _text(entry[name][0]) if entry.get(name) else None)
+                                 for name in ('mail', 'mailNickname', 'displayName'))
+                    userid = by_nickname.get((attrs['mailNickname'] or '').lower())
+                    if userid and userid not in found:
+                        found[userid] = attrs
+        return found
+
+    def lookup_artus(self, userids):
+        """ Users of the ARTUS directory
+            Returns {userid: mail} for the users found, userid matching sAMAccountName """
+        found = {}
+        for batch in self._batches(userids):
+            by_account = dict((userid.lower(), userid) for userid in batch)
+            search_filter = "(|%s)" % ''.join(
+                "(sAMAccountName=%s)" % escape_filter_chars(userid) for userid in batch)
+            for dn, entry in self.artus.search(ARTUS_ldap_data['basedn'], ldap.SCOPE_SUBTREE,
+                                               search_filter, ['mail', 'sAMAccountName']):
+                account = _text(entry['sAMAccountName'][0]) if entry.get('sAMAccountName') else ''
+                userid = by_account.get(account.lower())
+                if userid:
+                    found[userid] = _text(entry['mail'][0]) if entry.get('mail') else None
+        return found
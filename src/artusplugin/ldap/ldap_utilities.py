@@ -5,16 +5,67 @@
 # import ConfigParser
 # from backports import configparser as ConfigParser
 import configparser as ConfigParser
+import os
+import threading
 
 # MEGGITT and ARTUS LDAP
-from artusplugin.ldap.meggitt_ldap import Meggitt_Ldap
-from artusplugin.ldap.artus_ldap import Artus_Ldap
+from artusplugin.ldap.directory import Directory
+
+
+class TranslationMap(object):
+    """ Sections of a translation file, shared by the threads of the process
+        and parsed again only when the file modification time changes
+
+    The user-translation section (fname = forename.name) is also
+    available reversed (forename.name -> fname).
+    """
+
+    _maps = {}
+    _maps_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, path):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        with cls._maps_lock:
+            translation_map = cls._maps.get(path)
+            if translation_map is None or translation_map.mtime != mtime:
+                translation_map = cls._maps[path] = cls(path, mtime)
+        return translation_map
+
+    def __init__(self, path, mtime):
+        self.mtime = mtime
+        parser = ConfigParser.RawConfigParser()
+        parser.read(path)
+        self.sections = dict((section, dict(parser.items(section)))
+                             for section in parser.sections())
+        # Options are lower case (ConfigParser)
+        self.users = self.sections.get('user-translation', {})
+        self.reverse_users = dict((forename_name.lower(), fname)
+                                  for fname, forename_name in self.users.items())
+
+    def get_section(self, section):
+        return self.sections.get(section, {})
+
+    def get_meggitt_id(self, fname):
+        """ forename.name of fname, None if not translated """
+        return self.users.get(fname.lower())
+
+    def get_fname(self, forename_name):
+        """ fname of forename.name, None if not translated """
+        return self.reverse_users.get(forename_name.lower())
+
 
 class Ldap_Utilities(object):
+    """ Lookups of users in the MEGGITT and ARTUS directories
+        (see directory.Directory for the shared connections) """
 
     def __init__(self):
         # email conversion
         self.MEGGITT_TRANSLATION = '/srv/svn/access_right/meggitt-translation.conf'
+        self.directory = Directory.get()
 
     def __enter__(self):
         return self
@@ -26,55 +77,59 @@ class Ldap_Utilities(object):
         if '.' in userid:
             # Already a MEGGITT user id
             return userid
-        try:
-            meggitt_translation = ConfigParser.ConfigParser()
-            meggitt_translation.read(self.MEGGITT_TRANSLATION)
-            return meggitt_translation.get(
-                'user-translation', userid)
-        except ConfigParser.NoOptionError:
-            return None
+        return TranslationMap.get(self.MEGGITT_TRANSLATION).get_meggitt_id(userid)
+
+    def get_fname(self, userid):
+        if '.' not in userid:
+            # Already an ARTUS user id
+            return userid
+        return TranslationMap.get(self.MEGGITT_TRANSLATION).get_fname(userid)
+
+    def get_users(self, userids):
+        """ Bulk lookup: {userid: {'mail': ..., 'displayName': ...}}
+            for the users found in the directories
+            - forename.name: MEGGITT directory
+            - fname: ARTUS directory, else MEGGITT directory through
+              the translation of fname into forename.name """
+        users = {}
+        fnames = [userid for userid in userids if '.' not in userid]
+        artus_mails = self.directory.lookup_artus(fnames) if fnames else {}
+        for userid, mail in artus_mails.items():
+            users[userid] = {'mail': mail, 'displayName': None}
+        meggitt_ids = {}
+        for userid in userids:
+            if userid not in artus_mails:
+                forename_name = self.get_meggitt_id(userid)
+                if forename_name:
+                    meggitt_ids.setdefault(forename_name, []).append(userid)
+        if meggitt_ids:
+            for forename_name, attrs in self.directory.lookup_meggitt(list(meggitt_ids)).items():
+                for userid in meggitt_ids[forename_name]:
+                    users[userid] = {'mail': attrs['mail'],
+                                     'displayName': attrs['displayName']}
+        return users
+
     def user_exists(self, userid):
-        with Meggitt_Ldap() as mgt_ldap:
-            with Artus_Ldap() as art_ldap:
-                if '.' in userid:
-                    # forename.name
-                    return mgt_ldap.exist_in_MEGGITT_AD(userid)
-                else:
-                    # fname
-                    if art_ldap.exist_in_ARTUS_AD(userid):
-                        return True
-                    else:
-                        forename_name = self.get_meggitt_id(userid)
-                        if forename_name:
-                            return mgt_ldap.exist_in_MEGGITT_AD(forename_name)
-                        else:
-                            return False
-                        
+        return userid in self.get_users([userid])
+
+    def get_meggitt_mails(self, userids):
+        """ {userid: mail} for the users found in the directories """
+        return dict((userid, attrs['mail']) for userid, attrs in self.get_users(userids).items())
+
     def get_meggitt_mail(self, userid):
-        with Meggitt_Ldap() as mgt_ldap:
-            with Artus_Ldap() as art_ldap:
-                if '.' in userid:
-                    # forename.name
-                    return mgt_ldap.get_meggitt_mail(userid)
-                else:
-                    # fname
-                    if art_ldap.exist_in_ARTUS_AD(userid):
-                        return art_ldap.get_artus_mail(userid)
-                    else:
-                        forename_name = self.get_meggitt_id(userid)
-                        if forename_name:
-                            return mgt_ldap.get_meggitt_mail(forename_name)
-                        else:
-                            return None
+        return self.get_meggitt_mails([userid]).get(userid)
+
+    def get_ldap_displaynames(self, userids):
+        """ {userid: displayName} for the MEGGITT user ids (mailNickname) found """
+        return dict((userid, attrs['displayName'])
+                    for userid, attrs in self.directory.lookup_meggitt(userids).items())
 
     def get_ldap_displayname(self, userid):
-        with Meggitt_Ldap() as mgt_ldap:
-            return mgt_ldap.get_ldap_displayname(userid)
-        
+        return self.get_ldap_displaynames([userid]).get(userid)
+
     def user_is_external(self, userid):
         meggitt_mail = self.get_meggitt_mail(userid)
         if meggitt_mail:
-            return '.external@' in self.get_meggitt_mail(userid)
+            return '.external@' in meggitt_mail
         else:
             return False
-
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Artus
+# All rights reserved.
+#
+# Author: Michel Guillot <michel.guillot@meggitt.com>
+
+""" In-memory editing of Office Open XML packages (docx/docm) """
+
+# Standard lib
+import copy
+import fnmatch
+import hashlib
+import io
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from xml.dom.minidom import parseString
+from xml.etree import ElementTree
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP64_LIMIT
+
+# 3rd party modules
+from lxml import etree
+
+__all__ = ['OOXMLPackage', 'TemplateArtefacts', 'TemplateCache']
+
+# Local file header: signature (4), version (2), flags (2), method (2), time (2), date (2),
+# crc (4), sizes (4 + 4), name length (2), extra length (2)
+_LOCAL_HEADER_SIZE = 30
+_MASK_USE_DATA_DESCRIPTOR = 0x08
+
+
+class OOXMLPackage(object):
+    """ Office Open XML package opened for editing
+
+    Changed parts are kept in memory and only them are compressed when
+    the package is saved: the other members are copied as is
+    (no decompression/recompression) into the new archive, which then
+    replaces the package.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = ZipFile(path)
+        # part name -> new content (bytes) or None if removed
+        self.changes = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def namelist(self):
+        names = [name for name in self.zip.namelist()
+                 if name not in self.changes or self.changes[name] is not None]
+        names += [name for name, data in self.changes.items()
+                  if data is not None and name not in names]
+        return names
+
+    def read(self, name):
+        if name in self.changes:
+            if self.changes[name] is None:
+                raise KeyError(name)
+            return self.changes[name]
+        return self.zip.read(name)
+
+    def write(self, name, data):
+        self.changes[name] = data
+
+    def remove(self, name):
+        self.changes[name] = None
+
+    @property
+    def modified(self):
+        return bool(self.changes)
+
+    # Operations
+
+    def find_customxml(self, root_tags):
+        """ Name of the custom XML part whose root is one of root_tags """
+        for name in self.namelist():
+            if re.match(r'customXml/item\d+\.xml$', name):
+                if ElementTree.fromstring(self.read(name)).tag in root_tags:
+                    return name
+        return None
+
+    def upgrade_namespace(self, name, legacy_urls, url):
+        """ Replace in the part the first legacy url found on each line by url
+            Return True if the part has changed """
+        content = self.read(name).decode('utf-8')
+        lines = []
+        for line in content.splitlines(True):
+            for legacy_url in legacy_urls:
+                if legacy_url and legacy_url in line:
+                    line = line.replace(legacy_url, url)
+                    break
+            lines.append(line)
+        new_content = ''.join(lines)
+        if new_content != content:
+            self.write(name, new_content.encode('utf-8'))
+            return True
+        return False
+
+    def swap_parts(self, source_parts, patterns):
+        """ Replace the parts matching the patterns (eg 'word/vbaProject*.bin')
+            by the source parts (eg the VBA project of a template, see
+            TemplateArtefacts.get_parts)
+            Return the names of the copied parts """
+        for name in self.namelist():
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                self.remove(name)
+        copied = []
+        for name, data in source_parts.items():
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                self.write(name, data)
+                copied.append(name)
+        return copied
+
+    def rewrite_data_bindings(self, legacy_urls, url):
+        """ Replace legacy urls by url in the prefix mappings of the data bindings
+            of the document and footers """
+        for name in ['word/document.xml'] + fnmatch.filter(self.namelist(), 'word/footer[1-99].xml'):
+            xml_root = etree.fromstring(self.read(name))
+            xml_ns = xml_root.nsmap['w']
+            for data_binding in xml_root.findall('.//w:dataBinding', xml_root.nsmap):
+                prefix_mappings = data_binding.get('{%s}prefixMappings' % xml_ns)
+                if prefix_mappings:
+                    for legacy_url in legacy_urls:
+                        if legacy_url and legacy_url in prefix_mappings:
+                            prefix_mappings = prefix_mappings.replace(legacy_url, url)
+                            break
+                    data_binding.set('{%s}prefixMappings' % xml_ns, prefix_mappings)
+            self.write(name, etree.tostring(etree.ElementTree(xml_root)))
+
+    # Saving
+
+    def save(self):
+        """ Write the package with its changes, unchanged members being copied raw """
+        if not self.changes:
+            return
+        written = set()
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(self.path))
+        os.close(fd)
+        try:
+            with ZipFile(tmp_path, 'w', ZIP_DEFLATED) as out_zip:
+                for info in self.zip.infolist():
+                    if info.filename in self.changes:
+                        data = self.changes[info.filename]
+                        if data is not None:
+                            self._write_part(out_zip, info.filename, data, info)
+                            written.add(info.filename)
+                    else:
+                        self._copy_raw(self.zip, out_zip, info)
+                for name, data in self.changes.items():
+                    if data is not None and name not in written:
+                        self._write_part(out_zip, name, data)
+            shutil.copymode(self.path, tmp_path)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.zip.close()
+        self.zip = ZipFile(self.path)
+        self.changes = OrderedDict()
+
+    @staticmethod
+    def _write_part(out_zip, name, data, info=None):
+        if info is not None:
+            new_info = copy.copy(info)
+            new_info.compress_type = ZIP_DEFLATED
+            new_info.extra = b''
+        else:
+            new_info = name
+        out_zip.writestr(new_info, data, ZIP_DEFLATED)
+
+    @staticmethod
+    def _copy_raw(in_zip, out_zip, info):
+        """ Copy a member with its compressed data as is """
+        in_zip.fp.seek(info.header_offset)
+        header = in_zip.fp.read(_LOCAL_HEADER_SIZE)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        in_zip.fp.seek(info.header_offset + _LOCAL_HEADER_SIZE + name_length + extra_length)
+        new_info = copy.copy(info)
+        # Sizes and CRC are known: no data descriptor
+        new_info.flag_bits &= ~_MASK_USE_DATA_DESCRIPTOR
+        new_info.extra = b''
+        out_zip.fp.seek(out_zip.start_dir)
+        new_info.header_offset = out_zip.fp.tell()
+        zip64 = info.file_size > ZIP64_LIMIT or info.compress_size > ZIP64_LIMIT
+        out_zip.fp.write(new_info.FileHeader(zip64))
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = in_zip.fp.read(min(remaining, 1 << 20))
+            if not chunk:
+                raise IOError('Truncated member %s' % info.filename)
+            out_zip.fp.write(chunk)
+            remaining -= len(chunk)
+        out_zip.filelist.append(new_info)
+        out_zip.NameToInfo[new_info.filename] = new_info
+        out_zip.start_dir = out_zip.fp.tell()
+        out_zip._didModify = True
+
+    # Extracted packages
+
+    def extract_all(self, dir_path):
+        """ Extract the package (with its changes) into dir_path """
+        if os.path.exists(dir_path):
+            shutil.rmtree(dir_path)
+        os.makedirs(dir_path)
+        for name in self.namelist():
+            if name.endswith('/'):
+                continue
+            file_path = os.path.join(dir_path, name)
+            if not os.path.isdir(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            if name in self.changes:
+                with open(file_path, 'wb') as f:
+                    f.write(self.changes[name])
+            else:
+                with self.zip.open(name) as source, open(file_path, 'wb') as f:
+                    shutil.copyfileobj(source, f, 1 << 20)
+
+    def load_dir(self, dir_path):
+        """ Take the content of dir_path (see extract_all) as the new content
+            of the package: only the files whose content differs from the
+            package members are recorded as changes """
+        names = set()
+        for root, dirnames, filenames in os.walk(dir_path):
+            for filename in filenames:
+                file_path = os.path.join(root, filename)
+                name = os.path.relpath(file_path, dir_path).replace(os.sep, '/')
+                names.add(name)
+                try:
+                    info = self.zip.getinfo(name)
+                except KeyError:
+                    info = None
+                if info is not None and info.file_size == os.path.getsize(file_path):
+                    crc = 0
+                    with open(file_path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(1 << 20), b''):
+                            crc = zlib.crc32(chunk, crc)
+                    if crc == info.CRC:
+                        continue
+                with open(file_path, 'rb') as f:
+                    self.write(name, f.read())
+        for name in self.zip.namelist():
+            if not name.endswith('/') and name not in names:
+                self.remove(name)
+
+
+class TemplateArtefacts(object):
+    """ Custom XML and VBA parts of a template, extracted once
+
+    The parsed custom XML elements and documents are shared:
+    they must not be modified by the callers.
+    """
+
+    # Parts kept from the template
+    patterns = ('customXml/item*.xml', '*/vbaProject*.bin', '*/vbaData.xml')
+
+    def __init__(self, source):
+        # source is a file path or the content of the template
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        self.parts = OrderedDict()
+        with ZipFile(source) as template_zip:
+            for name in template_zip.namelist():
+                if any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns):
+                    self.parts[name] = template_zip.read(name)
+        self._customxml = {}
+        self._lock = threading.Lock()
+
+    def _find_customxml(self, root_tags):
+        key = tuple(root_tags)
+        with self._lock:
+            if key not in self._customxml:
+                self._customxml[key] = None
+                for name, data in self.parts.items():
+                    if re.match(r'customXml/item\d+\.xml$', name):
+                        root_elt = ElementTree.fromstring(data)
+                        if root_elt.tag in root_tags:
+                            self._customxml[key] = [name, root_elt, None]
+                            break
+            return self._customxml[key]
+
+    def get_customxml_name(self, root_tags):
+        customxml = self._find_customxml(root_tags)
+        return customxml[0] if customxml else None
+
+    def get_customxml_root_elt(self, root_tags):
+        """ Root element (ElementTree) of the custom XML """
+        customxml = self._find_customxml(root_tags)
+        return customxml[1] if customxml else None
+
+    def get_customxml_dom(self, root_tags):
+        """ DOM (minidom) of the custom XML """
+        customxml = self._find_customxml(root_tags)
+        if not customxml:
+            return None
+        with self._lock:
+            if customxml[2] is None:
+                customxml[2] = parseString(self.parts[customxml[0]])
+            return customxml[2]
+
+    def get_parts(self, patterns):
+        return OrderedDict((name, data) for name, data in self.parts.items()
+                           if any(fnmatch.fnmatch(name, pattern) for pattern in patterns))
+
+    def get_md5(self, name):
+        return hashlib.md5(self.parts[name]).hexdigest()
+
+
+class TemplateCache(object):
+    """ Process-wide cache of the template artefacts
+
+    Templates on disk are keyed by their real path, checked against
+    their mtime and size; templates in the repository are keyed
+    by their path and last changed revision.
+    """
+
+    max_entries = 64
+
+    _entries = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, template_path):
+        """ Artefacts of the template file """
+        real_path = os.path.realpath(template_path)
+        st = os.stat(real_path)
+        return cls._get(real_path, (st.st_mtime, st.st_size),
+                        lambda: TemplateArtefacts(real_path))
+
+    @classmethod
+    def get_node(cls, node):
+        """ Artefacts of the template repository node """
+        key = 'repos:%s:%s' % (node.repos.reponame, node.path)
+        return cls._get(key, node.rev,
+                        lambda: TemplateArtefacts(node.get_content().read()))
+
+    @classmethod
+    def _get(cls, key, stamp, loader):
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry and entry[0] == stamp:
+                cls._entries.move_to_end(key)
+                return entry[1]
+        # Loaded outside the lock: a concurrent load only wastes time
+        artefacts = loader()
+        with cls._lock:
+            cls._entries[key] = (stamp, artefacts)
+            cls._entries.move_to_end(key)
+            while len(cls._entries) > cls.max_entries:
+                cls._entries.popitem(last=False)
+        return artefacts
+
+    @classmethod
+    def invalidate(cls, template_path=None):
+        """ Forget the template (all templates if None) """
+        with cls._lock:
+            if template_path is None:
+                cls._entries.clear()
+            else:
+                cls._entries.pop(os.path.realpath(template_path), None)
@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Artus
+# All rights reserved.
+#
+# Author: Michel Guillot <michel.guillot@meggitt.com>
+
+""" Embedding of files into a PDF document as an incremental update
+
+The original document is copied as is and the embedded files, the
+EmbeddedFiles name tree and the updated catalog are appended with a
+new cross-reference section, so that existing objects (pages,
+bookmarks, signatures...) are kept untouched. Contents are streamed:
+neither the document nor the attachments are held in memory.
+
+Documents which cannot be updated this way (encrypted, already holding
+embedded files, unsupported cross-reference filters, malformed) raise
+PDFUpdateError.
+
+Benchmark:
+    python -m artusplugin.pdfattach <input.pdf> <output.pdf> <attachment>...
+"""
+
+# Standard lib
+import os
+import re
+import shutil
+import sys
+import time
+import zlib
+from collections import OrderedDict
+
+__all__ = ['PDFUpdateError', 'attach_files']
+
+WHITESPACE = b'\x00\t\n\x0c\r '
+DELIMITERS = b'()<>[]{}/%'
+CHUNK_SIZE = 1 << 20
+
+
+class PDFUpdateError(Exception):
+    pass
+
+
+class Raw(bytes):
+    """ Atom kept as written (number, name, string, boolean, null) """
+
+
+class Ref(object):
+
+    def __init__(self, num, gen):
+        self.num = num
+        self.gen = gen
+
+
+class Name(bytes):
+    pass
+
+
+# Parsing
+
+def _skip(data, pos):
+    """ Skip white spaces and comments """
+    while pos < len(data):
+        c = data[pos:pos + 1]
+        if not c or c not in WHITESPACE + b'%':
+            break
+        if c == b'%':
+            while pos < len(data) and data[pos:pos + 1] not in b'\r\n':
+                pos += 1
+        else:
+            pos += 1
+    return pos
+
+
+def _token_end(data, pos):
+    while pos < len(data) and data[pos:pos + 1] not in WHITESPACE + DELIMITERS:
+        pos += 1
+    return pos
+
+
+def _parse_literal_string(data, pos):
+    depth = 0
+    start = pos
+    while pos < len(data):
+        c = data[pos:pos + 1]
+        if c == b'\\':
+            pos += 2
+            continue
+        if c == b'(':
+            depth += 1
+        elif c == b')':
+            depth -= 1
+            if depth == 0:
+                return Raw(data[start:pos + 1]), pos + 1
+        pos += 1
+    raise PDFUpdateError('Unterminated string')
+
+
+def parse_object(data, pos):
+    """ Returns the object starting at pos and the position after it """
+    pos = _skip(data, pos)
+    c = data[pos:pos + 1]
+    if not c:
+        raise PDFUpdateError('Unexpected end of data')
+    if data.startswith(b'<<', pos):
+        pos += 2
+        items = OrderedDict()
+        while True:
+            pos = _skip(data, pos)
+            if data.startswith(b'>>', pos):
+                return items, pos + 2
+            key, pos = parse_object(data, pos)
+            if not isinstance(key, Name):
+                raise PDFUpdateError('Invalid dictionary key')
+            items[bytes(key)], pos = parse_object(data, pos)
+    if c == b'[':
+        pos += 1
+        items = []
+        while True:
+            pos = _skip(data, pos)
+            if data.startswith(b']', pos):
+                return items, pos + 1
+            item, pos = parse_object(data, pos)
+            items.append(item)
+    if c == b'(':
+        return _parse_literal_string(data, pos)
+    if c == b'<':
+        end = data.find(b'>', pos)
+        if end < 0:
+            raise PDFUpdateError('Unterminated hex string')
+        return Raw(data[pos:end + 1]), end + 1
+    if c == b'/':
+        end = _token_end(data, pos + 1)
+        return Name(data[pos + 1:end]), end
+    end = _token_end(data, pos)
+    if end == pos:
+        raise PDFUpdateError('Unexpected character %r' % c)
+    token = data[pos:end]
+    if re.match(br'^\d+$', token):
+        # Indirect reference ?
+        m = re.compile(br'\s+(\d+)\s+R(?=[\s/<>\[\]()%]|$)').match(data, end)
+        if m:
+            return Ref(int(token), int(m.group(1))), m.end()
+    return Raw(token), end
+
+
+def serialize(value):
+    if isinstance(value, Name):
+        return b'/' + value
+    if isinstance(value, Raw):
+        return bytes(value)
+    if isinstance(value, Ref):
+        return b'%d %d R' % (value.num, value.gen)
+    if isinstance(value, list):
+        return b'[' + b' '.join(serialize(item) for item in value) + b']'
+    if isinstance(value, dict):
+        return b'<<' + b''.join(b'/' + key + b' ' + serialize(item)
+                                for key, item in value.items()) + b'>>'
+    if isinstance(value, int):
+        return b'%d' % value
+    if isinstance(value, bytes):
+        return value
+    raise PDFUpdateError('Cannot serialize %r' % value)
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise PDFUpdateError('Integer expected')
+
+
+def pdf_string(text):
+    """ Text string (UTF-16BE hexadecimal string with BOM) """
+    return Raw(b'<' + (u'\ufeff' + text).encode('utf-16-be').hex().upper().encode('ascii') + b'>')
+
+
+class PDFReader(object):
+    """ Reads the cross-reference sections and the objects of a PDF file """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.fp.seek(0, os.SEEK_END)
+        self.size = self.fp.tell()
+        # object number -> (1, offset, gen) or (2, object stream number, index)
+        self.xref = {}
+        self.trailer = None
+        self.startxref = self._find_startxref()
+        self.xref_stream = False
+        self._object_streams = {}
+        offset = self.startxref
+        seen = set()
+        while offset is not None and offset not in seen:
+            seen.add(offset)
+            offset = self._read_xref_section(offset)
+
+    def _read(self, offset, size):
+        self.fp.seek(offset)
+        return self.fp.read(size)
+
+    def _find_startxref(self):
+        tail = self._read(max(0, self.size - 2048), 2048)
+        pos = tail.rfind(b'startxref')
+        if pos < 0:
+            raise PDFUpdateError('startxref not found')
+        m = re.compile(br'startxref\s+(\d+)').match(tail, pos)
+        if not m:
+            raise PDFUpdateError('Invalid startxref')
+        return int(m.group(1))
+
+    def _read_xref_section(self, offset):
+        """ Returns the offset of the previous section """
+        data = self._read(offset, 64)
+        if data.startswith(b'xref'):
+            trailer = self._read_xref_table(offset)
+        else:
+            trailer = self._read_xref_stream(offset)
+            if self.trailer is None:
+                self.xref_stream = True
+        if self.trailer is None:
+            self.trailer = trailer
+        if b'XRefStm' in trailer:
+            # Hybrid file
+            self._read_xref_stream(_int(trailer[b'XRefStm']))
+        return _int(trailer[b'Prev']) if b'Prev' in trailer else None
+
+    def _read_xref_table(self, offset):
+        self.fp.seek(offset)
+        self.fp.readline()
+        while True:
+            line = self.fp.readline()
+            if not line:
+                raise PDFUpdateError('Truncated xref table')
+            fields = line.split()
+            if not fields:
+                continue
+            if fields[0].startswith(b'trailer'):
+                trailer_offset = self.fp.tell() - len(line) + line.find(b'trailer') + 7
+                trailer, end = parse_object(self._read(trailer_offset, 65536), 0)
+                return trailer
+            if len(fields) < 2:
+                raise PDFUpdateError('Invalid xref subsection')
+            first, count = _int(fields[0]), _int(fields[1])
+            entries = self.fp.read(20 * count)
+            for i in range(count):
+                entry = entries[20 * i:20 * i + 20].split()
+                if len(entry) < 3:
+                    raise PDFUpdateError('Invalid xref entry')
+                if first + i not in self.xref and entry[2] == b'n':
+                    self.xref[first + i] = (1, _int(entry[0]), _int(entry[1]))
+                elif first + i not in self.xref:
+                    self.xref[first + i] = (0, 0, 0)
+
+    def _read_object_at(self, offset):
+        """ Returns (object number, dictionary or value, stream data or None) """
+        data = self._read(offset, 65536)
+        while True:
+            try:
+                m = re.compile(br'\s*(\d+)\s+(\d+)\s+obj').match(data)
+                if not m:
+                    raise PDFUpdateError('Object not found at %s' % offset)
+                value, pos = parse_object(data, m.end())
+                break
+            except PDFUpdateError:
+                if len(data) >= self.size - offset:
+                    raise
+                data = self._read(offset, len(data) * 4)
+        stream = None
+        pos = _skip(data, pos)
+        if isinstance(value, dict) and data.startswith(b'stream', pos):
+            pos += 6
+            if data.startswith(b'\r\n', pos):
+                pos += 2
+            elif data.startswith(b'\n', pos) or data.startswith(b'\r', pos):
+                pos += 1
+            length = value.get(b'Length')
+            if isinstance(length, Ref):
+                length = self.get_object(length.num)
+            stream = self._read(offset + pos, _int(length))
+        return int(m.group(1)), value, stream
+
+    def _decode(self, value, stream):
+        filters = value.get(b'Filter')
+        if filters is None:
+            filters = []
+        elif not isinstance(filters, list):
+            filters = [filters]
+        params = value.get(b'DecodeParms')
+        if isinstance(params, list):
+            params = params[0] if params else None
+        for name in filters:
+            if bytes(name) != b'FlateDecode':
+                raise PDFUpdateError('Unsupported filter %s' % bytes(name))
+            stream = zlib.decompress(stream)
+        if isinstance(params, dict) and _int(params.get(b'Predictor', 1)) >= 10:
+            stream = self._unpredict(stream, _int(params.get(b'Columns', 1)))
+        return stream
+
+    @staticmethod
+    def _unpredict(data, columns):
+        """ PNG predictors """
+        rows = []
+        previous = bytearray(columns)
+        for i in range(0, len(data), columns + 1):
+            kind = data[i]
+            row = bytearray(data[i + 1:i + 1 + columns])
+            for j in range(len(row)):
+                left = row[j - 1] if j else 0
+                up = previous[j]
+                up_left = previous[j - 1] if j else 0
+                if kind == 1:
+                    row[j] = (row[j] + left) & 0xff
+                elif kind == 2:
+                    row[j] = (row[j] + up) & 0xff
+                elif kind == 3:
+                    row[j] = (row[j] + ((left + up) >> 1)) & 0xff
+                elif kind == 4:
+                    p = left + up - up_left
+                    pa, pb, pc = abs(p - left), abs(p - up), abs(p - up_left)
+                    predictor = left if pa <= pb and pa <= pc else up if pb <= pc else up_left
+                    row[j] = (row[j] + predictor) & 0xff
+            rows.append(bytes(row))
+            previous = row
+        return b''.join(rows)
+
+    def _read_xref_stream(self, offset):
+        num, value, stream = self._read_object_at(offset)
+        if not isinstance(value, dict) or bytes(value.get(b'Type', b'')) != b'XRef':
+            raise PDFUpdateError('Invalid xref stream')
+        data = self._decode(value, stream)
+        widths = [_int(w) for w in value[b'W']]
+        index = [_int(i) for i in value.get(b'Index', [0, value[b'Size']])]
+        entry_size = sum(widths)
+        pos = 0
+        for first, count in zip(index[0::2], index[1::2]):
+            for num in range(first, first + count):
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(data[pos:pos + width], 'big') if width else None)
+                    pos += width
+                kind = 1 if fields[0] is None else fields[0]
+                if num not in self.xref:
+                    self.xref[num] = (kind, fields[1] or 0, fields[2] or 0)
+            if pos > len(data) + entry_size:
+                raise PDFUpdateError('Truncated xref stream')
+        return value
+
+    def get_object(self, num):
+        entry = self.xref.get(num)
+        if entry is None or entry[0] == 0:
+            raise PDFUpdateError('Object %s not found' % num)
+        if entry[0] == 1:
+            return self._read_object_at(entry[1])[1]
+        # Compressed object
+        objects = self._get_object_stream(entry[1])
+        return objects[entry[2]]
+
+    def _get_object_stream(self, num):
+        if num not in self._object_streams:
+            entry = self.xref.get(num)
+            if entry is None or entry[0] != 1:
+                raise PDFUpdateError('Object stream %s not found' % num)
+            snum, value, stream = self._read_object_at(entry[1])
+            data = self._decode(value, stream)
+            first = _int(value[b'First'])
+            header = data[:first].split()
+            count = _int(value[b'N'])
+            if len(header) < 2 * count:
+                raise PDFUpdateError('Invalid object stream %s' % num)
+            objects = []
+            for i in range(count):
+                offset = _int(header[2 * i + 1])
+                objects.append(parse_object(data, first + offset)[0])
+            self._object_streams[num] = objects
+        return self._object_streams[num]
+
+
+# Writing
+
+class PDFUpdateWriter(object):
+    """ Appends objects and a cross-reference section to a copy of the document """
+
+    def __init__(self, fp, reader):
+        self.fp = fp
+        self.reader = reader
+        self.next_num = _int(reader.trailer[b'Size'])
+        self.offsets = {}
+
+    def new_num(self):
+        num = self.next_num
+        self.next_num += 1
+        return num
+
+    def write_object(self, num, value):
+        self.offsets[num] = self.fp.tell()
+        self.fp.write(b'%d 0 obj\n' % num)
+        self.fp.write(serialize(value))
+        self.fp.write(b'\nendobj\n')
+
+    def write_file_stream(self, num, source_path):
+        """ Embedded file stream, compressed on the fly
+            Returns the uncompressed size """
+        length_num = self.new_num()
+        self.offsets[num] = self.fp.tell()
+        self.fp.write(b'%d 0 obj\n' % num)
+        size = os.path.getsize(source_path)
+        self.fp.write(serialize(OrderedDict([
+            (b'Type', Name(b'EmbeddedFile')),
+            (b'Filter', Name(b'FlateDecode')),
+            (b'Length', Ref(length_num, 0)),
+            (b'Params', OrderedDict([(b'Size', size)]))])))
+        self.fp.write(b'\nstream\n')
+        compressor = zlib.compressobj(6)
+        length = 0
+        with open(source_path, 'rb') as source:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                compressed = compressor.compress(chunk)
+                self.fp.write(compressed)
+                length += len(compressed)
+        compressed = compressor.flush()
+        self.fp.write(compressed)
+        length += len(compressed)
+        self.fp.write(b'\nendstream\nendobj\n')
+        self.write_object(length_num, length)
+        return size
+
+    def write_xref(self, trailer):
+        trailer[b'Size'] = self.next_num
+        trailer[b'Prev'] = self.reader.startxref
+        nums = sorted(self.offsets)
+        # Subsections of consecutive objects
+        sections = []
+        for num in nums:
+            if sections and sections[-1][-1] == num - 1:
+                sections[-1].append(num)
+            else:
+                sections.append([num])
+        if self.reader.xref_stream:
+            xref_num = self.new_num()
+            trailer[b'Size'] = self.next_num
+            self.offsets[xref_num] = self.fp.tell()
+            sections.append([xref_num])
+            # Offset field wide enough for the largest offset
+            width = max(4, (max(self.offsets.values()).bit_length() + 7) // 8)
+            rows = []
+            for section in sections:
+                for num in section:
+                    rows.append(b'\x01' + self.offsets[num].to_bytes(width, 'big') + b'\x00\x00')
+            trailer[b'Type'] = Name(b'XRef')
+            trailer[b'W'] = [1, width, 2]
+            trailer[b'Index'] = [item for section in sections for item in (section[0], len(section))]
+            trailer[b'Length'] = len(rows) * (width + 3)
+            trailer.pop(b'Filter', None)
+            trailer.pop(b'DecodeParms', None)
+            self.fp.write(b'%d 0 obj\n' % xref_num)
+            self.fp.write(serialize(trailer))
+            self.fp.write(b'\nstream\n')
+            self.fp.write(b''.join(rows))
+            self.fp.write(b'\nendstream\nendobj\n')
+            startxref = self.offsets[xref_num]
+        else:
+            startxref = self.fp.tell()
+            self.fp.write(b'xref\n')
+            # Head of the free entries list
+            self.fp.write(b'0 1\n0000000000 65535 f \n')
+            for section in sections:
+                self.fp.write(b'%d %d\n' % (section[0], len(section)))
+                for num in section:
+                    self.fp.write(b'%010d 00000 n \n' % self.offsets[num])
+            self.fp.write(b'trailer\n')
+            self.fp.write(serialize(trailer))
+            self.fp.write(b'\n')
+        self.fp.write(b'startxref\n%d\n%%%%EOF\n' % startxref)
+
+
+def attach_files(pdf_input_file, attachments, pdf_output_file):
+    """ Copy pdf_input_file to pdf_output_file with the attachments
+        (list of paths) embedded and shown when the document is opened """
+    try:
+        _attach_files(pdf_input_file, attachments, pdf_output_file)
+    except (ValueError, IndexError, KeyError, TypeError, AttributeError,
+            OverflowError, RecursionError, zlib.error) as e:
+        # Malformed document
+        raise PDFUpdateError('%s: %s' % (e.__class__.__name__, e))
+
+
+def _attach_files(pdf_input_file, attachments, pdf_output_file):
+    with open(pdf_input_file, 'rb') as source:
+        reader = PDFReader(source)
+        trailer = reader.trailer
+        if b'Encrypt' in trailer:
+            raise PDFUpdateError('Encrypted document')
+        root = trailer.get(b'Root')
+        if not isinstance(root, Ref):
+            raise PDFUpdateError('Catalog not found')
+        catalog = reader.get_object(root.num)
+        if not isinstance(catalog, dict):
+            raise PDFUpdateError('Invalid catalog')
+        names = catalog.get(b'Names')
+        names_num = None
+        if isinstance(names, Ref):
+            names_num = names.num
+            names = reader.get_object(names.num)
+        if names is None:
+            names = OrderedDict()
+        if not isinstance(names, dict):
+            raise PDFUpdateError('Invalid names dictionary')
+        if b'EmbeddedFiles' in names:
+            raise PDFUpdateError('Document already holding embedded files')
+
+        with open(pdf_output_file, 'wb') as target:
+            source.seek(0)
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+            target.seek(0, os.SEEK_END)
+            target.write(b'\n')
+            writer = PDFUpdateWriter(target, reader)
+            entries = []
+            for attachment in attachments:
+                filename = os.path.basename(attachment)
+                file_num = writer.new_num()
+                size = writer.write_file_stream(file_num, attachment)
+                spec_num = writer.new_num()
+                ascii_name = filename.encode('ascii', 'replace').replace(b'\\', b'\\\\') \
+                                     .replace(b'(', b'\\(').replace(b')', b'\\)')
+                writer.write_object(spec_num, OrderedDict([
+                    (b'Type', Name(b'Filespec')),
+                    (b'F', Raw(b'(' + ascii_name + b')')),
+                    (b'UF', pdf_string(filename)),
+                    (b'EF', OrderedDict([(b'F', Ref(file_num, 0))]))]))
+                entries.append((pdf_string(filename), Ref(spec_num, 0)))
+            # Name tree keys are sorted
+            entries.sort(key=lambda entry: bytes(entry[0]))
+            tree_num = writer.new_num()
+            writer.write_object(tree_num, OrderedDict([
+                (b'Names', [item for entry in entries for item in entry])]))
+            names[b'EmbeddedFiles'] = Ref(tree_num, 0)
+            if names_num is None:
+                catalog[b'Names'] = names
+            else:
+                writer.write_object(names_num, names)
+            catalog[b'PageMode'] = Name(b'UseAttachments')
+            writer.write_object(root.num, catalog)
+            new_trailer = OrderedDict((key, value) for key, value in trailer.items()
+                                      if key in (b'Root', b'Info', b'ID'))
+            writer.write_xref(new_trailer)
+
+
+def main(argv):
+    """ Benchmark: size and throughput of the incremental update """
+    import resource
+    if len(argv) < 3:
+        sys.stderr.write('Usage: python -m artusplugin.pdfattach <input.pdf> <output.pdf> <attachment>...\n')
+        return 2
+    pdf_input_file, pdf_output_file, attachments = argv[0], argv[1], argv[2:]
+    start = time.time()
+    attach_files(pdf_input_file, attachments, pdf_output_file)
+    elapsed = time.time() - start
+    input_size = os.path.getsize(pdf_input_file)
+    attachments_size = sum(os.path.getsize(attachment) for attachment in attachments)
+    output_size = os.path.getsize(pdf_output_file)
+    processed = input_size + attachments_size
+    print('input: %d bytes, attachments: %d bytes (%d files), output: %d bytes' % (
+        input_size, attachments_size, len(attachments), output_size))
+    print('elapsed: %.3f s, throughput: %.1f MB/s, peak memory: %d kB' % (
+        elapsed, processed / 1e6 / max(elapsed, 1e-6),
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
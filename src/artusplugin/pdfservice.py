@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Artus
+# All rights reserved.
+#
+# Author: Michel Guillot <michel.guillot@meggitt.com>
+
+""" Client of the resident PDF signing/filling service
+
+The TracPdfSign and TracPdfFill tools (/srv/trac/common) are run by a
+resident service listening on a local UNIX socket (see pdfservice_daemon
+and contrib/pdfservice), so that neither sudo nor the JVM start is paid
+by each signature or form filling.
+Requests and responses are JSON lines:
+    {"cmd": "ping"}                        -> {"ok": true}
+    {"cmd": "run", "batch": [<job>, ...]}  -> {"ok": true, "results": [<result>, ...]}
+with
+    <job> = {"jar": <path>, "args": [<arg>, ...], "copy": [<from>, <to>]}
+        "copy" (optional): <from> is copied over <to>, if not empty,
+        once the tool has succeeded, with the user and group of the client
+    <result> = {"retcode": <int>, "lines": [<output line>, ...]}
+The jobs of a batch are run in turn, the first failure ending the batch.
+
+When the service cannot be reached, the tools are run as before
+(sudo /usr/bin/java -jar ...).
+Options ([artusplugin] section):
+    pdf_service_socket: socket of the service (/run/trac/pdfservice.sock)
+    pdf_service_timeout: seconds allowed for a batch (300)
+"""
+
+# Standard lib
+import base64
+import calendar
+import hashlib
+import json
+import os
+import re
+import socket
+import syslog
+import threading
+import time
+
+# Same package
+from artusplugin import util
+
+__all__ = ['CertificateValidity', 'PdfJob', 'run_jobs', 'FILL_JAR', 'SIGN_JAR']
+
+SIGN_JAR = '/srv/trac/common/TracPdfSign.jar'
+FILL_JAR = '/srv/trac/common/TracPdfFill.jar'
+
+
+class PdfServiceError(Exception):
+    pass
+
+
+class PdfServiceUnavailable(PdfServiceError):
+    """ Nothing was run """
+
+
+class PdfJob(object):
+    """ Run of a PDF tool (jar) with its arguments """
+
+    def __init__(self, jar, args, copy=None):
+        self.jar = jar
+        self.args = args
+        # (from, to): signed/filled PDF copied to the working copy
+        self.copy = copy
+
+    def to_json(self):
+        job = {'jar': self.jar, 'args': self.args}
+        if self.copy:
+            job['copy'] = list(self.copy)
+        return job
+
+    def get_unix_cmd_list(self):
+        unix_cmd_list = ['sudo /usr/bin/java -jar %s %s' % (
+            self.jar, ' '.join('"%s"' % arg for arg in self.args))]
+        if self.copy:
+            unix_cmd_list += ['if [[ -s "%s" ]] ; then cp -f "%s" "%s"; fi'
+                              % (self.copy[0], self.copy[0], self.copy[1])]
+        return unix_cmd_list
+
+
+class PdfServiceClient(object):
+    """ Connection to the service, with a health probe
+
+    The result of the probe is kept probe_delay seconds per socket,
+    so that an unavailable service does not delay each call.
+    """
+
+    probe_delay = 30
+    _probes = {}
+    _probes_lock = threading.Lock()
+
+    def __init__(self, env):
+        self.path = env.config.get('artusplugin', 'pdf_service_socket',
+                                   '/run/trac/pdfservice.sock')
+        self.timeout = env.config.getint('artusplugin', 'pdf_service_timeout', 300)
+
+    def _get_probe(self):
+        with self._probes_lock:
+            probe = self._probes.get(self.path)
+        if probe and time.time() - probe[0] < self.probe_delay:
+            return probe[1]
+        return None
+
+    def _set_probe(self, ok):
+        with self._probes_lock:
+            self._probes[self.path] = (time.time(), ok)
+
+    def is_available(self):
+        """ Health probe """
+        probe = self._get_probe()
+        if probe is not None:
+            return probe
+        if not os.path.exists(self.path):
+            ok = False
+        else:
+            try:
+                ok = bool(self._request({'cmd': 'ping'}, self.probe_delay).get('ok'))
+            except PdfServiceError as e:
+                syslog.syslog("PDF service %s not available: %s" % (self.path, e))
+                ok = False
+        self._set_probe(ok)
+        return ok
+
+    def _request(self, message, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            try:
+                sock.connect(self.path)
+            except socket.error as e:
+                raise PdfServiceUnavailable(e)
+            sock.sendall(('%s\n' % json.dumps(message)).encode('utf-8'))
+            with sock.makefile('rb') as f:
+                line = f.readline()
+            if not line:
+                raise PdfServiceError('Connection closed')
+            return json.loads(line.decode('utf-8'))
+        except (socket.error, ValueError) as e:
+            raise PdfServiceError(e)
+        finally:
+            sock.close()
+
+    def run(self, jobs):
+        """ Returns the list of results (retcode, lines) of the jobs run """
+        response = self._request({'cmd': 'run',
+                                  'batch': [job.to_json() for job in jobs]},
+                                 self.timeout)
+        if not response.get('ok'):
+            raise PdfServiceUnavailable(response.get('error', 'Batch refused'))
+        return [(result['retcode'], result['lines']) for result in response['results']]
+
+
+def run_jobs(env, jobs):
+    """ Run the jobs in turn, the first failure ending the run
+        Returns the error code and the output of the last job run,
+        as unix_cmd_apply """
+    if not jobs:
+        return 0, []
+    client = PdfServiceClient(env)
+    if client.is_available():
+        try:
+            results = client.run(jobs)
+        except PdfServiceUnavailable as e:
+            # The jobs are run by the tools
+            client._set_probe(False)
+            syslog.syslog("PDF service batch not run: %s" % e)
+        except PdfServiceError as e:
+            # Some jobs may have been run: not run again
+            client._set_probe(False)
+            msg = "PDF service batch interrupted: %s" % e
+            syslog.syslog(msg)
+            return -1, [msg]
+        else:
+            retcode, lines = results[-1] if results else (-1, [])
+            if retcode != 0:
+                job = jobs[len(results) - 1] if results else jobs[0]
+                syslog.syslog("The following PDF service job failed (retcode = %s): %s %s" % (
+                    retcode, job.jar, ' '.join(job.args)))
+                for line in lines:
+                    syslog.syslog("    " + line)
+            return retcode, lines
+    unix_cmd_list = []
+    for job in jobs:
+        unix_cmd_list += job.get_unix_cmd_list()
+    return util.unix_cmd_apply(env, unix_cmd_list, util.lineno())
+
+
+def _der_element(data, pos):
+    """ Returns the tag, the start of the content and the end of a DER element """
+    tag = data[pos]
+    length = data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[pos:pos + size], 'big')
+        pos += size
+    return tag, pos, pos + length
+
+
+def _der_time(tag, value):
+    value = value.decode('ascii').rstrip('Z')
+    if tag == 0x17:
+        # UTCTime
+        year = int(value[:2])
+        value = '%s%s' % (2000 + year if year < 50 else 1900 + year, value[2:])
+    return calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
+
+
+def get_validity_dates(der):
+    """ (notBefore, notAfter) of a DER certificate, as timestamps """
+    tag, pos, end = _der_element(der, 0)         # Certificate
+    tag, pos, end = _der_element(der, pos)       # TBSCertificate
+    tag, start, end = _der_element(der, pos)
+    if tag == 0xa0:
+        # Version
+        tag, start, end = _der_element(der, end)
+    # Serial number read: signature algorithm, issuer
+    for i in range(2):
+        tag, start, end = _der_element(der, end)
+    tag, pos, end = _der_element(der, end)       # Validity
+    dates = []
+    for i in range(2):
+        tag, start, pos = _der_element(der, pos)
+        dates.append(_der_time(tag, der[start:pos]))
+    return tuple(dates)
+
+
+class CertificateValidity(object):
+    """ Check of the validity dates of the signing certificate chain
+
+    A successful check (TracPdfSign -validity) is kept, keyed by the
+    fingerprint of the certificate chain, until the earliest notAfter date
+    of the chain or for sign_validity_ttl seconds (86400) if sooner.
+    The chain is read from sign_certificate_path (PEM), the certificate
+    chain of the keystore used by the signing tool: when it is not set or
+    cannot be read, the checks are not kept.
+    The kept checks are cleared by: trac-admin <env> artus cache validity reset
+    """
+
+    cache_path = '/var/cache/trac/sign_validity.json'
+    _lock = threading.Lock()
+
+    def __init__(self, env, jar):
+        self.env = env
+        self.jar = jar
+        self.certificate_path = env.config.get('artusplugin', 'sign_certificate_path')
+        self.ttl = env.config.getint('artusplugin', 'sign_validity_ttl', 86400)
+
+    def _get_certificates(self):
+        """ Returns the fingerprint and the validity dates of the chain
+            (None, None) if the chain is not available """
+        if not self.certificate_path:
+            return None, None
+        try:
+            with open(self.certificate_path, 'rb') as f:
+                pem = f.read()
+            ders = [base64.b64decode(b''.join(block.split()))
+                    for block in re.findall(br'-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----',
+                                            pem, re.S)]
+            if not ders:
+                raise ValueError('No certificate')
+            return (hashlib.sha256(b''.join(ders)).hexdigest(),
+                    [get_validity_dates(der) for der in ders])
+        except (IOError, OSError, ValueError, IndexError) as e:
+            syslog.syslog("Certificate chain %s not read, validity checks not kept: %s"
+                          % (self.certificate_path, e))
+            return None, None
+
+    @classmethod
+    def _load(cls):
+        try:
+            with open(cls.cache_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    @classmethod
+    def _save(cls, checks):
+        tmp_path = '%s.%s.tmp' % (cls.cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(checks, f)
+            os.replace(tmp_path, cls.cache_path)
+        except (IOError, OSError) as e:
+            syslog.syslog("Certificate validity not kept: %s" % e)
+
+    def check(self):
+        """ Returns the error code and the output of the check, as run_jobs """
+        fingerprint, dates = self._get_certificates()
+        if fingerprint is None:
+            return run_jobs(self.env, [PdfJob(self.jar, ['-validity'])])
+        key = '%s:%s' % (self.jar, fingerprint)
+        now = time.time()
+        with self._lock:
+            entry = self._load().get(key)
+        if entry and entry['expires'] > now:
+            return 0, entry['lines']
+        retcode, lines = run_jobs(self.env, [PdfJob(self.jar, ['-validity'])])
+        if retcode == 0:
+            expires = min([now + self.ttl] + [not_after for not_before, not_after in dates])
+            if expires > now:
+                with self._lock:
+                    checks = dict((k, v) for k, v in self._load().items()
+                                  if v['expires'] > now)
+                    checks[key] = {'expires': expires, 'lines': list(lines)}
+                    self._save(checks)
+        return retcode, lines
+
+    @classmethod
+    def get_checks(cls):
+        """ Kept checks: {<jar>:<fingerprint>: {'expires': <timestamp>, 'lines': [...]}} """
+        with cls._lock:
+            return cls._load()
+
+    @classmethod
+    def reset(cls):
+        """ Returns the number of checks cleared """
+        with cls._lock:
+            checks = cls._load()
+            if os.path.exists(cls.cache_path):
+                os.remove(cls.cache_path)
+        return len(checks)
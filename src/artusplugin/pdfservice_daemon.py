@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Artus
+# All rights reserved.
+#
+# Author: Michel Guillot <michel.guillot@meggitt.com>
+
+""" Resident PDF signing/filling service (see pdfservice)
+
+Run as root, as the tools were through sudo (see
+contrib/pdfservice/trac-pdfservice.service):
+    python3 pdfservice_daemon.py --socket /run/trac/pdfservice.sock --group apache
+        --jar /srv/trac/common/TracPdfSign.jar --jar /srv/trac/common/TracPdfFill.jar
+        [--launcher-dir /srv/trac/common] [--jvm-option=<option>]... [--workers 2]
+Only the given jars are run. The socket is accessible to the given group.
+Requests and responses are JSON lines (see pdfservice):
+    {"cmd": "ping"}                        -> {"ok": true}
+    {"cmd": "run", "batch": [<job>, ...]}  -> {"ok": true, "results": [<result>, ...]}
+                                              or {"ok": false, "error": <message>}
+                                              if the batch is refused (nothing run)
+The jobs of a batch are run in turn, the first failure ending the batch.
+The copy of a job is done with the user and group of the client.
+
+JVMs are started ahead: for each jar, a JVM with the main class of the
+tool loaded (PdfToolLauncher, compiled into the launcher directory) waits
+for the arguments of the next run, so that the JVM start is not paid by
+the requests. Each JVM is used for a single run. Without PdfToolLauncher,
+the tools are run by 'java -jar'.
+"""
+
+# Standard lib
+import argparse
+import grp
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import syslog
+import threading
+import time
+
+# Environment of the tools (see util.unix_cmd_apply)
+TOOLS_ENV = {'LC_ALL': 'fr_FR.utf8', 'PATH': '/usr/bin:/bin'}
+
+
+class PrestartedJvm(object):
+    """ JVM waiting for the arguments of a run of the tool """
+
+    def __init__(self, service, jar):
+        self.jar = jar
+        self.mtime = os.path.getmtime(jar)
+        self.process = subprocess.Popen(
+            [service.java] + service.jvm_options +
+            ['-cp', service.launcher_dir, 'PdfToolLauncher', jar],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            env=TOOLS_ENV)
+
+    def is_current(self):
+        try:
+            return self.process.poll() is None and os.path.getmtime(self.jar) == self.mtime
+        except OSError:
+            return False
+
+    def run(self, args, timeout):
+        """ Returns the exit status and the output lines """
+        def send_args(lines):
+            # Output before 'ready' (JVM warnings, or errors if the tool
+            # could not be loaded) is kept
+            for line in self.process.stdout:
+                if line.strip() == b'ready':
+                    data = ''.join('%s\n' % arg for arg in args).encode('utf-8') + b'\n'
+                    break
+                lines.append(line.decode('utf-8', 'replace'))
+            else:
+                data = b''
+            try:
+                self.process.stdin.write(data)
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+
+        return _communicate(self.process, timeout, send_args)
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+def _communicate(process, timeout, send_args=None):
+    """ Returns the exit status and the output lines of the process,
+        killed after timeout seconds """
+    lines = []
+    timer = threading.Timer(timeout, process.kill)
+    timer.start()
+    try:
+        if send_args:
+            send_args(lines)
+        for line in process.stdout:
+            lines.append(line.decode('utf-8', 'replace'))
+        retcode = process.wait()
+    finally:
+        timer.cancel()
+    return retcode, lines
+
+
+class PdfService(object):
+
+    def __init__(self, jars, java, jvm_options, launcher_dir, workers, timeout):
+        self.jars = set(os.path.realpath(jar) for jar in jars)
+        self.java = java
+        self.jvm_options = jvm_options
+        self.launcher_dir = launcher_dir
+        self.timeout = timeout
+        self.prestart = bool(launcher_dir) and os.path.exists(
+            os.path.join(launcher_dir, 'PdfToolLauncher.class'))
+        if not self.prestart:
+            syslog.syslog("PdfToolLauncher.class not found: the tools are run by java -jar")
+        self.slots = threading.BoundedSemaphore(workers)
+        # jar -> PrestartedJvm
+        self.jvms = {}
+        self.jvms_lock = threading.Lock()
+        if self.prestart:
+            for jar in self.jars:
+                self._start_jvm(jar)
+
+    def _start_jvm(self, jar):
+        try:
+            jvm = PrestartedJvm(self, jar)
+        except (IOError, OSError) as e:
+            syslog.syslog("JVM not started for %s: %s" % (jar, e))
+            return
+        with self.jvms_lock:
+            self.jvms[jar] = jvm
+
+    def _take_jvm(self, jar):
+        """ The prestarted JVM of the jar, another one being started for the next run """
+        with self.jvms_lock:
+            jvm = self.jvms.pop(jar, None)
+        if jvm is not None and not jvm.is_current():
+            # Stopped or jar updated
+            jvm.kill()
+            jvm = None
+        if jvm is None:
+            jvm = PrestartedJvm(self, jar)
+        self._start_jvm(jar)
+        return jvm
+
+    def run_tool(self, jar, args):
+        if self.prestart:
+            return self._take_jvm(jar).run(args, self.timeout)
+        process = subprocess.Popen([self.java] + self.jvm_options + ['-jar', jar] + args,
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, env=TOOLS_ENV)
+        return _communicate(process, self.timeout)
+
+    def check_batch(self, batch):
+        """ Returns the reason why the batch is refused """
+        if not isinstance(batch, list) or not batch:
+            return 'Empty batch'
+        for job in batch:
+            if not isinstance(job, dict) or os.path.realpath(job.get('jar', '')) not in self.jars:
+                return 'Tool not allowed: %s' % (job.get('jar') if isinstance(job, dict) else job)
+            args = job.get('args')
+            if not isinstance(args, list) or not all(isinstance(arg, str) and '\n' not in arg
+                                                     for arg in args):
+                return 'Invalid arguments'
+            copy = job.get('copy')
+            if copy is not None and (not isinstance(copy, list) or len(copy) != 2):
+                return 'Invalid copy'
+        return None
+
+    def run_batch(self, batch, uid, gid):
+        results = []
+        with self.slots:
+            for job in batch:
+                start = time.time()
+                try:
+                    retcode, lines = self.run_tool(os.path.realpath(job['jar']), job['args'])
+                except (IOError, OSError) as e:
+                    retcode, lines = -1, ['%s\n' % e]
+                if retcode == 0 and job.get('copy'):
+                    retcode, lines = self.copy(job['copy'][0], job['copy'][1], uid, gid)
+                results.append({'retcode': retcode, 'lines': lines})
+                syslog.syslog("%s: %s in %.3f s" % (os.path.basename(job['jar']),
+                                                    'done' if retcode == 0 else 'failed (%s)' % retcode,
+                                                    time.time() - start))
+                if retcode != 0:
+                    break
+        return results
+
+    @staticmethod
+    def copy(source, target, uid, gid):
+        """ Copy source over target, if not empty, as the client """
+        if not os.path.exists(source) or os.path.getsize(source) == 0:
+            return 0, []
+        try:
+            process = subprocess.run(['cp', '-f', source, target],
+                                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     user=uid, group=gid, extra_groups=[], env=TOOLS_ENV)
+        except (IOError, OSError) as e:
+            return -1, ['%s\n' % e]
+        return process.returncode, process.stdout.decode('utf-8', 'replace').splitlines(True)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        service = self.server.service
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                if request.get('cmd') == 'ping':
+                    response = {'ok': True}
+                elif request.get('cmd') == 'run':
+                    error = service.check_batch(request.get('batch'))
+                    if error:
+                        response = {'ok': False, 'error': error}
+                    else:
+                        uid, gid = self.get_peer_credentials()
+                        response = {'ok': True,
+                                    'results': service.run_batch(request['batch'], uid, gid)}
+                else:
+                    response = {'ok': False, 'error': 'Unknown command'}
+            except (ValueError, AttributeError) as e:
+                response = {'ok': False, 'error': 'Invalid request: %s' % e}
+            self.wfile.write(('%s\n' % json.dumps(response)).encode('utf-8'))
+            self.wfile.flush()
+
+    def get_peer_credentials(self):
+        creds = self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                        struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        return uid, gid
+
+
+class PdfServiceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Resident PDF signing/filling service')
+    parser.add_argument('--socket', default='/run/trac/pdfservice.sock')
+    parser.add_argument('--group', help='group allowed to connect')
+    parser.add_argument('--jar', action='append', required=True, help='tool allowed to run')
+    parser.add_argument('--java', default='/usr/bin/java')
+    parser.add_argument('--jvm-option', action='append', default=[])
+    parser.add_argument('--launcher-dir', help='directory of PdfToolLauncher.class')
+    parser.add_argument('--workers', type=int, default=2, help='batches run at the same time')
+    parser.add_argument('--timeout', type=int, default=300, help='seconds allowed for a run')
+    options = parser.parse_args(argv)
+
+    syslog.openlog('trac-pdfservice')
+    service = PdfService(options.jar, options.java, options.jvm_option, options.launcher_dir,
+                         options.workers, options.timeout)
+    if os.path.exists(options.socket):
+        os.remove(options.socket)
+    server = PdfServiceServer(options.socket, RequestHandler)
+    server.service = service
+    if options.group:
+        os.chown(options.socket, -1, grp.getgrnam(options.group).gr_gid)
+    os.chmod(options.socket, 0o660)
+    syslog.syslog("Listening on %s" % options.socket)
+    try:
+        server.serve_forever()
+    finally:
+        for jvm in list(service.jvms.values()):
+            jvm.kill()
+        os.remove(options.socket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
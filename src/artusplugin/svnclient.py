@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Artus
+# All rights reserved.
+#
+# Author: Michel Guillot <michel.guillot@meggitt.com>
+
+""" Subversion client backends used for handling the working copies """
+
+# Standard lib
+import os
+import re
+import syslog
+import tempfile
+import threading
+from time import sleep
+from urllib.parse import quote
+
+# Subversion bindings (same ones as used by Trac's svn connector)
+try:
+    from svn import core, client, ra
+    has_svn_bindings = True
+except ImportError:
+    has_svn_bindings = False
+
+# Same package
+from artusplugin import util
+
+
+def get_svn_client(env):
+    """ Return the Subversion client backend selected through the
+        [artusplugin] svn_backend option:
+            shell    -> svn command line client (default)
+            bindings -> in-process Subversion Python bindings
+        The shell backend is used as a fallback if the bindings
+        are not available """
+    backend = env.config.get('artusplugin', 'svn_backend', 'shell')
+    if backend == 'bindings':
+        if has_svn_bindings:
+            return BindingsSvnClient(env)
+        else:
+            syslog.syslog("Subversion Python bindings not found, "
+                          "falling back to the svn command line client")
+    return ShellSvnClient(env)
+
+
+class SvnClient(object):
+    """ Subversion client backend
+
+    Objects of this class should not be instantiated directly,
+    use get_svn_client() instead.
+
+    Working copy operations return a (retcode, lines) tuple,
+    as util.unix_cmd_apply does, so that callers handle
+    all backends alike. Targets are given relative to the
+    working copy path.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.log_level = env.config.get('logging', 'log_level')
+
+    def checkout(self, url, wc_path, depth='empty'):
+        raise NotImplementedError
+
+    def update(self, wc_path, targets=None, revision=None, depth=None):
+        raise NotImplementedError
+
+    def switch(self, url, wc_path):
+        raise NotImplementedError
+
+    def add(self, wc_path, targets):
+        raise NotImplementedError
+
+    def propset(self, name, value, wc_path, targets=None):
+        raise NotImplementedError
+
+    def propget(self, name, wc_path):
+        raise NotImplementedError
+
+    def lock(self, wc_path, targets, comment):
+        raise NotImplementedError
+
+    def unlock(self, wc_path, targets):
+        raise NotImplementedError
+
+    def commit(self, wc_path, message):
+        """ Return (retcode, lines, revision) - revision is '' if nothing
+            has been committed """
+        raise NotImplementedError
+
+    def cleanup(self, wc_path):
+        raise NotImplementedError
+
+    def mkdir(self, url, message):
+        raise NotImplementedError
+
+    def exists(self, url, revision='HEAD'):
+        """ Test existence of the given url (without peg revision)
+            in the repository at the given revision """
+        raise NotImplementedError
+
+    def status(self, wc_path, targets):
+        """ Return the status of each target as a dictionary:
+            {target: {'wc-status': status, 'repos-status': status}}
+            each status being a dictionary
+            ('change_status', 'lock_agent', 'lock_comment') """
+        raise NotImplementedError
+
+    @staticmethod
+    def _empty_status():
+        return {'change_status': None,
+                'lock_agent': None,
+                'lock_comment': None}
+
+
+class ShellSvnClient(SvnClient):
+    """ svn command line client run through util.unix_cmd_apply """
+
+    @staticmethod
+    def _targets(targets):
+        return ' '.join(['"%s"' % target for target in targets])
+
+    def _apply(self, unix_cmd_list):
+        return util.unix_cmd_apply(self.env, unix_cmd_list, util.caller_lineno())
+
+    def checkout(self, url, wc_path, depth='empty'):
+        unix_cmd_list = ['mkdir -p "%s"' % wc_path]
+        unix_cmd_list += [util.SVN_TEMPLATE_CMD % {'subcommand': 'co --depth %s' % depth} +
+                          '"' + url + '" "' + wc_path + '"']
+        return self._apply(unix_cmd_list)
+
+    def update(self, wc_path, targets=None, revision=None, depth=None):
+        subcommand = 'up'
+        if revision:
+            subcommand += ' -r %s' % revision
+        if depth:
+            subcommand += ' --depth %s' % depth
+        unix_cmd_list = ['cd "%s";%s' % (wc_path, util.SVN_TEMPLATE_CMD % {'subcommand': subcommand} +
+                                         self._targets(targets or ['.']))]
+        return self._apply(unix_cmd_list)
+
+    def switch(self, url, wc_path):
+        unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'switch'} +
+                         '--ignore-ancestry "' + url + '" "' + wc_path + '"']
+        return self._apply(unix_cmd_list)
+
+    def add(self, wc_path, targets):
+        unix_cmd_list = ['cd "%s";%s' % (wc_path, util.SVN_TEMPLATE_CMD % {'subcommand': 'add --force'} +
+                                         self._targets(targets))]
+        return self._apply(unix_cmd_list)
+
+    def propset(self, name, value, wc_path, targets=None):
+        # The value is passed through a file so that it is not interpreted by the shell
+        fd, value_file = tempfile.mkstemp('.prop')
+        with os.fdopen(fd, 'w') as f:
+            f.write(value)
+        unix_cmd_list = ['cd "%s";%s' % (wc_path, util.SVN_TEMPLATE_CMD % {
+            'subcommand': 'propset --force %s -F "%s"' % (name, value_file)} +
+            self._targets(targets or ['.']))]
+        try:
+            return self._apply(unix_cmd_list)
+        finally:
+            os.remove(value_file)
+
+    def propget(self, name, wc_path):
+        unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'propget %s' % name} +
+                         '"' + wc_path + '" 2> /dev/null']
+        return self._apply(unix_cmd_list)
+
+    def lock(self, wc_path, targets, comment):
+        unix_cmd_list = ['cd "%s";%s' % (wc_path, util.SVN_TEMPLATE_CMD % {
+            'subcommand': 'lock --force -m "%s" %s' % (comment, self._targets(targets))})]
+        return self._apply(unix_cmd_list)
+
+    def unlock(self, wc_path, targets):
+        unix_cmd_list = ['cd "%s";%s' % (wc_path, util.SVN_TEMPLATE_CMD % {'subcommand': 'unlock --force'} +
+                                         self._targets(targets))]
+        return self._apply(unix_cmd_list)
+
+    def commit(self, wc_path, message):
+        unix_cmd_list = ['cd "%s";%s' % (wc_path, util.SVN_TEMPLATE_CMD % {'subcommand': 'commit -m "%s"' % message})]
+        retcode, lines = self._apply(unix_cmd_list)
+        revision = ''
+        if retcode == 0:
+            for line in lines:
+                if line.startswith(u'Révision '):
+                    regular_expression = u'\\ARévision (\\d+) propagée\\.\\n\\Z'
+                    match = re.search(regular_expression, line)
+                    if match:
+                        revision = match.group(1)
+                    break
+        return retcode, lines, revision
+
+    def cleanup(self, wc_path):
+        unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'cleanup'} + '"%s"' % wc_path]
+        return self._apply(unix_cmd_list)
+
+    def mkdir(self, url, message):
+        unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'mkdir -m "%s" --parents "%s" &> /dev/null' % (
+            message, url)}]
+        return self._apply(unix_cmd_list)
+
+    def exists(self, url, revision='HEAD'):
+        unix_cmd_list = [util.SVN_TEMPLATE_CMD % {'subcommand': 'info'} +
+                         '"%s@%s" &> /dev/null' % (url, revision)]
+        return self._apply(unix_cmd_list)[0] == 0
+
+    def status(self, wc_path, targets):
+        from xml.dom.minidom import parseString
+        statuses = dict((target, {'wc-status': self._empty_status(),
+                                  'repos-status': self._empty_status()})
+                        for target in targets)
+        if not targets:
+            return statuses
+        # missing pristine warning eg is filtered out
+        unix_cmd = util.SVN_TEMPLATE_CMD % {
+            'subcommand': 'status --xml --show-updates --verbose'} + \
+            ' '.join(['"%s/%s"' % (wc_path, target) for target in targets]) + ' 2> /dev/null'
+        retcode, lines = self._apply([unix_cmd])
+        if retcode == 0:
+            dom = parseString(''.join(lines).encode('utf-8'))
+            for entry in dom.getElementsByTagName("entry"):
+                target = os.path.relpath(entry.getAttribute("path"), wc_path)
+                if target not in statuses:
+                    continue
+                for status in ('wc-status', 'repos-status'):
+                    status_list = entry.getElementsByTagName(status)
+                    if status_list:
+                        svn_status = statuses[target][status]
+                        svn_status['change_status'] = status_list[0].getAttribute("item")
+                        lock_list = status_list[0].getElementsByTagName("lock")
+                        if lock_list:
+                            owner_list = lock_list[0].getElementsByTagName("owner")
+                            if owner_list and owner_list[0].childNodes:
+                                svn_status['lock_agent'] = owner_list[0].childNodes[0].data
+                            comment_list = lock_list[0].getElementsByTagName("comment")
+                            if comment_list and comment_list[0].childNodes:
+                                svn_status['lock_comment'] = comment_list[0].childNodes[0].data
+        return statuses
+
+
+# Per thread client contexts and RA sessions of the bindings backend
+# (Subversion contexts and sessions are not thread-safe)
+_bindings_local = threading.local()
+
+# svn_wc_status_kind values as rendered by 'svn status --xml'
+_status_kinds = {1: 'none', 2: 'unversioned', 3: 'normal', 4: 'added',
+                 5: 'missing', 6: 'deleted', 7: 'replaced', 8: 'modified',
+                 9: 'merged', 10: 'conflicted', 11: 'ignored',
+                 12: 'obstructed', 13: 'external', 14: 'incomplete'}
+
+# Error codes which are worth a retry
+SVN_ERR_WC_LOCKED = 155004
+SVN_ERR_WC_CORRUPT_TEXT_BASE = 155010
+SVN_ERR_WC_PRISTINE_MISSING = 155032
+
+
+class BindingsSvnClient(SvnClient):
+    """ In-process Subversion client built on the Python bindings
+
+    One client context and one RA session per repository root url
+    are kept per worker process (and thread) and reused across calls.
+    """
+
+    def __init__(self, env):
+        super(BindingsSvnClient, self).__init__(env)
+        local = _bindings_local
+        if getattr(local, 'pid', None) != os.getpid():
+            # New process (eg forked job): sessions cannot be shared
+            local.pid = os.getpid()
+            local.ctx = None
+            local.sessions = {}
+            local.log_message = ''
+        self.local = local
+
+    @property
+    def ctx(self):
+        if self.local.ctx is None:
+            config_dir = os.path.join(util.apache_homedir, '.subversion')
+            ctx = client.create_context()
+            ctx.config = core.svn_config_get_config(config_dir)
+            providers = [client.get_simple_provider(),
+                         client.get_username_provider(),
+                         client.get_ssl_server_trust_file_provider(),
+                         client.get_ssl_client_cert_file_provider(),
+                         client.get_ssl_client_cert_pw_file_provider()]
+            ctx.auth_baton = core.svn_auth_open(providers)
+            core.svn_auth_set_parameter(ctx.auth_baton,
+                                        core.SVN_AUTH_PARAM_DEFAULT_USERNAME,
+                                        'trac')
+            core.svn_auth_set_parameter(ctx.auth_baton,
+                                        core.SVN_AUTH_PARAM_CONFIG_DIR,
+                                        config_dir)
+            ctx.log_msg_func3 = client.svn_swig_py_get_commit_log_func
+            ctx.log_msg_baton3 = self._get_log_message
+            self.local.ctx = ctx
+        return self.local.ctx
+
+    def _get_log_message(self, items, pool):
+        return self.local.log_message
+
+    @staticmethod
+    def _url(url):
+        return core.svn_uri_canonicalize(quote(url, safe="/:@!$&'()*+,;=~%"))
+
+    @staticmethod
+    def _revision(revision):
+        rev = core.svn_opt_revision_t()
+        if revision in (None, '', 'HEAD'):
+            rev.kind = core.svn_opt_revision_head
+        else:
+            rev.kind = core.svn_opt_revision_number
+            rev.value.number = int(revision)
+        return rev
+
+    @staticmethod
+    def _unspecified():
+        rev = core.svn_opt_revision_t()
+        rev.kind = core.svn_opt_revision_unspecified
+        return rev
+
+    @staticmethod
+    def _depth(depth):
+        return {None: core.svn_depth_unknown,
+                'empty': core.svn_depth_empty,
+                'files': core.svn_depth_files,
+                'immediates': core.svn_depth_immediates,
+                'infinity': core.svn_depth_infinity}[depth]
+
+    def _paths(self, wc_path, targets):
+        return [os.path.join(wc_path, target) for target in targets or ['.']]
+
+    def _get_session(self, url):
+        """ RA session reparented to the given url, opened once
+            per repository root url """
+        url = self._url(url)
+        for root, session in self.local.sessions.items():
+            if url == root or url.startswith(root + '/'):
+                try:
+                    ra.reparent(session, url)
+                    return session
+                except core.SubversionException:
+                    # Stale session, it is reopened
+                    del self.local.sessions[root]
+                    break
+        session = client.open_ra_session(url, self.ctx)
+        self.local.sessions[ra.get_repos_root2(session)] = session
+        return session
+
+    def _call(self, wc_path, func, *args):
+        """ Apply the bindings function and recover from the errors
+            also handled by util.unix_cmd_apply """
+        for attempt in (1, 2):
+            try:
+                return 0, [], func(*args)
+            except core.SubversionException as e:
+                retcode = e.apr_err
+                lines = [str(e)]
+                if attempt == 1 and wc_path:
+                    if retcode == SVN_ERR_WC_LOCKED:
+                        # before trying to restore things, we wait a while (it may be concurrency)
+                        sleep(1)
+                        self.cleanup(wc_path)
+                        continue
+                    elif retcode in (SVN_ERR_WC_CORRUPT_TEXT_BASE, SVN_ERR_WC_PRISTINE_MISSING):
+                        match = re.search(r'[0-9a-f]{40}', lines[0])
+                        if match:
+                            sleep(1)
+                            unix_cmd_list = ['cd "%s";/srv/svn/common/svn-fetch-pristine-by-sha1.sh %s' % (
+                                wc_path, match.group(0))]
+                            if util.unix_cmd_apply(self.env, unix_cmd_list, util.lineno())[0] == 0:
+                                continue
+                syslog.syslog("The following svn operation failed "
+                              "(retcode = %s - line number = %s - process id = %s - thread id = %s):" %
+                              (retcode, util.caller_lineno(), os.getpid(), threading.current_thread()))
+                syslog.syslog("    %s %s" % (func.__name__, wc_path or ''))
+                syslog.syslog("with the following output:")
+                syslog.syslog("    %s" % lines[0])
+                return retcode, lines, None
+
+    def checkout(self, url, wc_path, depth='empty'):
+        if not os.path.isdir(wc_path):
+            os.makedirs(wc_path)
+        peg = self._revision(util.get_revision(url))
+        return self._call(wc_path, client.checkout3,
+                          self._url(util.get_url(url)), wc_path, peg, peg,
+                          self._depth(depth), False, False, self.ctx)[:2]
+
+    def update(self, wc_path, targets=None, revision=None, depth=None):
+        depth_is_sticky = depth is not None
+        return self._call(wc_path, client.update4,
+                          self._paths(wc_path, targets), self._revision(revision),
+                          self._depth(depth), depth_is_sticky, False, False, False, False,
+                          self.ctx)[:2]
+
+    def switch(self, url, wc_path):
+        peg = self._revision(util.get_revision(url))
+        return self._call(wc_path, client.switch3,
+                          wc_path, self._url(util.get_url(url)), peg, peg,
+                          core.svn_depth_unknown, False, False, False, True,
+                          self.ctx)[:2]
+
+    def add(self, wc_path, targets):
+        for path in self._paths(wc_path, targets):
+            retcode, lines = self._call(wc_path, client.add4,
+                                        path, core.svn_depth_infinity, True, False, False,
+                                        self.ctx)[:2]
+            if retcode != 0:
+                return retcode, lines
+        return 0, []
+
+    def propset(self, name, value, wc_path, targets=None):
+        return self._call(wc_path, client.propset_local,
+                          name, value.encode('utf-8'), self._paths(wc_path, targets),
+                          core.svn_depth_empty, False, None, self.ctx)[:2]
+
+    def propget(self, name, wc_path):
+        retcode, lines, props = self._call(wc_path, client.propget3,
+                                           name, wc_path, self._unspecified(), self._unspecified(),
+                                           core.svn_depth_empty, None, self.ctx)
+        if retcode == 0:
+            if isinstance(props, tuple):
+                props = props[0]
+            value = b''.join(props.values())
+            lines = [line + '\n' for line in value.decode('utf-8').splitlines()]
+        return retcode, lines
+
+    def lock(self, wc_path, targets, comment):
+        return self._call(wc_path, client.lock,
+                          self._paths(wc_path, targets), comment, True, self.ctx)[:2]
+
+    def unlock(self, wc_path, targets):
+        return self._call(wc_path, client.unlock,
+                          self._paths(wc_path, targets), True, self.ctx)[:2]
+
+    def commit(self, wc_path, message):
+        self.local.log_message = message
+        retcode, lines, commit_info = self._call(wc_path, client.commit4,
+                                                 [wc_path], core.svn_depth_infinity,
+                                                 False, False, None, None, self.ctx)
+        revision = ''
+        if retcode == 0 and commit_info and commit_info.revision > 0:
+            revision = str(commit_info.revision)
+        return retcode, lines, revision
+
+    def cleanup(self, wc_path):
+        try:
+            client.cleanup(wc_path, self.ctx)
+            return 0, []
+        except core.SubversionException as e:
+            return e.apr_err, [str(e)]
+
+    def mkdir(self, url, message):
+        self.local.log_message = message
+        return self._call(None, client.mkdir3,
+                          [self._url(url)], True, None, self.ctx)[:2]
+
+    def exists(self, url, revision='HEAD'):
+        try:
+            session = self._get_session(url)
+            if revision in (None, '', 'HEAD'):
+                revnum = ra.get_latest_revnum(session)
+            else:
+                revnum = int(revision)
+            return ra.check_path(session, '', revnum) != core.svn_node_none
+        except core.SubversionException:
+            return False
+
+    def status(self, wc_path, targets):
+        statuses = dict((target, {'wc-status': self._empty_status(),
+                                  'repos-status': self._empty_status()})
+                        for target in targets)
+        if not targets:
+            return statuses
+
+        def receiver(path, st, pool=None):
+            target = os.path.relpath(path, wc_path)
+            if target not in statuses:
+                return
+            for status, change_status, lock in (
+                    ('wc-status', st.node_status, st.lock),
+                    ('repos-status', st.repos_node_status, st.repos_lock)):
+                svn_status = statuses[target][status]
+                svn_status['change_status'] = _status_kinds.get(change_status)
+                if lock:
+                    svn_status['lock_agent'] = lock.owner
+                    svn_status['lock_comment'] = lock.comment
+
+        # svn_client_status5 takes a single path
+        for path in self._paths(wc_path, targets):
+            self._call(wc_path, client.status5,
+                       self.ctx, path, self._revision('HEAD'),
+                       core.svn_depth_empty, True, True, False, True, False, None, receiver)
+        return statuses
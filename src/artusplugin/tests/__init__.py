@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Artus
+# All rights reserved.
+#
+# Author: Michel Guillot <michel.guillot@meggitt.com>
+
+import unittest
+
+from artusplugin.tests import test_pdfattach
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(test_pdfattach.test_suite())
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Artus
+# All rights reserved.
+#
+# Author: Michel Guillot <michel.guillot@meggitt.com>
+
+""" Tests of the incremental embedding of files (pdfattach) """
+
+# Standard lib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+# Same package
+from artusplugin import pdfattach
+from artusplugin.pdfattach import Name, PDFReader, PDFUpdateError, PDFUpdateWriter, Ref
+
+OBJECTS = [b'<</Type/Catalog/Pages 2 0 R>>',
+           b'<</Type/Pages/Kids[3 0 R]/Count 1>>',
+           b'<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>']
+
+
+def build_xref_table_pdf():
+    """ Document with a classic cross-reference table """
+    pdf = io.BytesIO()
+    pdf.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for num, value in enumerate(OBJECTS, 1):
+        offsets.append(pdf.tell())
+        pdf.write(b'%d 0 obj\n%s\nendobj\n' % (num, value))
+    startxref = pdf.tell()
+    pdf.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(OBJECTS) + 1))
+    for offset in offsets:
+        pdf.write(b'%010d 00000 n \n' % offset)
+    pdf.write(b'trailer\n<</Size %d/Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n'
+              % (len(OBJECTS) + 1, startxref))
+    return pdf.getvalue()
+
+
+def build_xref_stream_pdf():
+    """ Document with its objects in an object stream and a cross-reference
+        stream (FlateDecode, PNG Up predictor) """
+    pdf = io.BytesIO()
+    pdf.write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+    header = b''
+    body = b''
+    for num, value in enumerate(OBJECTS, 1):
+        header += b'%d %d ' % (num, len(body))
+        body += value + b'\n'
+    objstm = zlib.compress(header + body)
+    objstm_offset = pdf.tell()
+    pdf.write(b'4 0 obj\n<</Type/ObjStm/N %d/First %d/Filter/FlateDecode/Length %d>>\nstream\n'
+              % (len(OBJECTS), len(header), len(objstm)))
+    pdf.write(objstm + b'\nendstream\nendobj\n')
+    xref_offset = pdf.tell()
+    rows = [(0, 0, 255)] + [(2, 4, i) for i in range(len(OBJECTS))] + \
+           [(1, objstm_offset, 0), (1, xref_offset, 0)]
+    rows = [bytes([kind]) + value.to_bytes(2, 'big') + bytes([index])
+            for kind, value, index in rows]
+    data = b''
+    previous = bytes(4)
+    for row in rows:
+        data += b'\x02' + bytes((c - p) & 0xff for c, p in zip(row, previous))
+        previous = row
+    data = zlib.compress(data)
+    pdf.write(b'5 0 obj\n<</Type/XRef/Size 6/W[1 2 1]/Root 1 0 R/Filter/FlateDecode'
+              b'/DecodeParms<</Predictor 12/Columns 4>>/Length %d>>\nstream\n' % len(data))
+    pdf.write(data + b'\nendstream\nendobj\n')
+    pdf.write(b'startxref\n%d\n%%%%EOF\n' % xref_offset)
+    return pdf.getvalue()
+
+
+class AttachFilesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.attachments = []
+        for name, content in (('report.txt', b'Report\n' * 1000),
+                              ('check list.xlsx', os.urandom(5000))):
+            path = os.path.join(self.tmpdir, name)
+            with open(path, 'wb') as f:
+                f.write(content)
+            self.attachments.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _attach(self, data):
+        input_path = self._write('input.pdf', data)
+        output_path = os.path.join(self.tmpdir, 'output.pdf')
+        pdfattach.attach_files(input_path, self.attachments, output_path)
+        with open(output_path, 'rb') as f:
+            return f.read()
+
+    def _check_update(self, data, xref_stream):
+        output = self._attach(data)
+        # Incremental update: the original document is kept as is
+        self.assertTrue(output.startswith(data))
+        original = PDFReader(io.BytesIO(data))
+        reader = PDFReader(io.BytesIO(output))
+        self.assertEqual(xref_stream, reader.xref_stream)
+        self.assertEqual(original.startxref, pdfattach._int(reader.trailer[b'Prev']))
+        # Objects of the original document still readable through /Prev
+        pages = reader.get_object(2)
+        self.assertEqual(b'Pages', bytes(pages[b'Type']))
+        self.assertEqual(b'Page', bytes(reader.get_object(3)[b'Type']))
+        catalog = reader.get_object(reader.trailer[b'Root'].num)
+        self.assertEqual(b'UseAttachments', bytes(catalog[b'PageMode']))
+        names = catalog[b'Names']
+        tree = reader.get_object(names[b'EmbeddedFiles'].num)
+        self.assertEqual(2 * len(self.attachments), len(tree[b'Names']))
+        contents = {}
+        for key, spec_ref in zip(tree[b'Names'][0::2], tree[b'Names'][1::2]):
+            spec = reader.get_object(spec_ref.num)
+            self.assertEqual(b'Filespec', bytes(spec[b'Type']))
+            file_ref = spec[b'EF'][b'F']
+            num, value, stream = reader._read_object_at(reader.xref[file_ref.num][1])
+            self.assertEqual(b'EmbeddedFile', bytes(value[b'Type']))
+            content = reader._decode(value, stream)
+            self.assertEqual(len(content), pdfattach._int(value[b'Params'][b'Size']))
+            contents[bytes(key)] = content
+        for attachment in self.attachments:
+            with open(attachment, 'rb') as f:
+                self.assertEqual(f.read(), contents[bytes(pdfattach.pdf_string(os.path.basename(attachment)))])
+        # Name tree keys are sorted
+        keys = [bytes(key) for key in tree[b'Names'][0::2]]
+        self.assertEqual(sorted(keys), keys)
+
+    def test_xref_table(self):
+        self._check_update(build_xref_table_pdf(), False)
+
+    def test_xref_stream(self):
+        self._check_update(build_xref_stream_pdf(), True)
+
+    def test_already_embedded_files(self):
+        data = build_xref_table_pdf()
+        output = self._attach(data)
+        self.assertRaises(PDFUpdateError, self._attach, output)
+
+    def test_encrypted(self):
+        data = build_xref_table_pdf().replace(b'/Root 1 0 R>>', b'/Root 1 0 R/Encrypt 9 0 R>>')
+        self.assertRaises(PDFUpdateError, self._attach, data)
+
+    def test_malformed_xref_table(self):
+        data = build_xref_table_pdf()
+        self.assertRaises(PDFUpdateError, self._attach,
+                          data.replace(b'xref\n0 4\n', b'xref\n0 x\n'))
+        self.assertRaises(PDFUpdateError, self._attach,
+                          data.replace(b'0000000015 00000 n', b'00000000zz 00000 n'))
+        self.assertRaises(PDFUpdateError, self._attach, data[:len(data) // 2])
+        self.assertRaises(PDFUpdateError, self._attach, b'Not a PDF document')
+
+    def test_malformed_object_stream(self):
+        data = build_xref_stream_pdf()
+        # More objects announced than given by the header
+        self.assertRaises(PDFUpdateError, self._attach,
+                          data.replace(b'/ObjStm/N 3', b'/ObjStm/N 9'))
+        # Stream which cannot be decompressed
+        start = data.index(b'stream\n') + 7
+        self.assertRaises(PDFUpdateError, self._attach,
+                          data[:start] + b'x' * 10 + data[start + 10:])
+
+    def test_large_offsets(self):
+        """ Offset field of the xref stream sized from the largest offset """
+        reader = mock.Mock(startxref=100, xref_stream=True, trailer={b'Size': 10})
+        target = io.BytesIO()
+        writer = PDFUpdateWriter(target, reader)
+        writer.offsets = {10: 5 << 32, 11: 17}
+        writer.next_num = 12
+        writer.write_xref({b'Root': Ref(1, 0)})
+        output = target.getvalue()
+        trailer = pdfattach.parse_object(output, output.index(b'obj') + 3)[0]
+        self.assertEqual([1, 5, 2], [pdfattach._int(w) for w in trailer[b'W']])
+        stream = output[output.index(b'stream\n') + 7:]
+        self.assertEqual(b'\x01' + (5 << 32).to_bytes(5, 'big') + b'\x00\x00', stream[:8])
+        self.assertEqual(3 * 8, pdfattach._int(trailer[b'Length']))
+        self.assertEqual(b'XRef', bytes(trailer[b'Type']))
+        self.assertIsInstance(trailer[b'Type'], Name)
+
+
+class PdfAttachFilesFallbackTestCase(unittest.TestCase):
+    """ util.pdf_attach_files falls back to jpdftweak """
+
+    def test_malformed_document(self):
+        from artusplugin import util
+        tmpdir = tempfile.mkdtemp()
+        try:
+            input_path = os.path.join(tmpdir, 'input.pdf')
+            with open(input_path, 'wb') as f:
+                f.write(build_xref_table_pdf().replace(b'xref\n0 4\n', b'xref\n0 x\n'))
+            attachment = os.path.join(tmpdir, 'report.txt')
+            with open(attachment, 'wb') as f:
+                f.write(b'Report\n')
+            with mock.patch.object(util, 'unix_cmd_apply', return_value=(0, [])) as unix_cmd_apply:
+                util.pdf_attach_files(input_path, [attachment], os.path.join(tmpdir, 'output.pdf'))
+            unix_cmd_list = unix_cmd_apply.call_args[0][1]
+            self.assertIn('jpdftweak', unix_cmd_list[-1])
+            self.assertIn('-attach "%s"' % attachment, unix_cmd_list[-1])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(AttachFilesTestCase))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(PdfAttachFilesFallbackTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -13,14 +13,16 @@ from bs4 import BeautifulSoup
 from jinja2 import Environment, FileSystemLoader, TemplateNotFound
 
 # Trac
+from trac.cache import cached
 from trac.config import Option
 from trac.core import Component, implements, TracError
-from trac.perm import PermissionSystem
+from trac.perm import IPermissionChangeListener, PermissionSystem
 from trac.resource import ResourceNotFound
 from trac.ticket import Ticket
 from trac.util import get_pkginfo
 from trac.util.text import unicode_quote_plus
-from trac.versioncontrol.api import RepositoryManager, Node, Changeset, NoSuchNode
+from trac.versioncontrol.api import RepositoryManager, Node, Changeset, NoSuchNode, \
+    IRepositoryChangeListener
 from trac.web.chrome import add_ctxtnav, Chrome
 
 # Standard lib
@@ -28,15 +30,15 @@ from collections import OrderedDict
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 # from ldap_utilities import Ldap_Utilities
-from artusplugin.ldap.ldap_utilities import Ldap_Utilities
+from artusplugin.ldap.ldap_utilities import Ldap_Utilities, TranslationMap
 from unidecode import unidecode
 from time import sleep
-from threading import current_thread, BoundedSemaphore
+from threading import current_thread, BoundedSemaphore, Lock, Thread
 from urllib.parse import unquote_plus
 import cgi
 import codecs
-# import ConfigParser
-from backports import configparser as ConfigParser
+import errno
+import hashlib
 import inspect
 import os
 import pyodbc
@@ -51,18 +53,16 @@ import tempfile
 import unicodedata
 import urllib.request
 import zipfile
+import zlib
 import json
 
-# 3rd party modules
-import posix_ipc
-
 # Announcer Plugin
 from artusplugin.announcer.api import IAnnouncementAddressResolver
 from artusplugin.announcer.specified import SpecifiedEmailResolver
 
 # Same package
 import artusplugin
-from artusplugin import _
+from artusplugin import _, pdfattach
 import trac
 
 # Other plugin
@@ -345,6 +345,17 @@ def get_repo_url(env, url):
     return repo_url
 
 
+def get_repo_internal_url(env, repo_url):
+    # Get internal path from complete Subversion url (reverse of get_repo_url)
+    base_url = env.base_url.replace('/tracs', '', 1)
+    for base in (base_url, base_url[:base_url.rfind('/')]):
+        if repo_url.startswith(base + '/'):
+            url = repo_url[len(base):]
+            if get_repo_url(env, url) == repo_url:
+                return url
+    return None
+
+
 def get_repo_local_url(env, url):
     # Get local Subversion url from internal path
     repository = get_repository(env, url)
@@ -482,6 +493,11 @@ def exist_in_repo(env, url):
         Test existence of the given url (http(s)://...) in the repository
     """
     if url:
+        internal_url = get_repo_internal_url(env, get_url(url))
+        if internal_url:
+            found = RepositoryIndex(env).exists(internal_url)
+            if found is not None:
+                return found
         unix_cmd_list = [SVN_TEMPLATE_CMD % {'subcommand': 'info'} +
                          '"%s" &> /dev/null' % get_url(url)]
         retcode = unix_cmd_apply(env, unix_cmd_list, lineno())[0]
@@ -881,6 +897,25 @@ def unix_cmd_apply(env, unix_cmd_list, line_number, nesting_level=0):
     return (retcode, lines)
 
 
+def collate_sort(names):
+    """ Sort the names as 'sort' does under the fr_FR.utf8 locale of the
+        commands (see unix_cmd_apply): accents and case are not ordered
+        by code point, which 'sorted' would do """
+    try:
+        p1 = subprocess.Popen(['sort'],
+                              stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE,
+                              env={'LC_ALL': 'fr_FR.utf8'})
+        output = p1.communicate(''.join('%s\n' % name for name in names).encode('utf-8'))[0]
+        if p1.returncode == 0:
+            sorted_names = output.decode('utf-8').splitlines()
+            if sorted(sorted_names) == sorted(names):
+                return sorted_names
+    except OSError as e:
+        syslog.syslog("Collation sort failed: %s" % e)
+    return sorted(names)
+
+
 def lineno():
     """Returns the current line number in our program."""
     caller_frame = inspect.currentframe().f_back
@@ -1390,16 +1425,19 @@ def group_by(elt_list, group1=(None, True), group2=(None, True), group3=(None, T
     return grouped_by_list
 
 
-def create_fs_from_repo(path, node):
+def create_fs_from_repo(path, node, blob_cache=None):
     try:
         path += '/' + node.name
         if node.isdir:
             if not os.access(path, os.F_OK):
                 os.mkdir(path)
             for entry in node.get_entries():
-                create_fs_from_repo(path, entry)
+                create_fs_from_repo(path, entry, blob_cache)
+        elif blob_cache:
+            # Copied: the files may be updated in place
+            blob_cache.copy(node, path)
         else:
-            with open(path.encode('utf-8'), 'w') as targetfile:
+            with open(path.encode('utf-8'), 'wb') as targetfile:
                 shutil.copyfileobj(node.get_content(), targetfile)
     except Exception:
         exc_info = sys.exc_info()
@@ -1538,7 +1576,15 @@ def pdf_attach_files(pdf_input_file, attachments, pdf_output_file):
     """ Add the given attachments to the given input pdf file.
         The attachments'paths are given in a list
         The output pdf file shall be different from the input pdf file
+        The attachments are appended as an incremental update (see pdfattach),
+        the document being rebuilt by jpdftweak when it cannot be updated so
     """
+    try:
+        pdfattach.attach_files(pdf_input_file, attachments, pdf_output_file)
+        return
+    except (pdfattach.PDFUpdateError, IOError, OSError, zlib.error) as e:
+        syslog.syslog("Incremental update of %s failed (%s): rebuilt by jpdftweak" % (pdf_input_file, e))
+
     bookmark_file = tempfile.mkstemp('.csv')[1]
 
     unix_cmd_list = ['java -jar /opt/jpdftweak/jpdftweak.jar -i "%s" ' % pdf_input_file +
@@ -1577,6 +1623,342 @@ def strip_accents(text):
     return str(text)
 
 
+class RepositoryIndex(object):
+    """ Index of node existence keyed by (repository, path, revision)
+
+    Existence of a path at a given revision never changes, so answers
+    are shared by all requests of the process in a bounded LRU.
+    They are read from Trac's cached repository, which may lag behind
+    the repositories: the changesets notified by the post-commit hook
+    (see RepositoryIndexFeeder) are kept in <env>/db/repository_index.db,
+    shared by the processes of the environment, and answer for the
+    revisions not synced yet.
+    'HEAD' is resolved once per index object to the youngest revision
+    known from Trac's cache or from the hook.
+    """
+
+    max_entries = 50000
+    # Revisions kept in the shared store, behind the last notified one
+    max_revisions = 100
+    _entries = OrderedDict()
+    _lock = Lock()
+
+    def __init__(self, env):
+        self.env = env
+        self.db_path = os.path.join(env.path, 'db', 'repository_index.db')
+        self.youngest_revs = {}
+        self.notified_revs = {}
+
+    @classmethod
+    def get(cls, key):
+        with cls._lock:
+            if key in cls._entries:
+                cls._entries.move_to_end(key)
+                return cls._entries[key]
+        return None
+
+    @classmethod
+    def set(cls, key, value):
+        with cls._lock:
+            cls._entries[key] = value
+            cls._entries.move_to_end(key)
+            while len(cls._entries) > cls.max_entries:
+                cls._entries.popitem(last=False)
+
+    # Shared store
+
+    def _connect(self):
+        cnx = sqlite3.connect(self.db_path, timeout=10)
+        cnx.execute("CREATE TABLE IF NOT EXISTS node (reponame text, path text, rev integer, "
+                    "found integer, PRIMARY KEY (reponame, path, rev))")
+        cnx.execute("CREATE TABLE IF NOT EXISTS head (reponame text PRIMARY KEY, rev integer)")
+        return cnx
+
+    def add_changeset(self, reponame, rev, changes):
+        """ Keep the (path, found) changes of the revision """
+        try:
+            cnx = self._connect()
+            try:
+                with cnx:
+                    cnx.executemany("INSERT OR REPLACE INTO node VALUES (?, ?, ?, ?)",
+                                    [(reponame, path, rev, int(found)) for path, found in changes])
+                    cnx.execute("INSERT OR REPLACE INTO head VALUES (?, MAX(?, COALESCE("
+                                "(SELECT rev FROM head WHERE reponame=?), 0)))",
+                                (reponame, rev, reponame))
+                    cnx.execute("DELETE FROM node WHERE reponame=? AND rev<?",
+                                (reponame, rev - self.max_revisions))
+            finally:
+                cnx.close()
+        except sqlite3.Error as e:
+            syslog.syslog("Repository index %s not updated: %s" % (self.db_path, e))
+
+    def _read(self, query, args):
+        try:
+            cnx = self._connect()
+            try:
+                return cnx.execute(query, args).fetchone()
+            finally:
+                cnx.close()
+        except sqlite3.Error as e:
+            syslog.syslog("Repository index %s not read: %s" % (self.db_path, e))
+            return None
+
+    def get_notified_rev(self, reponame):
+        """ Last revision notified by the post-commit hook """
+        if reponame not in self.notified_revs:
+            row = self._read("SELECT rev FROM head WHERE reponame=?", (reponame,))
+            self.notified_revs[reponame] = row[0] if row else 0
+        return self.notified_revs[reponame]
+
+    def get_notified(self, reponame, path, rev):
+        """ Whether the path exists, if it was changed at the given revision """
+        row = self._read("SELECT found FROM node WHERE reponame=? AND path=? AND rev=?",
+                         (reponame, path, rev))
+        return bool(row[0]) if row else None
+
+    def get_youngest_rev(self, repos):
+        if repos.reponame not in self.youngest_revs:
+            self.youngest_revs[repos.reponame] = repos.youngest_rev
+        return self.youngest_revs[repos.reponame]
+
+    def get_head_rev(self, url):
+        """ Youngest revision of the repository of the given internal url,
+            as known from Trac's cache or from the hook (None if unknown) """
+        repos = get_repository(self.env, url)
+        if not repos:
+            return None
+        try:
+            youngest_rev = int(self.get_youngest_rev(repos))
+        except Exception:
+            return None
+        return max(youngest_rev, self.get_notified_rev(repos.reponame))
+
+    def exists(self, url, revision='HEAD'):
+        """ Test existence of the given internal url (/[reponame/]trunk/...)
+            at the given revision.
+            None is returned if the index cannot tell, the caller
+            then has to ask the repository server itself:
+            -> the url does not belong to a known repository
+            -> the revision is not synced yet in Trac's cache
+               and the url was not changed at that revision
+            -> the url is not found at HEAD (it may have just been committed)
+        """
+        repos = get_repository(self.env, url)
+        if not repos:
+            return None
+        path = get_url(url)
+        if repos.reponame:
+            path = path[len(repos.reponame) + 1:]
+        path = path.rstrip('/') or '/'
+        head = revision in (None, '', 'HEAD')
+        try:
+            youngest_rev = self.get_youngest_rev(repos)
+            rev = youngest_rev if head else int(revision)
+        except Exception:
+            return None
+        notified_rev = self.get_notified_rev(repos.reponame)
+        if notified_rev > youngest_rev and (head or rev > youngest_rev):
+            # Committed since Trac's cache was synced:
+            # only the paths changed at that revision are known
+            found = self.get_notified(repos.reponame, path, notified_rev if head else rev)
+            return found if found or not head else None
+        if rev > youngest_rev:
+            return None
+        key = (repos.reponame, path, rev)
+        found = self.get(key)
+        if found is None:
+            try:
+                found = repos.has_node(path, rev)
+            except Exception:
+                return None
+            self.set(key, found)
+        if not found and head:
+            return None
+        return found
+
+
+class RepositoryIndexFeeder(Component):
+    """ Feeds the shared store of the repository index with the
+        changesets notified by the post-commit hook """
+
+    implements(IRepositoryChangeListener)
+
+    def changeset_added(self, repos, changeset):
+        RepositoryIndex(self.env).add_changeset(
+            repos.reponame, changeset.rev,
+            [('/' + path.strip('/'), change != Changeset.DELETE)
+             for path, kind, change, base_path, base_rev in changeset.get_changes()])
+
+    def changeset_modified(self, repos, changeset, old_changeset):
+        pass
+
+
+def parse_size(size):
+    """ Size in bytes of eg '20G', '500M' or '1000' """
+    units = {'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12}
+    if size[-1:].upper() in units:
+        return int(float(size[:-1]) * units[size[-1:].upper()])
+    return int(size)
+
+
+class BlobCache(object):
+    """ Repository file contents cache shared by the processes of the environment
+
+    Contents are stored once under /var/cache/trac/blobs/<env>, keyed by
+    (repository, path, last changed revision), which identifies them for ever.
+    They are read-only: callers either hardlink them (see link), when the
+    file is only replaced afterwards, or copy them.
+    The least recently used contents are evicted beyond the disk budget.
+    Hits and misses are counted in memory and stored by flush.
+    Options ([artusplugin] section):
+        blob_cache_max_size: disk budget, eg 10G (default), 500M
+    """
+
+    root = '/var/cache/trac/blobs'
+
+    def __init__(self, env):
+        self.env = env
+        self.path = '%s/%s' % (self.root, get_program_data(env)['trac_env_name'])
+        self.stats_path = '%s/.stats.db' % self.path
+        # name -> count not stored yet
+        self.counts = {}
+        self.counts_lock = Lock()
+
+    def get_key(self, node):
+        return hashlib.sha1(('%s\0%s\0%s' % (node.repos.reponame or '',
+                                                node.path, node.rev)).encode('utf-8')).hexdigest()
+
+    def get_path(self, node):
+        """ Path of the cached content of the node (fetched if needed) """
+        key = self.get_key(node)
+        blob_path = '%s/%s/%s' % (self.path, key[:2], key)
+        if os.path.exists(blob_path):
+            try:
+                # Access time used for eviction (noatime mounts)
+                os.utime(blob_path)
+            except OSError:
+                pass
+            self.count('hits')
+            return blob_path
+        blob_dir = os.path.dirname(blob_path)
+        if not os.path.isdir(blob_dir):
+            os.makedirs(blob_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=blob_dir)
+        try:
+            with os.fdopen(fd, 'wb') as blob:
+                shutil.copyfileobj(node.get_content(), blob, 1 << 20)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, blob_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.count('misses')
+        return blob_path
+
+    def link(self, node, target_path):
+        """ Hardlink the content of the node to target_path
+            (which must not exist) """
+        blob_path = self.get_path(node)
+        try:
+            os.link(blob_path, target_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Not on the same file system
+            shutil.copyfile(blob_path, target_path)
+
+    def copy(self, node, target_path):
+        """ Copy the content of the node to target_path (may be modified) """
+        shutil.copyfile(self.get_path(node), target_path)
+
+    # Counters
+
+    def _connect(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, exist_ok=True)
+        cnx = sqlite3.connect(self.stats_path, timeout=10)
+        cnx.execute("CREATE TABLE IF NOT EXISTS counter (name text PRIMARY KEY, value integer)")
+        return cnx
+
+    def count(self, name):
+        with self.counts_lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def flush(self):
+        """ Store the counts in one transaction """
+        with self.counts_lock:
+            counts = self.counts
+            self.counts = {}
+        if not counts:
+            return
+        try:
+            cnx = self._connect()
+            try:
+                with cnx:
+                    for name, value in sorted(counts.items()):
+                        cnx.execute("INSERT OR IGNORE INTO counter VALUES (?, 0)", (name,))
+                        cnx.execute("UPDATE counter SET value=value+? WHERE name=?", (value, name))
+            finally:
+                cnx.close()
+        except sqlite3.Error as e:
+            syslog.syslog("Blob cache counters not updated: %s" % e)
+
+    def get_stats(self):
+        """ Hits, misses, number and size of the cached contents """
+        self.flush()
+        stats = {'hits': 0, 'misses': 0}
+        cnx = self._connect()
+        try:
+            stats.update(cnx.execute("SELECT name, value FROM counter"))
+        finally:
+            cnx.close()
+        blobs = self.get_blobs()
+        stats['blobs'] = len(blobs)
+        stats['size'] = sum(blob[2] for blob in blobs)
+        return stats
+
+    # Eviction
+
+    def get_blobs(self):
+        """ (atime, path, size) of the cached contents """
+        blobs = []
+        if os.path.isdir(self.path):
+            for dirpath, dirnames, filenames in os.walk(self.path):
+                for filename in filenames:
+                    if filename.startswith('.') or filename.endswith('.tmp'):
+                        continue
+                    blob_path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(blob_path)
+                    except OSError:
+                        continue
+                    blobs.append((max(st.st_atime, st.st_mtime), blob_path, st.st_size))
+        return blobs
+
+    def prune(self):
+        """ Evict the least recently used contents beyond the budget
+            Return (evicted contents, reclaimed bytes) """
+        budget = parse_size(self.env.config.get('artusplugin', 'blob_cache_max_size', '10G'))
+        blobs = sorted(self.get_blobs())
+        total = sum(blob[2] for blob in blobs)
+        evicted = 0
+        reclaimed = 0
+        for atime, blob_path, size in blobs:
+            if total - reclaimed <= budget:
+                break
+            try:
+                # Hardlinked copies (packages being built) are left untouched
+                os.remove(blob_path)
+            except OSError:
+                continue
+            evicted += 1
+            reclaimed += size
+        if evicted:
+            self.count('evictions')
+        return evicted, reclaimed
+
+
 class ArtusDomainEmailResolver(Component):
     """Support of new email scheme for old repositories."""
 
@@ -1588,15 +1970,13 @@ class ArtusDomainEmailResolver(Component):
 
     translation_file = Option('artusplugin', 'translation_file')
 
-    domain_translation = {}
-
-    name_translation = {}
+    @property
+    def domain_translation(self):
+        return TranslationMap.get(self.translation_file).get_section('domain-translation')
 
-    def __init__(self):
-        meggitt_translation = ConfigParser.RawConfigParser()
-        meggitt_translation.read(self.translation_file)
-        self.domain_translation = dict(meggitt_translation.items('domain-translation'))
-        self.name_translation = dict(meggitt_translation.items('user-translation'))
+    @property
+    def name_translation(self):
+        return TranslationMap.get(self.translation_file).users
 
     def get_address_for_name(self, name, authenticated):
         if self.smtp_default_domain:
@@ -1611,12 +1991,226 @@ class ArtusDomainEmailResolver(Component):
         return None
 
 
+class DirectoryCache(object):
+    """ Directory attributes of the users, kept in <env>/db/directory.db
+
+    Email addresses and display names found in the directories are kept
+    for directory_cache_ttl seconds (86400), users not found (eg who have
+    left the company) for directory_cache_negative_ttl seconds (3600).
+    Expired entries are returned while being refreshed in the background,
+    so that a slow or unavailable directory does not stall the requests:
+    only users never seen are looked up before returning, unless the
+    caller does not wait for them (see get_users).
+    Background refreshes are done in turn by a single worker thread per
+    process, each refresh being stored in one transaction.
+    """
+
+    # Background refreshes are not started again for a while after a failure
+    retry_delay = 60
+
+    # path -> last time given to expire by the process
+    _expired = {}
+
+    # Process of the refresh state below
+    _pid = None
+    # path -> (cache, users to refresh)
+    _pending = {}
+    _refreshing = set()
+    _failures = {}
+    # path -> number of refreshes stored by the process
+    _generations = {}
+    _worker = None
+    _refreshing_lock = Lock()
+
+    def __init__(self, env):
+        self.env = env
+        self.path = os.path.join(env.path, 'db', 'directory.db')
+        self.ttl = env.config.getint('artusplugin', 'directory_cache_ttl', 86400)
+        self.negative_ttl = env.config.getint('artusplugin', 'directory_cache_negative_ttl', 3600)
+
+    def _connect(self):
+        cnx = sqlite3.connect(self.path, timeout=10)
+        cnx.execute("CREATE TABLE IF NOT EXISTS user (name text PRIMARY KEY, mail text, "
+                    "display_name text, found integer, time real)")
+        return cnx
+
+    @staticmethod
+    def _entry(row):
+        return {'mail': row[1], 'display_name': row[2], 'found': bool(row[3]), 'time': row[4]}
+
+    def is_fresh(self, entry, now=None):
+        age = (now or time.time()) - entry['time']
+        return age < (self.ttl if entry['found'] else self.negative_ttl)
+
+    def get_users(self, users, ldap_util=None, wait=True):
+        """ {user: {'mail': ..., 'display_name': ..., 'found': ..., 'time': ...}}
+            Users not in the cache are looked up at once if wait is True,
+            else in the background: they are missing, as those whose lookup
+            has failed """
+        users = sorted(set(users))
+        entries = {}
+        try:
+            cnx = self._connect()
+            try:
+                for i in range(0, len(users), 500):
+                    batch = users[i:i + 500]
+                    for row in cnx.execute("SELECT name, mail, display_name, found, time FROM user "
+                                           "WHERE name IN (%s)" % ','.join('?' * len(batch)), batch):
+                        entries[row[0]] = self._entry(row)
+            finally:
+                cnx.close()
+        except sqlite3.Error as e:
+            syslog.syslog("Directory cache %s not read: %s" % (self.path, e))
+        now = time.time()
+        missing = [user for user in users if user not in entries]
+        stale = [user for user, entry in entries.items() if not self.is_fresh(entry, now)]
+        if missing:
+            if wait:
+                try:
+                    entries.update(self.refresh(missing, ldap_util))
+                except Exception as e:
+                    syslog.syslog("Directory lookup failed: %s" % e)
+            else:
+                stale += missing
+        if stale:
+            self._refresh_in_background(stale)
+        return entries
+
+    def refresh(self, users, ldap_util=None):
+        """ Look the users up in the directories and keep the result """
+        if ldap_util is None:
+            with Ldap_Utilities() as ldap_util:
+                return self.refresh(users, ldap_util)
+        mails = ldap_util.get_meggitt_mails(users)
+        user_ids = dict((user, mails[user].split('@')[0]) for user in users if mails.get(user))
+        display_names = ldap_util.get_ldap_displaynames(list(set(user_ids.values())))
+        now = time.time()
+        entries = {}
+        for user in users:
+            entries[user] = {'mail': mails.get(user),
+                             'display_name': display_names.get(user_ids.get(user)),
+                             'found': user in mails,
+                             'time': now}
+        try:
+            cnx = self._connect()
+            try:
+                with cnx:
+                    cnx.executemany("INSERT OR REPLACE INTO user VALUES (?, ?, ?, ?, ?)",
+                                    [(user, entry['mail'], entry['display_name'],
+                                      int(entry['found']), entry['time'])
+                                     for user, entry in entries.items()])
+            finally:
+                cnx.close()
+        except sqlite3.Error as e:
+            syslog.syslog("Directory cache %s not updated: %s" % (self.path, e))
+        with self._refreshing_lock:
+            self._generations[self.path] = self._generations.get(self.path, 0) + 1
+        return entries
+
+    def get_generation(self):
+        """ Changes whenever the process has stored a refresh """
+        with self._refreshing_lock:
+            return self._generations.get(self.path, 0)
+
+    def _refresh_in_background(self, users):
+        cls = DirectoryCache
+        with cls._refreshing_lock:
+            if cls._pid != os.getpid():
+                # Refreshes of the parent process are not run by its worker
+                # in a forked process: they are requested again
+                cls._pid = os.getpid()
+                cls._pending = {}
+                cls._refreshing = set()
+                cls._failures = {}
+                cls._worker = None
+            if time.time() - cls._failures.get(self.path, 0) < self.retry_delay:
+                return
+            users = [user for user in users if (self.path, user) not in cls._refreshing]
+            if not users:
+                return
+            cls._refreshing.update((self.path, user) for user in users)
+            cls._pending.setdefault(self.path, (self, set()))[1].update(users)
+            if cls._worker is None or not cls._worker.is_alive():
+                cls._worker = Thread(target=cls._run_worker, name='directory-cache-refresh')
+                cls._worker.daemon = True
+                cls._worker.start()
+
+    @classmethod
+    def _run_worker(cls):
+        while True:
+            with cls._refreshing_lock:
+                if not cls._pending:
+                    cls._worker = None
+                    return
+                path, (cache, users) = cls._pending.popitem()
+            try:
+                cache.refresh(sorted(users))
+            except Exception as e:
+                syslog.syslog("Directory refresh failed: %s" % e)
+                with cls._refreshing_lock:
+                    cls._failures[path] = time.time()
+            finally:
+                with cls._refreshing_lock:
+                    cls._refreshing.difference_update((path, user) for user in users)
+
+    def expire(self, before):
+        """ Entries kept before the given time are to be refreshed
+            (only done again by the process when the time changes) """
+        if DirectoryCache._expired.get(self.path) == before:
+            return
+        try:
+            cnx = self._connect()
+            try:
+                with cnx:
+                    cnx.execute("UPDATE user SET time=0 WHERE time<?", (before,))
+            finally:
+                cnx.close()
+        except sqlite3.Error as e:
+            syslog.syslog("Directory cache %s not expired: %s" % (self.path, e))
+            return
+        DirectoryCache._expired[self.path] = before
+
+    def get_entries(self):
+        """ (user, entry) of the cache, oldest first """
+        cnx = self._connect()
+        try:
+            return [(row[0], self._entry(row)) for row in
+                    cnx.execute("SELECT name, mail, display_name, found, time FROM user ORDER BY time")]
+        finally:
+            cnx.close()
+
+    def clear(self):
+        cnx = self._connect()
+        try:
+            with cnx:
+                return cnx.execute("DELETE FROM user").rowcount
+        finally:
+            cnx.close()
+
+
 class Users(Component):
-    """Compile projet users data for use by other components."""
+    """Compile projet users data for use by other components.
+
+    The profiles, roles and users are indexed once and the index is
+    rebuilt on permission changes only.
+    """
+
+    implements(IPermissionChangeListener)
 
     @staticmethod
     def get_email(env, user, ldap_util):
-        email = ldap_util.get_meggitt_mail(user)
+        return Users.get_emails(env, [user], ldap_util)[user]
+
+    @staticmethod
+    def get_emails(env, users, ldap_util):
+        """ {user: email} - the directories are searched in bulk
+            for the users not in the directory cache """
+        entries = DirectoryCache(env).get_users(users, ldap_util)
+        return dict((user, Users._get_email(env, user, entries[user]['mail'] if user in entries else None))
+                    for user in users)
+
+    @staticmethod
+    def _get_email(env, user, email):
         if email:
             # User is in the company directory
             return email
@@ -1654,100 +2248,188 @@ class Users(Component):
             else:
                 self.role_initials[role] = ''.join(item[0] for item in self.displayed_roles[role].split())
 
-        perm = PermissionSystem(self.env)
-        self.all_permissions = perm.get_all_permissions()
+        # Test users
+        self.test_users = [test_user.strip() for test_user in
+                           self.env.config.get('artusplugin', 'htpasswd_test_users').split(',')]
 
-        # Sort by second element
-        def take_second(elem):
-            return elem[1]
+        self._memos = {}
+
+    # IPermissionChangeListener
+
+    def permission_added(self, username, action):
+        self.invalidate()
+
+    def permission_removed(self, username, action):
+        self.invalidate()
+
+    # Index
+
+    @cached
+    def index(self):
+        """ Profiles, roles and users of the project (see UsersIndex)
+            Rebuilt after a permission change, in all the processes """
+        return UsersIndex(PermissionSystem(self.env).get_all_permissions(),
+                          self.user_profiles, self.user_roles)
+
+    def invalidate(self):
+        del self.index
+        self._memos.clear()
+
+    def _get_memo(self, name, key, compute):
+        memo = self._memos.get(name)
+        if memo is None or memo[0] != key:
+            memo = self._memos[name] = (key, compute())
+        return memo[1]
+
+    @property
+    def all_permissions(self):
+        return self.index.all_permissions
+
+    @property
+    def roles_by_profile(self):
+        """ Sorted list of roles by profile """
+        return self.index.roles_by_profile
+
+    @property
+    def users_by_profile(self):
+        """ Sorted list of users by profile
+            (directly assigned to profiles, not through roles) """
+        return self.index.users_by_profile
+
+    @property
+    def users_by_role(self):
+        """ Sorted list of users by role """
+        return self.index.users_by_role
+
+    @property
+    def users_with_role_by_profile(self):
+        """ Sorted list of users with role by profile
+            (users with several roles in same profile are not duplicated) """
+        return self.index.users_with_role_by_profile
+
+    @property
+    def users_without_role_by_profile(self):
+        """ Sorted list of users without role by profile """
+        return self.index.users_by_profile
+
+    @property
+    def project_users(self):
+        """ All project users """
+        return self.index.project_users
+
+    @property
+    def registered_users(self):
+        """ All registered users (read again when the htpasswd file changes) """
+        htpasswd_file = self.env.config.get("artusplugin", "htpasswd_file")
 
-        # Sorted list of roles by profile
-        self.roles_by_profile = {}
-        for profile in self.user_profiles:
-            self.roles_by_profile[profile] = [subject
-                                              for (subject, action) in self.all_permissions
-                                              if subject not in self.user_profiles and
-                                              subject in self.user_roles and
-                                              action == profile]
-            self.roles_by_profile[profile].sort()
-
-        # Sorted list of users by profile
-        # (directly assigned to profiles, not through roles)
-        self.users_by_profile = {}
-        for profile in self.user_profiles:
-            self.users_by_profile[profile] = [subject
-                                              for (subject, action) in self.all_permissions
-                                              if subject not in self.user_profiles and
-                                              subject not in self.user_roles and
-                                              action == profile]
-            self.users_by_profile[profile].sort()
-
-        # Sorted list of users by role
-        self.users_by_role = {}
-        for role in self.user_roles:
-            self.users_by_role[role] = [subject
-                                        for (subject, action) in self.all_permissions
-                                        if action == role]
-            self.users_by_role[role].sort()
+        def read():
+            with open(htpasswd_file, 'r') as f:
+                return {line.split(':')[0] for line in f}
 
-        # Sorted list of users with role by profile
-        # (users with several roles in same profile are not duplicated)
-        self.users_with_role_by_profile = {}
-        for profile in self.user_profiles:
-            self.users_with_role_by_profile[profile] = []
-            for role in self.roles_by_profile[profile]:
-                self.users_with_role_by_profile[profile] += \
-                    [user for user in self.users_by_role[role]]
-            self.users_with_role_by_profile[profile] = \
-                sorted(set(self.users_with_role_by_profile[profile]))
-
-        # Sorted list of users without role by profile
-        self.users_without_role_by_profile = {}
-        for profile in self.user_profiles:
-            self.users_without_role_by_profile[profile] = \
-                [user for user in self.users_by_profile[profile]]
+        return self._get_memo('registered_users', os.path.getmtime(htpasswd_file), read)
 
-        # All registered users
-        htpasswd_file = self.env.config.get("artusplugin", "htpasswd_file")
-        lines = open(htpasswd_file, 'r').readlines()
-        self.registered_users = {line.split(':')[0] for line in lines}
+    @property
+    def users_ldap_names(self):
+        """ Users LdapNames, sorted by name
+            (read again when the users or their translations change,
+            after the directory cache refreshes of the process
+            and every 5 minutes for those of the other processes) """
+        users_ldap_names = UsersLdapNames(self.env)
 
-        # Test users
-        self.test_users = [test_user.strip() for test_user in
-                           self.env.config.get('artusplugin', 'htpasswd_test_users').split(',')]
+        def read():
+            return OrderedDict(sorted(users_ldap_names.get_users_ldap_names(),
+                                      key=lambda elem: elem[1]))
 
-        # All project users
-        self.project_users = set()
-        for profile in self.users_with_role_by_profile:
-            self.project_users.update(self.users_with_role_by_profile[profile])
-        for profile in self.users_without_role_by_profile:
-            self.project_users.update(self.users_without_role_by_profile[profile])
-        sorted(self.project_users)
-
-        # Users LdapNames
-        self.users_ldap_names = OrderedDict()
-        for (k,v) in sorted(UsersLdapNames(self.env).get_users_ldap_names(), key=take_second):
-            self.users_ldap_names[k] = v
-
-        # Email addresses
-        self.users_emails = {}
-        with Ldap_Utilities() as ldap_util:
-            for user in self.project_users:
-                self.users_emails[user] = Users.get_email(self.env, user, ldap_util)
+        return self._get_memo('users_ldap_names',
+                              (os.path.getmtime(users_ldap_names.htpasswd_file),
+                               os.path.getmtime(users_ldap_names.translation_file),
+                               DirectoryCache(self.env).get_generation(),
+                               int(time.time() // 300)),
+                              read)
+
+    @property
+    def users_emails(self):
+        """ Email addresses of the project users """
+        index = self.index
+
+        def read():
+            with Ldap_Utilities() as ldap_util:
+                return Users.get_emails(self.env, list(index.project_users), ldap_util)
+
+        return self._get_memo('users_emails', (id(index), int(time.time() // 300)), read)
+
+    def has_profile(self, user, profile):
+        """ Whether the user is directly assigned to the profile """
+        return user in self.index.user_sets_by_profile.get(profile, ())
+
+    def has_role(self, user):
+        """ Whether the user has a role in the project """
+        return user in self.index.users_with_role
+
+    def get_roles(self, user):
+        """ Roles of the user """
+        return self.index.roles_by_user.get(user, set())
 
     def user_check(self, user):
         # Check user is not associated with a profile or a role
-        return user not in self.project_users
+        return user not in self.index.project_users
 
     def role_check(self, role):
         # Check role is associated with one and only one profile
-        return len([profile for profile in self.roles_by_profile.keys() if role in self.roles_by_profile[profile]]) == 1
+        return len(self.index.profiles_by_role.get(role, ())) == 1
 
     def group_check(self, group):
         # Check group is a known profile or role
         return group in self.user_profiles or group in self.user_roles
 
 
+class UsersIndex(object):
+    """ Profiles, roles and users of the project, built in one pass over
+        the permissions: sorted lists for display and sets for lookups """
+
+    def __init__(self, all_permissions, user_profiles, user_roles):
+        self.all_permissions = all_permissions
+        profiles = set(user_profiles)
+        roles = set(user_roles)
+        role_sets_by_profile = dict((profile, set()) for profile in user_profiles)
+        self.user_sets_by_profile = dict((profile, set()) for profile in user_profiles)
+        user_sets_by_role = dict((role, set()) for role in user_roles)
+        self.profiles_by_role = {}
+        self.roles_by_user = {}
+        # Subjects which are neither profiles nor roles
+        self.users = set()
+        for subject, action in all_permissions:
+            if subject not in profiles and subject not in roles:
+                self.users.add(subject)
+            if action in role_sets_by_profile and subject not in profiles:
+                if subject in roles:
+                    role_sets_by_profile[action].add(subject)
+                    self.profiles_by_role.setdefault(subject, set()).add(action)
+                else:
+                    self.user_sets_by_profile[action].add(subject)
+            if action in user_sets_by_role:
+                user_sets_by_role[action].add(subject)
+                self.roles_by_user.setdefault(subject, set()).add(action)
+
+        self.users_with_role = set()
+        for users in user_sets_by_role.values():
+            self.users_with_role.update(users)
+        self.project_users = set()
+        self.roles_by_profile = {}
+        self.users_by_profile = {}
+        self.users_with_role_by_profile = {}
+        for profile in user_profiles:
+            self.roles_by_profile[profile] = sorted(role_sets_by_profile[profile])
+            self.users_by_profile[profile] = sorted(self.user_sets_by_profile[profile])
+            users_with_role = set()
+            for role in role_sets_by_profile[profile]:
+                users_with_role.update(user_sets_by_role[role])
+            self.users_with_role_by_profile[profile] = sorted(users_with_role)
+            self.project_users.update(users_with_role)
+            self.project_users.update(self.user_sets_by_profile[profile])
+        self.users_by_role = dict((role, sorted(users)) for role, users in user_sets_by_role.items())
+
+
 class UsersLdapNames(object):
     """Support of permissions admin panel."""
 
@@ -1755,17 +2437,10 @@ class UsersLdapNames(object):
         self.env = env
         self.htpasswd_file = self.env.config.get('artusplugin', 'htpasswd_file')
         self.translation_file = self.env.config.get('artusplugin', 'translation_file')
-        self.ldap_display_names_file = self.env.config.get('artusplugin', 'ldap_display_names_file')
-        self.ldap_display_names_section = 'user-display'
         self.projects_database_filepath = self.env.config.get('artusplugin', 'projects_database_filepath')
         self.special_users = [special_user.strip() for special_user in
                               self.env.config.get('artusplugin', 'htpasswd_special_users').split(',')]
         self.login_type = self.get_project_login_type()
-        self.sem_name = '/%s' % str(self.ldap_display_names_file.replace('/', ':'))
-        self.sem_handle = posix_ipc.Semaphore(
-            name=self.sem_name,
-            flags=posix_ipc.O_CREAT,
-            initial_value=1)
 
     def get_users_ldap_names(self):
         # Get real users
@@ -1778,79 +2453,29 @@ class UsersLdapNames(object):
                 continue
             real_users.append(user)
 
-        # Start of critical section
-        self.sem_handle.acquire()
-
-        # Check cache existence and validity, regenerate if needed
-        generate = False
-        if not os.path.isfile(self.ldap_display_names_file):
-            generate = True
-        else:
-            ldap_display_names_mt = os.path.getmtime(self.ldap_display_names_file)
-            htpasswd_mt = os.path.getmtime(self.htpasswd_file)
-            translation_mt = os.path.getmtime(self.translation_file)
-            if htpasswd_mt > ldap_display_names_mt or translation_mt > ldap_display_names_mt:
-                generate = True
-
-        if generate:
-            self._generate_cache(real_users)
-
-        # End of critical section
-        self.sem_handle.release()
-
-        # Read cache
-        ldap_display = ConfigParser.RawConfigParser()
-        ldap_display.read(self.ldap_display_names_file)
+        directory_cache = DirectoryCache(self.env)
+        # Users translations may have changed
+        directory_cache.expire(os.path.getmtime(self.translation_file))
+        # Users added to htpasswd are looked up in the background,
+        # their user name being displayed meanwhile
+        entries = directory_cache.get_users(real_users, wait=False)
 
         # Get project compatible users
         ldap_display_names = []
-        for username, display_name in ldap_display.items(self.ldap_display_names_section):
+        for username in real_users:
             if ((self.login_type == 'fname' and '.' in username) or
                 (self.login_type == 'forename.name' and '.' not in username)):
                 continue
             else:
+                display_name = entries.get(username, {}).get('display_name')
+                if display_name is None:
+                    display_name = username
+                else:
+                    display_name = unidecode(str(display_name))
                 ldap_display_names.append((username, display_name))
 
         return ldap_display_names
 
-    def _generate_cache(self, usernames):
-        # Get data
-        ldap_display = ConfigParser.RawConfigParser()
-        ldap_display.add_section(self.ldap_display_names_section)
-        for username, ldap_name in self._get_ldap_names(usernames).items():
-            ldap_display.set(self.ldap_display_names_section, username, ldap_name)
-
-        # Generate
-        if os.access(self.ldap_display_names_file, os.F_OK):
-            os.remove(self.ldap_display_names_file)
-        flags = os.O_CREAT + os.O_WRONLY
-        if hasattr(os, 'O_BINARY'):
-            flags += os.O_BINARY
-        targetfile = os.fdopen(os.open(self.ldap_display_names_file, flags, 666), 'w')
-        ldap_display.write(targetfile)
-        targetfile.close()
-
-    def _get_ldap_names(self, usernames):
-        ldap_names = OrderedDict()
-        with Ldap_Utilities() as ldap_util:
-            for username in usernames:
-                from_addr = Users.get_email(self.env, username, ldap_util)
-                if from_addr:
-                    user_id = from_addr.split('@')[0]
-                    try:
-                        ldap_name = ldap_util.get_ldap_displayname(user_id)
-                        if ldap_name is None:
-                            ldap_name = username
-                        else:
-                            ldap_name = unidecode(str(ldap_name))
-                    except Exception:
-                        ldap_name = username
-                else:
-                    ldap_name = username
-                ldap_names[username] = ldap_name
-
-        return ldap_names
-
     def get_project_login_type(self):
         # Get project login type:
         #   old projects: fname
@@ -66,6 +66,8 @@ from os.path import splitext
 # Same package
 from artusplugin import util, model, form, _
 import artusplugin.cache as cache
+from artusplugin.commitqueue import CommitQueue, commit_document
+from artusplugin.jobs import JobQueue
 from artusplugin.genshi.functions import plaintext, TEXT, TextSerializer
 
 class Ticket_UI(object):
@@ -1181,6 +1183,10 @@ class ArtusModule(Component):
 
         add_script_data(req, g_trac_env_name=self.trac_env_name, g_program_name=self.program_name)
 
+        if req.authname != 'anonymous' and JobQueue(self.env).has_recent_jobs(req.authname):
+            # PDF packaging/printing jobs shown (see show_pdf_jobs in artus.js)
+            add_script_data(req, g_pdf_jobs=True)
+
         if filename == "ticket.html":
 
             stream = self._filter_ticket_stream(req, method, filename, stream, data)
@@ -1632,6 +1638,10 @@ class ArtusModule(Component):
 
             elif (ticket_type == 'ECM' and not Ticket_UI.get_UI(ticket).legacy) or ticket_type == 'FEE' or ticket_type == 'DOC':
 
+                if CommitQueue(self.env).is_enabled():
+                    # Background commit of the document reported (see poll_commit_status in artus.js)
+                    add_script_data(req, g_commit_queue=True)
+
                 if ticket['status'] == '01-assigned_for_edition':
                     # A button is added in order to browse the source url (see doc_sourceurl in artus.js)
                     sourceurl = req.args.get('sourceurl') or ticket['sourceurl']
@@ -1648,7 +1658,8 @@ class ArtusModule(Component):
                         with template_cls(self.env,
                                           self.trac_env_name,
                                           req.authname,
-                                          ticket) as doc:
+                                          ticket,
+                                          mode='shared') as doc:
                             # A button is added in order to view or edit
                             # the document source file (see doc_sourcefile() in artus.js)
                             selected_src = ""
@@ -2623,29 +2634,18 @@ class ArtusModule(Component):
         # This is POST here: tickets selected from report for pdf printing
         if 'pdf_show' in req.args:
             if 'pdf_checkbox' in req.args:
-                # Handle PDF conversion asynchronously
-                pid = os.fork()
-                if pid == 0:  # Child process
-                    # The following waiting time is for allowing the parent process
-                    # to end because it seems concurrency is poorly supported for
-                    # access to the Trac database and generates the following error:
-                    # "sqlite backend database disk image is malformed"
-                    sleep(10)
-                    form.TicketForm.tickets_pdf_convert(self.env,
-                                                        self.trac_env_name,
-                                                        req.authname,
-                                                        req.args.get('pdf_checkbox'))
-                    os._exit(0)
-                else:  # Parent process
-                    base_url = '/PDF-printing/%s' % self.trac_env_name
-                    add_notice(req, _('You will receive an email '
-                                      'when your packaging job is complete. '))
-                    add_notice(req, tag(_('You may also click on '),
-                                        tag.a(_('this link'),
-                                              href="%s" % base_url),
-                                        _(' to access the package(s) directly. '),
-                                        tag.b(_('Please allow some time')),
-                                        _(' for zip generation.')))
+                # Handle PDF conversion asynchronously (see xhrget 'pdf_jobs')
+                JobQueue(self.env).enqueue('pdf_print', req.authname, {
+                    'ticket_list': req.args.get('pdf_checkbox')})
+                base_url = '/PDF-printing/%s' % self.trac_env_name
+                add_notice(req, _('You will receive an email '
+                                  'when your packaging job is complete. '))
+                add_notice(req, tag(_('You may also click on '),
+                                    tag.a(_('this link'),
+                                          href="%s" % base_url),
+                                    _(' to access the package(s) directly. '),
+                                    tag.b(_('Please allow some time')),
+                                    _(' for zip generation.')))
             else:
                 add_warning(req, _('You have not selected any ticket for PDF printing.'))
         if req.path_info.startswith('/report') and 'action' not in req.args:
@@ -3134,11 +3134,10 @@ class ArtusModule(Component):
                     template_cls = cache.Ticket_Cache.get_subclass(ticket['type'])
                     with template_cls(self.env, self.trac_env_name,
                                       req.authname, ticket) as doc:
+                        doc.update_files([ticket['sourcefile'], ticket['pdffile']])
                         if ticket['sourcefile'] and ticket['sourcefile'] != 'N/A':
-                            doc.update(ticket['sourcefile'])
                             doc.set_access(ticket['sourcefile'])
                         if ticket['pdffile'] and ticket['pdffile'] != 'N/A':
-                            doc.update(ticket['pdffile'])
                             if doc.exist_in_wc(ticket['pdffile']):
                                 doc.set_access(ticket['pdffile'])
                             else:
@@ -3566,7 +3565,8 @@ class ArtusModule(Component):
                 with template_cls(self.env,
                                   self.trac_env_name,
                                   req.authname,
-                                  ticket) as doc:
+                                  ticket,
+                                  mode='shared') as doc:
                     # Check existence of source or pdf trac lock in the repository
                     # This is to avoid deleting a ticket in Lock status
                     for docfile in (ticket['sourcefile'], ticket['pdffile']):
@@ -5075,7 +5075,8 @@ class ArtusModule(Component):
                         with template_cls(self.env,
                                           self.trac_env_name,
                                           req.authname,
-                                          ticket) as doc:
+                                          ticket,
+                                          mode='shared') as doc:
                             docfile = (ticket['sourcefile']
                                        if field_name == 'src_wc_status'
                                        else ticket['pdffile'])
@@ -5093,7 +5094,8 @@ class ArtusModule(Component):
                 with template_cls(self.env,
                                   self.trac_env_name,
                                   req.authname,
-                                  ticket) as doc:
+                                  ticket,
+                                  mode='shared') as doc:
                     docfile = (ticket['sourcefile']
                                if field_name == 'src_locker'
                                else ticket['pdffile'])
@@ -5119,7 +5121,8 @@ class ArtusModule(Component):
                     with template_cls(self.env,
                                       self.trac_env_name,
                                       req.authname,
-                                      ticket) as doc:
+                                      ticket,
+                                      mode='shared') as doc:
                         repo_url = ticket['sourceurl']
                         url = util.get_url(repo_url)
                         revision = util.get_revision(repo_url)
@@ -5165,7 +5168,8 @@ class ArtusModule(Component):
                     with template_cls(self.env,
                                       self.trac_env_name,
                                       req.authname,
-                                      ticket) as doc:
+                                      ticket,
+                                      mode='shared') as doc:
                         repo_url = ticket['sourceurl']
                         url = util.get_url(repo_url)
                         revision = util.get_revision(repo_url)
@@ -5195,7 +5199,8 @@ class ArtusModule(Component):
                     with template_cls(self.env,
                                       self.trac_env_name,
                                       req.authname,
-                                      ticket) as doc:
+                                      ticket,
+                                      mode='shared') as doc:
                         exist = doc.exist_in_wc(docfile)
                 field_value = json.dumps(exist)
 
@@ -5210,7 +5215,8 @@ class ArtusModule(Component):
                         with template_cls(self.env,
                                           self.trac_env_name,
                                           req.authname,
-                                          ticket) as doc:
+                                          ticket,
+                                          mode='shared') as doc:
                             docfile = (ticket['sourcefile']
                                        if field_name == 'src_repos_status'
                                        else ticket['pdffile'])
@@ -5230,6 +5236,14 @@ class ArtusModule(Component):
                 else:
                     field_value = json.dumps('ticket closed')
 
+            elif field_name == 'commit_status':
+                ticket_id = req.args.get('ticket_id')
+                field_value = json.dumps(CommitQueue(self.env).get_job_status(ticket_id, req.authname))
+
+            elif field_name == 'pdf_jobs':
+                # PDF packaging/printing jobs of the user and their progress
+                field_value = json.dumps(JobQueue(self.env).get_jobs(req.authname))
+
             elif field_name == 'workflow':
                 ticket_id = req.args.get('ticket_id')
                 ticket = Ticket(self.env, ticket_id)
@@ -5423,26 +5437,12 @@ class ArtusModule(Component):
                                         raise HTTPNotFound(_("The PDF File is older than the Source File"))
 
                                 # Commit the source and pdf files
-                                revision = doc.commit()
-                                if revision != '':
-                                    # The locks have been automatically removed
-                                    if (ticket['sourcefile'] and ticket['sourcefile'] != 'N/A'):
-                                        doc.set_access(ticket['sourcefile'])
-                                    if (ticket['pdffile'] and ticket['pdffile'] != 'N/A'):
-                                        doc.set_access(ticket['pdffile'])
-                                    # Beware recursion and cache semaphore !
-                                    # Used for ECM/FEE author tracking
-                                    ticket['sourceurl'] = '%s?rev=%s' % (
-                                        util.get_url(ticket['sourceurl']),
-                                        revision)
-                                    now = datetime.now(utc)
-                                    ticket.save_changes('trac', _('Source Url changed (on behalf of %(user)s)', user=req.authname), now)
+                                commit_queue = CommitQueue(self.env)
+                                if commit_queue.is_enabled():
+                                    # see xhrget 'commit_status'
+                                    commit_queue.enqueue(ticket, req.authname, doc.path)
                                 else:
-                                    # Remove the locks
-                                    if (ticket['sourcefile'] and ticket['sourcefile'] != 'N/A'):
-                                        doc.unlock(ticket['sourcefile'])
-                                    if (ticket['pdffile'] and ticket['pdffile'] != 'N/A'):
-                                        doc.unlock(ticket['pdffile'])
+                                    commit_document(self.env, doc, ticket, req.authname)
 
                         else:
                             template_cls = cache.Ticket_Cache.get_subclass(ticket['type'])
@@ -5466,18 +5466,17 @@ class ArtusModule(Component):
                                             generated_pdf = ticket['sourcefile'].replace('.docm', '.pdf')
                                         else:
                                             generated_pdf = None
-                                        doc.lock(ticket['sourcefile'])
+                                        docfiles = [ticket['sourcefile']]
                                         if generated_pdf:
-                                            doc.lock(generated_pdf)
+                                            docfiles.append(generated_pdf)
                                         elif ticket['pdffile'] != 'N/A':
-                                            doc.lock(ticket['pdffile'])
+                                            docfiles.append(ticket['pdffile'])
+                                        doc.lock_files(docfiles)
 
                                 elif action == 'unlock':
                                     # Remove the locks
-                                    if (ticket['sourcefile'] and ticket['sourcefile'] != 'N/A'):
-                                        doc.unlock(ticket['sourcefile'])
-                                    if (ticket['pdffile'] and ticket['pdffile'] != 'N/A'):
-                                        doc.unlock(ticket['pdffile'])
+                                    doc.unlock_files([docfile for docfile in (ticket['sourcefile'], ticket['pdffile'])
+                                                      if docfile and docfile != 'N/A'])
 
             else:
                 if action == 'change_comment_edit':
@@ -5515,6 +5514,8 @@ class ArtusModule(Component):
                     # prepare the MOM form
                     skills = util.get_ticket_skills(self.env, ticket['skill'])
                     tf.setup(skills, ticket['milestonetag'])
+                elif action == 'cancel_job':
+                    JobQueue(self.env).cancel(req.args.get('job_id'), req.authname)
                 else:
                     raise TracError(_("xhrpost unknown action: %s" % action))
 